@@ -0,0 +1,61 @@
+import argparse
+from sources.batch import BatchCutter
+from sources.pyramid import parse_size
+from sources.common.constants import *
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Measure every cell of every image in a folder, '\
+                    'without GUI')
+    parser.add_argument('image_folder')
+    parser.add_argument('-o', '--output', default='cells.csv',
+                        help='csv file to write the results')
+    parser.add_argument('-r', '--ratio', type=float,
+                        default=DEFAULT_MASK_RATIO,
+                        help='threshold of cell probability (0~100)')
+    parser.add_argument('--mp-pixel', type=float, default=DEFAULT_MP_PIXEL,
+                        help='length in pixels of the scale bar, '\
+                             'in the original image')
+    parser.add_argument('--mp-micro', type=float, default=DEFAULT_MP_MICRO,
+                        help='length in micrometers of the scale bar')
+    parser.add_argument('--min-pixels', type=int, default=MIN_CELL_PIXELS,
+                        help='ignore cells smaller than this')
+    parser.add_argument('--keep-border', action='store_true',
+                        help='also measure cells touching the image border')
+    parser.add_argument('-b', '--batch-size', type=int,
+                        default=DEFAULT_BATCH_SIZE,
+                        help='number of images (or tiles) given to the '\
+                             'model at once')
+    parser.add_argument('--tiled', action='store_true',
+                        help='predict AI mask on overlapping tiles '\
+                             'instead of the whole image resized')
+    parser.add_argument('--tile-size', type=int, default=DEFAULT_TILE_SIZE)
+    parser.add_argument('--tile-overlap', type=int,
+                        default=DEFAULT_TILE_OVERLAP)
+    parser.add_argument('--tile-scale', type=float,
+                        default=DEFAULT_TILE_SCALE,
+                        help='scale of the image before cutting tiles')
+    parser.add_argument('--prob-cache', default=PROB_CACHE_DIR,
+                        help='directory to cache AI masks')
+    parser.add_argument('--no-prob-cache', action='store_true',
+                        help='always run the model, even for known images')
+    parser.add_argument('--work-size', type=parse_size,
+                        default=WORK_SIZE, metavar='WIDTHxHEIGHT',
+                        help='size images are worked on at, keeping '\
+                             'aspect ratio, or "native" (default '\
+                             f'{WORK_SIZE[0]}x{WORK_SIZE[1]})')
+    args = parser.parse_args()
+    # TilePlan would only raise it later, in the Engine or a batch
+    if not 0 <= args.tile_overlap < args.tile_size:
+        parser.error('--tile-overlap should be at least 0, '\
+                     'and smaller than --tile-size')
+    cutter = BatchCutter(args.ratio, args.mp_pixel, args.mp_micro,
+                         args.min_pixels, args.keep_border, args.batch_size,
+                         {'tiled' : args.tiled,
+                          'tile_size' : args.tile_size,
+                          'tile_overlap' : args.tile_overlap,
+                          'tile_scale' : args.tile_scale,
+                          'cache_dir' : None if args.no_prob_cache \
+                                        else args.prob_cache},
+                         args.work_size)
+    cutter.run(args.image_folder, args.output)
@@ -0,0 +1,95 @@
+"""
+Compare the old scanline flood fill of Engine.fill_cell with CellIndex.
+
+Run from the repository root:
+    python -m benchmarks.bench_fill_cell
+"""
+import time
+import numpy as np
+from skimage import draw
+from sources.common.constants import *
+from sources.cell_index import CellIndex
+
+def scanline_fill(mask, pos):
+    """
+    The pure Python fill that Engine.fill_cell used before CellIndex
+    """
+    shape = mask.shape
+    mask = mask.copy()
+    new_layer = np.zeros((shape[0],shape[1],1), dtype=bool)
+    pos_stack = [pos]
+    pix_count = 0
+    while len(pos_stack) > 0:
+        x, y = pos_stack.pop()
+        while (mask[x,y] == CELL).all() and x>=0:
+            x -= 1
+        x += 1
+        above, below = False, False
+        while x < shape[0] and (mask[x,y]==CELL).all():
+            mask[x,y] = COUNT
+            new_layer[x,y] = True
+            pix_count += 1
+            if (not above) and (y>0) and (mask[x,y-1]==CELL).all():
+                pos_stack.append([x,y-1])
+                above = True
+            elif (above) and (y>0) and (mask[x,y-1]!=CELL).any():
+                above = False
+            if (not below) and (y<shape[1]-1) and (mask[x,y+1]==CELL).all():
+                pos_stack.append([x,y+1])
+                below = True
+            elif (below) and (y<shape[1]-1) and (mask[x,y+1]!=CELL).any():
+                below = False
+            x += 1
+    return new_layer, pix_count
+
+def index_fill(index, mask, pos):
+    new_layer = np.zeros((mask.shape[0],mask.shape[1],1), dtype=bool)
+    label = index.label_at(pos)
+    pix_count = 0
+    if label > 0:
+        box, component = index.component(label)
+        new_layer[box][...,0] = component
+        pix_count = index.count(label)
+    return new_layer, pix_count
+
+def cell_mask(shape, radius, rng):
+    """
+    A membrane grid with one round cell of radius in the middle,
+    and small noisy cells around it
+    """
+    mask = np.zeros(shape, dtype=np.uint8)
+    mask[rng.random(shape[:2]) > 0.4] = CELL
+    center = (shape[0]//2, shape[1]//2)
+    rr, cc = draw.disk(center, radius+2, shape=shape[:2])
+    mask[rr, cc] = MEMBRANE
+    rr, cc = draw.disk(center, radius, shape=shape[:2])
+    mask[rr, cc] = CELL
+    return mask, center
+
+def timeit(f, repeat):
+    times = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        result = f()
+        times.append(time.perf_counter() - t)
+    return result, np.median(times)
+
+if __name__ == '__main__':
+    rng = np.random.default_rng(0)
+    shape = (1200, 900, 3)
+    print(f'{"radius":>7}{"pixels":>9}{"scanline(ms)":>14}'
+          f'{"build(ms)":>11}{"click(ms)":>11}{"speedup":>9}')
+    for radius in (5, 20, 50, 100, 200, 400):
+        mask, center = cell_mask(shape, radius, rng)
+        (old_layer, old_count), t_old = timeit(
+            lambda: scanline_fill(mask, center), 1)
+        index = CellIndex()
+        _, t_build = timeit(
+            lambda: index.build((mask == CELL).all(axis=2)), 3)
+        (new_layer, new_count), t_click = timeit(
+            lambda: index_fill(index, mask, center), 5)
+        if old_count != new_count or (old_layer != new_layer).any():
+            raise AssertionError(f'Fill differs at radius {radius}')
+        print(f'{radius:>7}{new_count:>9}{t_old*1000:>14.1f}'
+              f'{t_build*1000:>11.1f}{t_click*1000:>11.2f}'
+              f'{t_old/t_click:>9.0f}x')
@@ -0,0 +1,56 @@
+"""
+Compare the old openpyxl round trip of Engine.fill_save with ResultStore,
+as results pile up.
+
+Run from the repository root:
+    python -m benchmarks.bench_save
+"""
+import os
+import time
+import tempfile
+import numpy as np
+from openpyxl import Workbook, load_workbook
+from sources.results import ResultStore
+
+def workbook_save(path, areas, image_name):
+    """
+    What Engine.fill_save did before ResultStore
+    """
+    wb = load_workbook(path)
+    ws = wb.worksheets[0]
+    row, col = 1, 1
+    while ws.cell(row, col).value != None:
+        col += 1
+    for area in areas:
+        ws.cell(row, col).value = area
+        ws.cell(row, col+1).value = image_name
+        row += 1
+    wb.save(path)
+
+if __name__ == '__main__':
+    rng = np.random.default_rng(0)
+    cells_per_save = 20
+    saves = 400
+    with tempfile.TemporaryDirectory() as d:
+        xlsx = os.path.join(d, 'old.xlsx')
+        Workbook().save(xlsx)
+        store = ResultStore(os.path.join(d, 'results.sqlite3'))
+        print(f'{"saves":>7}{"workbook(ms)":>14}{"store(ms)":>11}')
+        for i in range(1, saves+1):
+            areas = rng.uniform(500, 10000, cells_per_save).tolist()
+            name = f'image_{i:04d}.jpg'
+            t = time.perf_counter()
+            workbook_save(xlsx, areas, name)
+            t_old = time.perf_counter() - t
+            t = time.perf_counter()
+            store.add_cells(name, [(a, int(a/0.16), ((0,0),(100,100)))
+                                   for a in areas], 63, 50)
+            t_new = time.perf_counter() - t
+            if i in (1, 10, 50, 100, 200, 400):
+                print(f'{i:>7}{t_old*1000:>14.1f}{t_new*1000:>11.2f}')
+        for ext in ('xlsx', 'csv'):
+            t = time.perf_counter()
+            n = store.export(os.path.join(d, f'export.{ext}'))
+            print(f'Export {n} cells to {ext}: '
+                  f'{(time.perf_counter()-t)*1000:.0f} ms')
+        store.close()
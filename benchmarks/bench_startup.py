@@ -0,0 +1,98 @@
+"""
+Startup cost of each process of cutter.py.
+
+Import time and peak memory are measured in fresh interpreters, for the
+old layout (every spawned process imported cutter.py, which imported
+TensorFlow through sources.engine) and the current one. Time to first
+frame is measured by starting Engine alone and asking it for an image.
+
+Run from the repository root:
+    python -m benchmarks.bench_startup
+"""
+import sys
+import time
+import subprocess
+from multiprocessing import Queue, set_start_method
+from sources.common.constants import *
+
+# Modules each process imports
+LAYOUTS = {
+    'before' : {
+        'main' : ['tensorflow', 'sources.console', 'sources.viewer',
+                  'sources.engine'],
+        'console' : ['tensorflow', 'sources.console', 'sources.viewer',
+                     'sources.engine'],
+        'viewer' : ['tensorflow', 'sources.console', 'sources.viewer',
+                    'sources.engine'],
+        'engine' : ['tensorflow', 'sources.console', 'sources.viewer',
+                    'sources.engine'],
+    },
+    'after' : {
+        'main' : ['sources.console', 'sources.viewer', 'sources.engine'],
+        'console' : ['sources.console'],
+        'viewer' : ['sources.viewer'],
+        'engine' : ['sources.engine', 'sources.inference'],
+    },
+}
+
+PROBE = """
+import time, importlib
+t = time.perf_counter()
+for m in {modules!r}:
+    importlib.import_module(m)
+t = time.perf_counter() - t
+try:
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    if __import__('sys').platform == 'darwin':
+        rss /= 1024
+except ImportError:
+    import psutil
+    rss = psutil.Process().memory_info().peak_wset / 2**20
+print(t, rss)
+"""
+
+def probe(modules):
+    """
+    Returns (import seconds, peak RSS in MB) of a fresh interpreter
+    """
+    out = subprocess.run([sys.executable, '-c', PROBE.format(modules=modules)],
+                         capture_output=True, text=True)
+    if out.returncode != 0:
+        return None
+    t, rss = out.stdout.split()[-2:]
+    return float(t), float(rss)
+
+def first_frame(image_path, timeout=120):
+    """
+    Seconds from starting Engine until Viewer would get the frame of image
+    """
+    from sources.engine import Engine
+    from sources.inbox import Inbox
+    to_EngineQ, to_ConsoleQ, imageQ, etcQ = [Queue() for _ in range(4)]
+    engine = Engine(to_EngineQ, to_ConsoleQ, imageQ, etcQ)
+    t = time.perf_counter()
+    engine.start()
+    Inbox(to_EngineQ).put({NEWIMAGE:image_path})
+    shape = None
+    while shape is None or shape[:2] != (1200, 900):
+        shape = imageQ.get(timeout=timeout)[NEW_FRAME][0][3]
+    t = time.perf_counter() - t
+    engine.terminate()
+    return t
+
+if __name__ == '__main__':
+    set_start_method('spawn')
+    for layout, processes in LAYOUTS.items():
+        print(f'{layout}:')
+        total = 0
+        for process, modules in processes.items():
+            result = probe(modules)
+            if result is None:
+                print(f'  {process:>8}: import failed {modules}')
+                continue
+            t, rss = result
+            total += rss
+            print(f'  {process:>8}: import {t:6.2f}s   peak RSS {rss:7.1f}MB')
+        print(f'  {"total":>8}: peak RSS {total:7.1f}MB')
+    print(f'time to first frame: {first_frame("images/CK1_1_0006.jpg"):.2f}s')
@@ -0,0 +1,364 @@
+"""
+Benchmarks of the Engine hot paths, compared with a stored baseline.
+
+Engine runs headless in this process, on synthetic images of several
+resolutions and on the bundled images/. Every case reports percentile
+latencies and throughput; a case is a regression when its median is
+slower than the baseline by more than the tolerance.
+
+The mask model stages (preprocess, inference, postprocess of
+set_new_mask) need TensorFlow and are skipped without it.
+
+Run from the repository root:
+    python -m benchmarks.suite                # compare with baseline.json
+    python -m benchmarks.suite --save         # store a new baseline
+    python -m benchmarks.suite --quick -k fill_cell
+Exits with 1 if a case regressed, or has no baseline.
+"""
+import os
+import sys
+import json
+import glob
+import time
+import argparse
+import platform
+import tempfile
+import numpy as np
+from PIL import Image
+from scipy import ndimage
+from skimage import draw
+from sources.common.constants import *
+from sources.engine import Engine
+from sources.packed import PackedLabels
+from sources.prob_map import ProbMap
+from tests.conftest import Sink
+
+BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+# (Width, Height) of synthetic images; 1200x900 is the default WORK_SIZE
+RESOLUTIONS = [(600, 450), (1200, 900), (2400, 1800)]
+LAYER_COUNTS = [0, 4, 16, 64]
+CELL_RADII = [10, 40, 160]
+STROKE_COUNTS = [1, 8]
+# Clips saved at once by fill_save
+SAVE_CLIPS = 5
+# Regression when median > baseline median * (1 + TOLERANCE)
+TOLERANCE = 0.25
+# and slower by more than this; Below it is scheduler noise
+MIN_SLOWDOWN_MS = 0.1
+
+def headless_engine():
+    sink = Sink()
+    return Engine(None, sink, sink, sink), sink
+
+def synthetic_image(shape, rng):
+    """
+    Smooth random (Width, Height, 3) uint8 image
+    """
+    image = ndimage.gaussian_filter(rng.random(shape[:2]+(3,)), (4, 4, 0))
+    image = (image - image.min()) / np.ptp(image)
+    return (image * 255).astype(np.uint8)
+
+def synthetic_prob(shape, rng):
+    """
+    (Width, Height) probability of blobs of various sizes, like cells
+    """
+    prob = ndimage.gaussian_filter(rng.random(shape[:2]), 8)
+    return ((prob - prob.min()) / np.ptp(prob)).astype(np.float32)
+
+def disk_prob(shape, radius, rng):
+    """
+    Probability of one round cell of radius in the middle, walled by
+    membrane, among noise
+    """
+    prob = rng.random(shape[:2]).astype(np.float32)
+    center = (shape[0]//2, shape[1]//2)
+    rr, cc = draw.disk(center, radius+2, shape=shape[:2])
+    prob[rr, cc] = 0
+    rr, cc = draw.disk(center, radius, shape=shape[:2])
+    prob[rr, cc] = 1
+    return prob, center
+
+def clipped_engine(shape, rng):
+    """
+    Engine showing the AI mask of a clip as big as the whole image
+    """
+    engine, sink = headless_engine()
+    engine.image = synthetic_image(shape, rng)
+    engine.clip_image((0, 0), shape[:2])
+    engine.set_prob_mask(synthetic_prob(shape, rng))
+    return engine, sink
+
+def draw_lines(engine, n, rng):
+    """
+    Draw n connected membrane lines, like draw_mem mode
+    """
+    w, h = engine.shape[:2]
+    points = rng.integers((0, 0), (w, h), size=(n+1, 2))
+    engine.draw_mem_start(tuple(points[0]))
+    for p in points[1:]:
+        engine.draw_mem_end(tuple(p))
+
+def add_clips(engine, shape, rng):
+    """
+    Confirm SAVE_CLIPS clips of shape, as clip_confirm does
+    """
+    for _ in range(SAVE_CLIPS):
+        mask = (synthetic_prob(shape, rng) > 0.5).view(np.uint8)
+        engine._clips.append(engine.clip_store().append(
+            synthetic_image(shape, rng),
+            PackedLabels(mask[...,np.newaxis])))
+
+def measure(f, setup=None, repeat=20, warmup=2):
+    """
+    Returns seconds of each call of f; setup() is called before each call
+    and is not timed
+    """
+    times = []
+    for i in range(warmup + repeat):
+        if setup is not None:
+            setup()
+        t = time.perf_counter()
+        f()
+        t = time.perf_counter() - t
+        if i >= warmup:
+            times.append(t)
+    return times
+
+def summary(times):
+    p50, p90, p99 = np.percentile(times, [50, 90, 99]) * 1000
+    return {'n':len(times), 'p50_ms':round(float(p50), 4),
+            'p90_ms':round(float(p90), 4), 'p99_ms':round(float(p99), 4),
+            'per_s':round(len(times) / float(np.sum(times)), 2)}
+
+def res_name(shape):
+    return f'{shape[0]}x{shape[1]}'
+
+# Each case yields (name, seconds of each call)
+
+def case_put_image(shapes, repeat, rng):
+    for shape in shapes:
+        for n in LAYER_COUNTS:
+            engine, _ = clipped_engine(shape, rng)
+            if n > 0:
+                draw_lines(engine, n, rng)
+            yield f'put_image/{res_name(shape)}/layers={n}', \
+                measure(engine.put_image, repeat=repeat)
+            engine.close()
+
+def case_fill_cell(shapes, repeat, rng):
+    for shape in shapes:
+        for radius in CELL_RADII:
+            if 2*(radius+2) >= min(shape[:2]):
+                continue
+            engine, _ = headless_engine()
+            engine.image = synthetic_image(shape, rng)
+            prob, center = disk_prob(shape, radius, rng)
+            engine.set_prob_mask(prob, 50)
+            yield f'fill_cell/{res_name(shape)}/radius={radius}', \
+                measure(lambda: engine.fill_cell(center), repeat=repeat)
+            engine.close()
+
+def case_load_image(shapes, repeat, rng):
+    engine, _ = headless_engine()
+    with tempfile.TemporaryDirectory() as d:
+        for shape in shapes:
+            path = os.path.join(d, f'{res_name(shape)}.jpg')
+            Image.fromarray(synthetic_image(shape, rng).swapaxes(0,1)
+                            ).save(path)
+            yield f'load_image/{res_name(shape)}', \
+                measure(lambda: engine.load_image(path), repeat=repeat)
+    paths = sorted(glob.glob(os.path.join('images', '*.jpg')))[:repeat]
+    if paths:
+        it = iter(paths * 2)
+        yield 'load_image/images', \
+            measure(lambda: engine.load_image(next(it)),
+                    repeat=len(paths), warmup=min(2, len(paths)))
+    engine.close()
+
+def case_set_new_mask(shapes, repeat, rng):
+    try:
+        from sources.inference import Predictor, preprocess, postprocess
+    except ImportError as e:
+        print(f'Skipping mask model stages: {e}', file=sys.stderr)
+        predictor = None
+    else:
+        predictor = Predictor(MASK_MODEL, cache_dir=None)
+    for shape in shapes:
+        image = synthetic_image(shape, rng)
+        if predictor is not None:
+            name = f'set_new_mask/{res_name(shape)}'
+            yield f'{name}/preprocess', \
+                measure(lambda: preprocess(image), repeat=repeat)
+            tiles = preprocess(image)[np.newaxis]
+            yield f'{name}/inference', \
+                measure(lambda: predictor.predict_tiles(tiles), repeat=repeat)
+            prob = predictor.predict_tiles(tiles)[0]
+            yield f'{name}/postprocess', \
+                measure(lambda: postprocess(prob, shape), repeat=repeat)
+        # What is left once the probability is known: threshold and index
+        engine, _ = headless_engine()
+        engine.image = image
+        prob = synthetic_prob(shape, rng)
+        yield f'set_new_mask/{res_name(shape)}/apply', \
+            measure(lambda: engine.set_prob_mask(prob), repeat=repeat)
+        engine.close()
+
+def case_change_mask_ratio(shapes, repeat, rng):
+    for shape in shapes:
+        engine, _ = clipped_engine(shape, rng)
+        ratios = iter([30, 50] * (repeat+2))
+        yield f'change_mask_ratio/{res_name(shape)}', \
+            measure(lambda: engine.change_mask_ratio(next(ratios)),
+                    repeat=repeat)
+        engine.close()
+
+def case_draw_apply(shapes, repeat, rng):
+    for shape in shapes:
+        for n in STROKE_COUNTS:
+            engine, _ = clipped_engine(shape, rng)
+            yield f'draw_apply/{res_name(shape)}/lines={n}', \
+                measure(engine.draw_apply,
+                        lambda: draw_lines(engine, n, rng), repeat=repeat)
+            engine.close()
+
+def case_fill_save(shapes, repeat, rng):
+    for shape in shapes:
+        clip = (shape[0]//3, shape[1]//3, 3)
+        with tempfile.TemporaryDirectory() as d:
+            engine, sink = headless_engine()
+            add_clips(engine, clip, rng)
+            engine._cell_counts = [1000] * SAVE_CLIPS
+            engine._clip_boxes = [((0, 0), clip[:2])] * SAVE_CLIPS
+            name = f'fill_save/{res_name(shape)}/clips={SAVE_CLIPS}'
+            # Time Engine is busy, then until the images are written
+            pending = []
+            def save():
+                engine.fill_save('bench.jpg', d)
+                pending.append(True)
+            def wait():
+                while pending:
+                    sink.get()
+                    pending.pop()
+            def unsave():
+                # Saving again only adds clips that are not saved yet
+                wait()
+                engine._saved_clips.clear()
+            yield name, measure(save, unsave, repeat=repeat)
+            wait()
+            def written():
+                unsave()
+                save()
+                wait()
+            yield f'{name}/written', measure(written, repeat=repeat)
+            engine.close()
+
+def case_session(shapes, repeat, rng):
+    for shape in shapes:
+        clip = (shape[0]//3, shape[1]//3)
+        with tempfile.TemporaryDirectory() as d:
+            engine, _ = headless_engine()
+            engine.image = synthetic_image(shape, rng)
+            engine._image_path = os.path.join(d, 'bench.png')
+            engine._prob_masks[(engine._image_path, None)] = \
+                ProbMap(synthetic_prob(shape, rng))
+            add_clips(engine, clip, rng)
+            engine._cell_counts = [1000] * SAVE_CLIPS
+            engine._clip_boxes = [((0, 0), clip)] * SAVE_CLIPS
+            name = f'session/{res_name(shape)}/clips={SAVE_CLIPS}'
+            yield f'{name}/save', measure(engine.save_session, repeat=repeat)
+            yield f'{name}/restore', \
+                measure(engine.restore_session, engine.reset, repeat=repeat)
+            engine.close()
+
+CASES = [case_put_image, case_fill_cell, case_load_image, case_set_new_mask,
+         case_change_mask_ratio, case_draw_apply, case_fill_save,
+         case_session]
+
+def run(shapes, repeat, pattern=None):
+    rng = np.random.default_rng(0)
+    results = {}
+    for case in CASES:
+        if pattern and pattern not in case.__name__:
+            continue
+        for name, times in case(shapes, repeat, rng):
+            results[name] = summary(times)
+            print_row(name, results[name])
+    return results
+
+def print_row(name, result, base=None):
+    row = f'{name:<44}{result["p50_ms"]:>10.2f}{result["p90_ms"]:>10.2f}'\
+          f'{result["p99_ms"]:>10.2f}{result["per_s"]:>10.1f}'
+    if base is not None:
+        row += f'{base["p50_ms"]:>10.2f}{result["p50_ms"]/base["p50_ms"]:>8.2f}x'
+    print(row)
+
+def compare(results, baseline, tolerance):
+    """
+    Print results next to the baseline; Returns names of regressed cases
+    """
+    print(f'\n{"case":<44}{"p50(ms)":>10}{"p90(ms)":>10}{"p99(ms)":>10}'
+          f'{"per sec":>10}{"base p50":>10}{"ratio":>9}')
+    regressed = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        print_row(name, result, base)
+        if base is not None and \
+            result['p50_ms'] > base['p50_ms'] * (1 + tolerance) and \
+            result['p50_ms'] > base['p50_ms'] + MIN_SLOWDOWN_MS:
+            regressed.append(name)
+    return regressed
+
+def environment():
+    return {'python':platform.python_version(), 'numpy':np.__version__,
+            'machine':platform.machine(), 'system':platform.system(),
+            'processor':platform.processor()}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--baseline', default=BASELINE,
+                        help='Baseline JSON file')
+    parser.add_argument('--save', action='store_true',
+                        help='Store results as the new baseline')
+    parser.add_argument('--quick', action='store_true',
+                        help='Only the working resolution, fewer calls')
+    parser.add_argument('-k', dest='pattern', default=None,
+                        help='Only cases whose name contains this')
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='Timed calls of each case')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE,
+                        help='Allowed slowdown of the median, e.g. 0.25')
+    args = parser.parse_args()
+    shapes = [(1200, 900, 3)] if args.quick else \
+             [(w, h, 3) for w, h in RESOLUTIONS]
+    repeat = min(args.repeat, 5) if args.quick else args.repeat
+    results = run(shapes, repeat, args.pattern)
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            json.dump({'environment':environment(), 'results':results},
+                      f, indent=1, sort_keys=True)
+        print(f'Saved {len(results)} cases to {args.baseline}')
+        sys.exit(0)
+    if not os.path.exists(args.baseline):
+        print(f'No baseline at {args.baseline}; run with --save first')
+        sys.exit(1)
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline.get('environment') != environment():
+        print('Baseline was measured in another environment:',
+              baseline.get('environment'))
+    regressed = compare(results, baseline['results'], args.tolerance)
+    # A case without a baseline is never checked; Save a new one with it
+    missing = [name for name in results if name not in baseline['results']]
+    if missing:
+        print(f'\n{len(missing)} not in the baseline; run with --save:')
+        for name in missing:
+            print(f'  {name}')
+    if regressed:
+        print(f'\n{len(regressed)} regressed by more than '
+              f'{args.tolerance:.0%}:')
+        for name in regressed:
+            print(f'  {name}')
+    if missing or regressed:
+        sys.exit(1)
+    print('\nNo regression')
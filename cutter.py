@@ -1,22 +1,84 @@
-from sources.console import Console
-from sources.viewer import Viewer
-from sources.engine import Engine
 from multiprocessing import Queue, set_start_method, freeze_support
 from sources.common.constants import *
+import argparse
 
 if __name__ == '__main__':
     set_start_method('spawn')
     freeze_support()
+    from sources.pyramid import parse_size
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tiled', action='store_true',
+                        help='predict AI mask on overlapping tiles '\
+                             'instead of the whole image resized')
+    parser.add_argument('--tile-size', type=int, default=DEFAULT_TILE_SIZE)
+    parser.add_argument('--tile-overlap', type=int,
+                        default=DEFAULT_TILE_OVERLAP)
+    parser.add_argument('--tile-scale', type=float,
+                        default=DEFAULT_TILE_SCALE,
+                        help='scale of the image before cutting tiles')
+    parser.add_argument('--prob-cache', default=PROB_CACHE_DIR,
+                        help='directory to cache AI masks')
+    parser.add_argument('--no-prob-cache', action='store_true',
+                        help='always run the model, even for known images')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help='number of tiles given to the model at once')
+    parser.add_argument('--history-mb', type=int,
+                        default=HISTORY_MAX_BYTES // 2**20,
+                        help='memory for undo, in megabytes')
+    parser.add_argument('--work-size', type=parse_size,
+                        default=WORK_SIZE, metavar='WIDTHxHEIGHT',
+                        help='size images are worked on at, keeping '\
+                             'aspect ratio, or "native" (default '\
+                             f'{WORK_SIZE[0]}x{WORK_SIZE[1]})')
+    parser.add_argument('--profile', action='store_true',
+                        help='print where time went in each process at exit')
+    parser.add_argument('--trace', metavar='DIR', default=None,
+                        help='also write a trace file of each process '\
+                             'to DIR (implies --profile)')
+    args = parser.parse_args()
+    # TilePlan would only raise it later, in the Engine or a batch
+    if not 0 <= args.tile_overlap < args.tile_size:
+        parser.error('--tile-overlap should be at least 0, '\
+                     'and smaller than --tile-size')
+    # Imported only here: spawned processes import this module again,
+    # and each of them should only import what it needs
+    from sources.console import Console
+    from sources.viewer import Viewer
+    from sources.engine import Engine
+    predictor_options = {
+        'batch_size' : args.batch_size,
+        'tiled' : args.tiled,
+        'tile_size' : args.tile_size,
+        'tile_overlap' : args.tile_overlap,
+        'tile_scale' : args.tile_scale,
+        'cache_dir' : None if args.no_prob_cache else args.prob_cache,
+    }
+    profile_options = {
+        'enabled' : args.profile,
+        'trace_dir' : args.trace,
+    }
     imgQ = Queue()
-    evntQ = Queue()
     etcQ = Queue()
     termQ =Queue()
     to_ConsoleQ = Queue()
     to_EngineQ = Queue()
-    console_test = Console(to_ConsoleQ, to_EngineQ, termQ)
-    viewer_test = Viewer(720, 300, evntQ, imgQ, etcQ, termQ)
-    engine_test = Engine(to_EngineQ, to_ConsoleQ, imgQ, evntQ, etcQ)
+    console_test = Console(to_ConsoleQ, to_EngineQ, termQ, profile_options)
+    # Engine sleeps on one queue, for both Console and Viewer
+    viewer_test = Viewer(720, 300, to_EngineQ, imgQ, etcQ, termQ,
+                         profile_options=profile_options)
+    engine_test = Engine(to_EngineQ, to_ConsoleQ, imgQ, etcQ,
+                         predictor_options, args.history_mb * 2**20,
+                         profile_options, args.work_size)
     viewer_test.start()
     console_test.start()
     engine_test.start()
-    termQ.get()
\ No newline at end of file
+    termQ.get()
+    # Let every process report, and Engine finish writing saved images,
+    # before they are killed with this process
+    from sources.inbox import Inbox
+    Inbox(to_EngineQ).put({TERMINATE:None})
+    to_ConsoleQ.put({TERMINATE:None})
+    etcQ.put({TERMINATE:None})
+    engine_test.join(ENGINE_EXIT_TIMEOUT)
+    console_test.join(1)
+    viewer_test.join(1)
@@ -0,0 +1,117 @@
+import os
+import csv
+import time
+import numpy as np
+from .common.constants import *
+from .engine import Engine, read_image
+
+class BatchCutter():
+    """
+    Headless version of the whole pipeline:
+    load image -> AI mask -> threshold -> measure every connected cell
+
+    No pygame or Tk is needed; Engine is used without starting its process.
+    """
+    def __init__(self, ratio:float=DEFAULT_MASK_RATIO,
+                 mp_pixel:float=DEFAULT_MP_PIXEL,
+                 mp_micro:float=DEFAULT_MP_MICRO,
+                 min_pixels:int=MIN_CELL_PIXELS, keep_border:bool=False,
+                 batch_size:int=DEFAULT_BATCH_SIZE,
+                 predictor_options:dict=None,
+                 work_size:tuple=WORK_SIZE):
+        """
+        Arguments:
+        ratio : Threshold of cell probability in percent (0~100)
+        mp_pixel, mp_micro : mp_pixel pixels of the original image are
+                             mp_micro micrometers long
+        min_pixels : Smaller cells are considered as noise
+        keep_border : If False, cells touching the border of the image
+                      are not measured because they are not complete
+        batch_size : Number of images given to the model at once
+        predictor_options : Other keyword arguments of Predictor
+        work_size : (Width, Height) images are measured at;
+                    None for native resolution
+        """
+        self._ratio = ratio
+        self._min_pixels = min_pixels
+        self._keep_border = keep_border
+        self._batch_size = batch_size
+        self._work_size = work_size
+        predictor_options = dict(predictor_options or {},
+                                 batch_size=batch_size)
+        self._engine = Engine(None, None, None, None,
+                              predictor_options)
+        self._engine.set_calibration(mp_pixel, mp_micro)
+        self._engine.load_model()
+
+    def measure(self, image:np.array, prob_mask:np.array,
+                native_scale:tuple=(1.0, 1.0)):
+        """
+        Returns list of (pixel count, area, bounding box) of cells in image
+
+        native_scale : Original pixels per pixel of image, along each axis
+        """
+        self._engine.image = image
+        self._engine.native_scale = native_scale
+        self._engine.reset()
+        self._engine.set_prob_mask(prob_mask, self._ratio)
+        width, height = self._engine.shape[:2]
+        cells = []
+        for count, area, box in self._engine.measure_cells():
+            if count < self._min_pixels:
+                continue
+            rows, cols = box
+            if not self._keep_border and (rows.start == 0 or cols.start == 0
+                    or rows.stop == width or cols.stop == height):
+                continue
+            cells.append((count, area, box))
+        return cells
+
+    def run(self, image_folder:str, result_path:str):
+        """
+        Measure every image under image_folder and stream
+        one row per cell to result_path (csv)
+        """
+        paths = list_images(image_folder)
+        start = time.perf_counter()
+        with open(result_path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['image', 'cell', 'pixels', 'area',
+                             'x0', 'y0', 'x1', 'y1'])
+            for i in range(0, len(paths), self._batch_size):
+                t = time.perf_counter()
+                batch_paths = paths[i:i+self._batch_size]
+                pyramids = [read_image(path, self._work_size)
+                            for path in batch_paths]
+                prob_masks = self._engine.predictor.predict_batch(
+                    [pyramid.work for pyramid in pyramids])
+                for path, pyramid, prob_mask in zip(batch_paths, pyramids,
+                                                    prob_masks):
+                    cells = self.measure(pyramid.work, prob_mask,
+                                         pyramid.scale)
+                    image_name = os.path.relpath(path, image_folder)
+                    for n, (count, area, (rows, cols)) in enumerate(cells):
+                        writer.writerow([image_name, n, count, area,
+                                         rows.start, cols.start,
+                                         rows.stop, cols.stop])
+                    print(f'{image_name}: {len(cells)} cells')
+                f.flush()
+                print(f'[{i+len(batch_paths)}/{len(paths)}] '
+                      f'{time.perf_counter()-t:.2f}s')
+        elapsed = time.perf_counter() - start
+        if len(paths) > 0:
+            print(f'{len(paths)} images in {elapsed:.1f}s'
+                  f' ({len(paths)/elapsed:.2f} images/s)')
+
+
+def list_images(image_folder:str):
+    """
+    All images under image_folder, except those saved by Adipose Cutter
+    """
+    paths = []
+    for root, dirs, files in os.walk(image_folder):
+        dirs[:] = sorted(d for d in dirs if d != 'save')
+        for f in sorted(files):
+            if f.lower().endswith(IMAGE_FORMATS):
+                paths.append(os.path.join(root, f))
+    return paths
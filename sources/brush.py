@@ -0,0 +1,67 @@
+import numpy as np
+
+def stroke(layer:np.array, points:list, radius:float):
+    """
+    Draw a thick polyline with round ends (capsules) on a bool layer.
+
+    Arguments:
+    layer : (Width, Height) or (Width, Height, 1) bool array
+    points : sequence of (x, y); A single point draws a dot
+    radius : Half of the brush width in pixels
+
+    Returns the bounding box (slice, slice) of the stroke, clipped to the
+    layer, or None if nothing of it is inside the layer.
+    """
+    if layer.ndim == 3:
+        layer = layer[...,0]
+    p = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    if len(p) == 1:
+        p = np.concatenate([p, p])
+    box = None
+    for a, b in zip(p[:-1], p[1:]):
+        seg_box = _segment_box(a, b, radius, layer.shape)
+        if seg_box is None:
+            continue
+        layer[seg_box] |= _capsule(a, b, radius, seg_box)
+        box = seg_box if box is None else union(box, seg_box)
+    return box
+
+def stroke_box(points:list, radius:float, shape:tuple):
+    """
+    Bounding box (slice, slice) that stroke() would draw in, on a layer of
+    shape (Width, Height), or None if it is all outside
+    """
+    p = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    return _segment_box(p.min(axis=0), p.max(axis=0), radius, shape[:2])
+
+def _capsule(a, b, radius, box):
+    """
+    Bool array of the box; True where the distance to segment ab <= radius
+    """
+    x = np.arange(box[0].start, box[0].stop, dtype=np.float64)[:,None]
+    y = np.arange(box[1].start, box[1].stop, dtype=np.float64)[None,:]
+    d = b - a
+    length2 = d @ d
+    qx, qy = x - a[0], y - a[1]
+    if length2 > 0:
+        # Position of the nearest point on the segment, 0 at a and 1 at b
+        t = np.clip((qx*d[0] + qy*d[1]) / length2, 0, 1)
+        qx = qx - t*d[0]
+        qy = qy - t*d[1]
+    return qx*qx + qy*qy <= radius*radius
+
+def _segment_box(a, b, radius, shape):
+    lo = np.floor(np.minimum(a, b) - radius).astype(int)
+    hi = np.floor(np.maximum(a, b) + radius).astype(int) + 1
+    lo = np.maximum(lo, 0)
+    hi = np.minimum(hi, shape)
+    if np.any(hi <= lo):
+        return None
+    return (slice(int(lo[0]), int(hi[0])), slice(int(lo[1]), int(hi[1])))
+
+def union(a:tuple, b:tuple):
+    """
+    Smallest (slice, slice) that covers both boxes
+    """
+    return tuple(slice(min(s.start, t.start), max(s.stop, t.stop))
+                 for s, t in zip(a, b))
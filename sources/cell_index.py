@@ -0,0 +1,120 @@
+import numpy as np
+from scipy import ndimage
+
+class CellIndex():
+    """
+    Connected component labels of cell pixels.
+
+    Components are 4-connected, the same as the scanline fill.
+    Label 0 means the pixel is not a cell.
+    """
+    def __init__(self):
+        self.invalidate()
+
+    @property
+    def valid(self):
+        return self._labels is not None
+
+    def invalidate(self):
+        self._labels = None
+        self._counts = None
+        self._boxes = None
+
+    @property
+    def _slices(self):
+        # Bounding boxes are only found when first needed;
+        # Counting cells does not need them
+        if self._boxes is None:
+            self._boxes = [None] + ndimage.find_objects(
+                self._labels, max_label=len(self._counts)-1)
+        return self._boxes
+
+    def build(self, cell:np.array):
+        """
+        Label every component
+
+        Arguments:
+        cell : (Width, Height) bool array
+        """
+        self._labels, n = ndimage.label(cell)
+        self._counts = np.bincount(self._labels.ravel(), minlength=n+1)
+        self._counts[0] = 0
+        self._boxes = None
+
+    def update(self, cell:np.array, region:tuple):
+        """
+        Relabel only around a region where cell pixels changed.
+        If the index is not built, nothing happens.
+
+        Arguments:
+        cell : (Width, Height) bool array after the change
+        region : (slice, slice) containing every changed pixel
+        """
+        if not self.valid:
+            return
+        # Components touching the region may merge or split.
+        # Grow the region until it holds every such component completely.
+        area = _grow(region, 1, cell.shape)
+        while True:
+            old = np.unique(self._labels[area])
+            old = old[old>0]
+            new_area = area
+            for label in old:
+                new_area = _union(new_area, self._slices[label])
+            if new_area == area:
+                break
+            area = new_area
+        sub_labels, n = ndimage.label(cell[area])
+        offset = len(self._slices) - 1
+        self._labels[area] = np.where(sub_labels>0, sub_labels+offset, 0)
+        self._counts[old] = 0
+        for label in old:
+            self._slices[label] = None
+        sub_counts = np.bincount(sub_labels.ravel(), minlength=n+1)[1:]
+        self._counts = np.concatenate([self._counts, sub_counts])
+        for s in ndimage.find_objects(sub_labels):
+            self._slices.append(tuple(
+                slice(a.start+b.start, a.stop+b.start) for a, b in zip(s, area)
+            ))
+
+    def label_at(self, pos:tuple):
+        """
+        Returns label of the component at pos (0 if not a cell)
+        """
+        x, y = pos
+        return int(self._labels[x, y])
+
+    def count(self, label:int):
+        """
+        Number of pixels in the component
+        """
+        return int(self._counts[label])
+
+    def component(self, label:int):
+        """
+        Returns (bounding box as (slice, slice), bool array of the box)
+        """
+        box = self._slices[label]
+        return box, self._labels[box] == label
+
+    def sizes(self):
+        """
+        Pixel counts of every component
+        """
+        return self._counts[self._counts > 0]
+
+    def components(self):
+        """
+        Yields (label, pixel count, bounding box) of every component
+        """
+        for label in np.flatnonzero(self._counts):
+            yield int(label), int(self._counts[label]), self._slices[label]
+
+
+def _grow(box, margin, shape):
+    return tuple(slice(max(0, s.start-margin), min(l, s.stop+margin))
+                 for s, l in zip(box, shape))
+
+def _union(a, b):
+    return tuple(slice(min(s.start, t.start), max(s.stop, t.stop))
+                 for s, t in zip(a, b))
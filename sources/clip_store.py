@@ -0,0 +1,213 @@
+import os
+import json
+import zlib
+import tempfile
+import threading
+import numpy as np
+from collections import OrderedDict
+from .common.constants import *
+from .packed import PackedMask, PackedLabels
+
+_MAGIC = b'CLIP'
+
+class ClipStore():
+    """
+    Confirmed clips (image crop and label mask) of one image, appended to
+    one file as soon as they are confirmed; Only the last few that were
+    read are kept in memory.
+
+    A clip is known by its id, the offset of its record in the file.
+    Records are never changed, so ids stay valid until compact().
+    A record cut short by a crash, or damaged, is dropped with everything
+    after it when the file is opened.
+
+    Safe to read from other threads, e.g. SavePool workers.
+    """
+    def __init__(self, path:str, cache_clips:int=CLIP_CACHE_CLIPS):
+        """
+        Arguments:
+        path : File of the store; Created if it does not exist.
+               None for a temporary file, deleted when closed
+        cache_clips : Number of decoded clips kept in memory
+        """
+        self.path = path
+        self._cache_clips = cache_clips
+        # {id : (image, PackedLabels)}, least recently used first
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        if path is None:
+            self._file = tempfile.TemporaryFile()
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self._file = open(path, 'a+b')
+        # {id : (header, offset of the data)}
+        self._index = {}
+        self._scan()
+
+    def _scan(self):
+        f = self._file
+        size = f.seek(0, os.SEEK_END)
+        offset = 0
+        while offset < size:
+            f.seek(offset)
+            head = f.read(8)
+            if len(head) < 8 or head[:4] != _MAGIC:
+                break
+            length = int(np.frombuffer(head[4:], dtype=np.uint32)[0])
+            try:
+                header = json.loads(f.read(length))
+                end = offset + 8 + length + int(header['nbytes'])
+            except (ValueError, KeyError, TypeError):
+                break
+            if end > size:
+                break
+            self._index[offset] = (header, offset + 8 + length)
+            offset = end
+        if offset < size:
+            f.truncate(offset)
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, clip_id:int):
+        return clip_id in self._index
+
+    def append(self, image:np.array, mask:PackedLabels):
+        """
+        Write a clip, and make sure it is on disk; Returns its id
+
+        Arguments:
+        image : (Width, Height, 3) uint8 crop
+        mask : PackedLabels of the clip
+        """
+        image = np.ascontiguousarray(image, dtype=np.uint8)
+        chunks = [zlib.compress(image.tobytes(), 1)]
+        planes = {}
+        for label, plane in mask.planes.items():
+            chunks.append(zlib.compress(plane.bits.tobytes(), 1))
+            planes[str(label)] = len(chunks[-1])
+        header = {'image_shape':list(image.shape),
+                  'image_nbytes':len(chunks[0]),
+                  'mask_shape':list(mask.shape), 'planes':planes,
+                  'nbytes':sum(len(chunk) for chunk in chunks)}
+        header_bytes = json.dumps(header).encode()
+        with self._lock:
+            f = self._file
+            clip_id = f.seek(0, os.SEEK_END)
+            f.write(_MAGIC + np.uint32(len(header_bytes)).tobytes())
+            f.write(header_bytes)
+            for chunk in chunks:
+                f.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+            self._index[clip_id] = (header, clip_id + 8 + len(header_bytes))
+            self._keep(clip_id, (image, mask))
+        return clip_id
+
+    def get(self, clip_id:int):
+        """
+        Returns (image, PackedLabels) of a clip
+        """
+        with self._lock:
+            clip = self._cache.get(clip_id)
+            if clip is not None:
+                self._cache.move_to_end(clip_id)
+                return clip
+            header, offset = self._index[clip_id]
+            self._file.seek(offset)
+            data = self._file.read(header['nbytes'])
+            clip = _decode(header, data)
+            self._keep(clip_id, clip)
+            return clip
+
+    def image(self, clip_id:int):
+        """
+        Image crop of a clip, read only when np.asarray() is called on it
+        """
+        return _Stored(self, clip_id, 0)
+
+    def mask(self, clip_id:int):
+        """
+        PackedLabels of a clip, read only when np.asarray() is called on it
+        """
+        return _Stored(self, clip_id, 1)
+
+    def _keep(self, clip_id, clip):
+        self._cache[clip_id] = clip
+        self._cache.move_to_end(clip_id)
+        while len(self._cache) > self._cache_clips:
+            self._cache.popitem(last=False)
+
+    def compact(self, keep:list):
+        """
+        Rewrite the file with only the clips of ids in keep
+
+        Returns list of new ids, in the order of keep
+        """
+        if self.path is None:
+            return list(keep)
+        with self._lock:
+            records = []
+            for clip_id in keep:
+                header, offset = self._index[clip_id]
+                start = offset - clip_id
+                self._file.seek(clip_id)
+                records.append(self._file.read(start + header['nbytes']))
+            folder = os.path.dirname(self.path)
+            fd, tmp_path = tempfile.mkstemp(dir=folder, suffix='.tmp')
+            new_ids = []
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    for record in records:
+                        new_ids.append(f.tell())
+                        f.write(record)
+                    f.flush()
+                    os.fsync(f.fileno())
+                self._file.close()
+                os.replace(tmp_path, self.path)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+            finally:
+                if self._file.closed:
+                    self._file = open(self.path, 'a+b')
+            self._cache.clear()
+            self._index = {}
+            self._scan()
+        return new_ids
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+            self._cache.clear()
+
+
+class _Stored():
+    """
+    One part of a stored clip, for np.asarray()
+    """
+    def __init__(self, store, clip_id, part):
+        self._store = store
+        self._id = clip_id
+        self._part = part
+
+    def __array__(self, dtype=None, copy=None):
+        array = np.asarray(self._store.get(self._id)[self._part])
+        return array if dtype is None else array.astype(dtype)
+
+
+def _decode(header, data):
+    image_nbytes = header['image_nbytes']
+    image = np.frombuffer(zlib.decompress(data[:image_nbytes]),
+                          dtype=np.uint8).reshape(header['image_shape'])
+    shape = tuple(header['mask_shape'])
+    row = int(np.prod(shape[1:]))
+    planes = {}
+    offset = image_nbytes
+    for label, nbytes in header['planes'].items():
+        bits = np.frombuffer(zlib.decompress(data[offset:offset+nbytes]),
+                             dtype=np.uint8).reshape(shape[0], (row+7) // 8)
+        planes[int(label)] = PackedMask.from_bits(shape, bits)
+        offset += nbytes
+    return image, PackedLabels.from_planes(shape, planes)
@@ -1,3 +1,4 @@
+import os
 
 # Engine Constants ############################################################
 MEMBRANE = (0,0,0)
@@ -7,13 +8,64 @@ LINE_START = (255,0,0)
 BOX_START = (255,0,0)
 BOX_COLOR = (255,0,255)
 CURSOR = (255,0,0)
+# Labels of the mask and of layers, one uint8 per pixel;
+# Colors are only looked up in LABEL_COLORS for frames and saved images
+LABEL_MEMBRANE = 0
+LABEL_CELL = 1
+LABEL_COUNT = 2
+# Start points of lines and boxes
+LABEL_START = 3
+LABEL_BOX = 4
+LABEL_COLORS = (MEMBRANE, CELL, COUNT, LINE_START, BOX_COLOR)
+# Cell brush; A dot is as wide as the big cursor (11 pixels)
+BRUSH_RADIUS = 5.5
 
 DEFAULT_MP_RATIO = 0.16259
-DEFAULT_MP_PIXEL = 63
+# In pixels of the original image; 63 at the former fixed 1200x900 of
+# the 1600x1200 slides
+DEFAULT_MP_PIXEL = 84
 DEFAULT_MP_MICRO = 50
 
+# Images are worked on at this size, keeping aspect ratio; None for native
+WORK_SIZE = (1200, 900)
+# Larger images are subsampled by an integer step to fit the Viewer
+DISPLAY_SIZE = (1200, 900)
+
+MASK_MODEL = 'hr_5_3_0'
+MODEL_INPUT_SIZE = (200,200)
+# Number of images or tiles given to the model at once
+DEFAULT_BATCH_SIZE = 8
+# Tiled inference; tile size is in pixels of the scaled image
+DEFAULT_TILE_SIZE = 200
+DEFAULT_TILE_OVERLAP = 32
+DEFAULT_TILE_SCALE = 1.0
+# Probability maps are cached on disk by image content
+PROB_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.adipose_cutter',
+                              'prob_cache')
+PROB_CACHE_MAX_BYTES = 512 * 2**20
+# Threshold of cell probability in percent
+DEFAULT_MASK_RATIO = 30
+# Smaller cells are considered as noise
+MIN_CELL_PIXELS = 100
+# Memory for undo, of each history; Oldest edits are dropped first
+HISTORY_MAX_BYTES = 256 * 2**20
+
 NEWIMAGE = 0
 NEWMASK = 1
+PREFETCH = 2
+# Progress of AI mask in percent, to Console
+MASK_PROGRESS = 3
+# From the mask worker thread to Engine itself, to wake it up
+MASK_DONE = 4
+# Seconds between progress reports while waiting for the AI mask
+MASK_PROGRESS_INTERVAL = 0.1
+# (number of cells, coverage 0~1) at current threshold, to Console
+MASK_STATS = 5
+# From SavePool threads to Engine, when a save is written; Image path
+SAVE_DONE = 6
+
+# Number of images (and their probability maps) kept by Prefetcher
+PREFETCH_CACHE_SIZE = 4
 
 MODE_MASK = 10
 MODE_IMAGE = 11
@@ -47,6 +99,21 @@ FILL_LIST = 303
 FILL_DELETE = 304
 FILL_SAVE = 305
 FILL_MICRO = 306
+FILL_EXPORT = 307
+
+# Results are appended to this database in the 'save' folder of images
+RESULTS_DB_NAME = 'results.sqlite3'
+# Threads that write images of saved clips
+SAVE_WORKERS = 4
+# Seconds to wait for Engine to finish pending saves when quitting
+ENGINE_EXIT_TIMEOUT = 30
+# Work on each image is kept in this folder next to the images,
+# and restored when the image is opened again
+SESSION_FOLDER = 'session'
+# Confirmed clips are read back from the disk; Decoded ones kept in memory
+CLIP_CACHE_CLIPS = 8
+# Spans and samples kept for a trace file of --trace, per process
+TRACE_MAX_EVENTS = 1000000
 
 TERMINATE = -1
 
@@ -69,9 +136,19 @@ CROSS_CURSOR_OFF = 506
 
 MESSAGE_BOX = 601
 
+# Image queue only carries notifications of frames in shared memory
+NEW_FRAME = 701
+FRAME_SLOTS = 3
+# Frames are compared in tiles of this size to find changed rectangles
+DIRTY_TILE = 64
+
 # Use same numbers as pygame.K_* + 1000
 K_Z = 1122
+K_Y = 1121
 K_ENTER = 1013
 
+# Messages from Viewer; Every other message to Engine is from Console
+EVENTS = (MOUSEDOWN, MOUSEUP, MOUSEPOS, MOUSEDOWN_RIGHT, K_Z, K_Y, K_ENTER)
+
 # Console Constants ###########################################################
 IMAGE_FORMATS = ('.jpg', '.png', '.jpeg', '.tif', '.tiff')
\ No newline at end of file
@@ -0,0 +1,133 @@
+import numpy as np
+from .brush import union
+
+class LayerCache():
+    """
+    Flattened result of the committed layers of one layer list.
+
+    The last layer of a list is not committed; it may still be drawn on
+    (e.g. a brush stroke), so Compositor paints it freshly every frame.
+    Layers are compared by identity, so a layer must not be modified
+    after another layer was appended after it.
+    """
+    def __init__(self):
+        self._layers = []
+        self.colors = None
+        self.cover = None
+        # (slice, slice) around every committed layer, None if none
+        self.box = None
+
+    def update(self, layers:list, shape:tuple, palette:np.array=None):
+        """
+        Flatten layers[:-1], reusing what is already flattened
+
+        palette : Colors of labels if shape is of an RGB array,
+                  None to flatten labels
+        """
+        committed = layers[:-1]
+        n = len(self._layers)
+        if self.colors is None or self.colors.shape != shape \
+            or n > len(committed) \
+            or any(a is not b for a, b in zip(self._layers, committed)):
+            # A layer was removed; start over
+            self.colors = np.zeros(shape, dtype=np.uint8)
+            self.cover = np.zeros(shape[:2]+(1,), dtype=bool)
+            self.box = None
+            n = 0
+        for c, m in committed[n:]:
+            m.paint_on(self.colors, c if palette is None else palette[c])
+            m.cover(self.cover)
+            if not m.empty():
+                self.box = m.box if self.box is None else union(self.box, m.box)
+        self._layers = list(committed)
+
+    def __len__(self):
+        return len(self._layers)
+
+
+class Compositor():
+    """
+    Draws layers of (Label, SparseLayer) on a base:
+    A label mask, or an RGB image with colors of labels from a palette.
+    Cost per frame does not depend on how many layers are committed.
+    """
+    def __init__(self):
+        self._caches = {}
+
+    def compose(self, base:np.array, groups:list, out:np.array,
+                palette:np.array=None):
+        """
+        Arguments:
+        base : (Width, Height, 1) uint8 labels, or (Width, Height, 3) image
+        groups : list of (name, list of layers), drawn in order
+        out : preallocated array with the same shape as base
+        palette : (number of labels, 3) uint8 colors; Needed for an image
+
+        Returns out
+        """
+        np.copyto(out, base)
+        for name, layers in groups:
+            if len(layers) == 0:
+                continue
+            cache = self._caches.setdefault(name, LayerCache())
+            cache.update(layers, base.shape, palette)
+            if cache.box is not None:
+                box = cache.box
+                np.copyto(out[box], cache.colors[box], where=cache.cover[box])
+            c, m = layers[-1]
+            m.paint_on(out, c if palette is None else palette[c])
+        return out
+
+    def clear(self):
+        self._caches = {}
+
+
+def paint(array:np.array, color:tuple, mask:np.array):
+    """
+    Same as array*(~mask) + mask*color, without temporary arrays
+    """
+    np.copyto(array, np.asarray(color, dtype=np.uint8), where=mask)
+
+def colorize(labels:np.array, palette:np.array, out:np.array=None):
+    """
+    (Width, Height, 3) colors of (Width, Height, 1) labels
+    """
+    if len(palette) < 256:
+        # Every uint8 is then a valid index, so bounds need no checking
+        table = np.zeros((256, palette.shape[1]), dtype=palette.dtype)
+        table[:len(palette)] = palette
+        palette = table
+    return np.take(palette, labels[...,0], axis=0, out=out, mode='wrap')
+
+def changed_rects(old:np.array, new:np.array, tile:int=64):
+    """
+    Rectangles of tiles where two frames differ
+
+    Arguments:
+    old, new : (Width, Height, 3) arrays of the same shape
+    tile : Size of the tiles that are compared
+
+    Returns list of (x, y, width, height); Changed tiles next to each other
+    in a row are merged into one rectangle.
+    """
+    width, height = new.shape[:2]
+    # Rows of bytes; Reducing over whole rows first is much faster
+    # than reducing over the small color axis
+    changed = old.reshape(width, -1) != new.reshape(width, -1)
+    n = width // tile
+    cols = changed[:n*tile].reshape(n, tile, -1).any(axis=1)
+    if n*tile < width:
+        cols = np.concatenate([cols, changed[n*tile:].any(axis=0)[None]])
+    ys = np.arange(0, height, tile)
+    tiles = np.logical_or.reduceat(cols, ys*(changed.shape[1]//height),
+                                   axis=1)
+    rects = []
+    for j, y in enumerate(ys):
+        h = min(tile, height - y)
+        row = np.concatenate([[False], tiles[:,j], [False]])
+        edges = np.flatnonzero(row[1:] != row[:-1])
+        for start, stop in zip(edges[::2], edges[1::2]):
+            x = start * tile
+            w = min(stop * tile, width) - x
+            rects.append((int(x), int(y), int(w), int(h)))
+    return rects
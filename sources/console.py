@@ -5,7 +5,10 @@ from functools import partial
 from PIL import ImageTk, Image
 from multiprocessing import Process, Queue
 from .common.constants import *
+from .inbox import Inbox
+from .profiler import Profiler, timed, message_name
 import os
+import time
 from tkinter import filedialog, messagebox
 
 class Console(Process):
@@ -13,15 +16,19 @@ class Console(Process):
     Console
     All the commands called by buttons, etc. are in console_f.py
     """
-    def __init__(self, to_ConsoleQ:Queue, to_EngineQ:Queue, termQ:Queue):
+    def __init__(self, to_ConsoleQ:Queue, to_EngineQ:Queue, termQ:Queue,
+                 profile_options:dict=None):
         """
         Tk objects are not pickleable
         Initiate all windows when start()
+
+        profile_options : Keyword arguments of Profiler; Disabled if None
         """
         super().__init__(daemon=True)
         self._to_ConsoleQ = to_ConsoleQ
         self._to_EngineQ = to_EngineQ
         self._termQ = termQ
+        self._profile_options = profile_options or {}
         self._image_name_list=[]
 
     def initiate(self):
@@ -84,11 +91,16 @@ class Console(Process):
                                           command=partial(button_set_new_mask_f,
                                           q=self._to_EngineQ))
         self.button_set_new_mask.grid(column=0, row=2, sticky=(tk.W))
-        self.ratio = tk.DoubleVar()
+        self._mask_progress_var = tk.StringVar(value='')
+        self.label_mask_progress = ttk.Label(self.frame_threshold,
+                                        textvariable=self._mask_progress_var)
+        self.label_mask_progress.grid(column=1, row=2, sticky=(tk.W))
+        self.ratio = tk.DoubleVar(value=DEFAULT_MASK_RATIO)
         self.scale_ratio = ttk.Scale(self.frame_threshold,
                                      from_=0, to=100, length=100,
-                                     variable=self.ratio)
-        self.scale_ratio.set(50)
+                                     variable=self.ratio,
+                                     command=partial(scale_ratio_f,
+                                     q=self._to_EngineQ))
         self.scale_ratio.grid(column=0, row=3)
         self.button_ratio = ttk.Button(self.frame_threshold,
                                        text='Set',
@@ -100,6 +112,10 @@ class Console(Process):
                                          command=partial(button_confirm_f,
                                          q=self._to_EngineQ))
         self.button_confirm.grid(column=0, row=4)
+        self._mask_stats_var = tk.StringVar(value='')
+        self.label_mask_stats = ttk.Label(self.frame_threshold,
+                                          textvariable=self._mask_stats_var)
+        self.label_mask_stats.grid(column=1, row=4, sticky=(tk.W))
 
         # Configure Top-Middle show/hide mask menu ############################
         self.frame_mask = ttk.Frame(self.root, padding='5 5 5 5')
@@ -217,6 +233,9 @@ class Console(Process):
         self.button_save = ttk.Button(self.frame_save, text='Save',
                                       command=self.button_save_f)
         self.button_save.grid(column=2, row=1, sticky=(tk.E, tk.S))
+        self.button_export = ttk.Button(self.frame_save, text='Export',
+                                        command=self.button_export_f)
+        self.button_export.grid(column=2, row=2, sticky=(tk.E, tk.S))
 
         # Set weights of frames ###############################################
         self.root.columnconfigure(0, weight=1)
@@ -249,16 +268,23 @@ class Console(Process):
             self.button_next,
             self.button_open,
             self.button_save,
+            self.button_export,
             self.button_delete,
         ]
         # Switch to normal mode state
         self.normal_mode_buttons()
 
     def run(self):
+        self._profiler = Profiler('Console', **self._profile_options)
+        self._to_EngineQ = Inbox(timed(self._to_EngineQ, self._profiler,
+                                       'engine'))
+        self._to_ConsoleQ = timed(self._to_ConsoleQ, self._profiler,
+                                  'console')
         self.initiate()
         self.button_open_f(ask=False)
         self.root.after(16, self.update)
         self.root.mainloop()
+        self._profiler.close()
         self._termQ.put(TERMINATE)
 
 
@@ -335,35 +361,34 @@ class Console(Process):
             for f in os.listdir(self._image_folder):
                 if f.endswith(IMAGE_FORMATS):
                     self._image_name_list.append(f)
-            self._to_EngineQ.put({
-                NEWIMAGE:os.path.join(self._image_folder,
-                        self._image_name_list[self._image_idx])
-            })
-            self._img_name_var.set(self._image_name_list[self._image_idx])
+            self.put_new_image()
+
+    def put_new_image(self):
+        """
+        Send current image to Engine, and let it prefetch the neighbours
+        """
+        n = len(self._image_name_list)
+        self._to_EngineQ.put({NEWIMAGE:self.image_path(self._image_idx)})
+        self._to_EngineQ.put({PREFETCH:[
+            self.image_path((self._image_idx+1)%n),
+            self.image_path((self._image_idx-1)%n),
+        ]})
+        self._img_name_var.set(self._image_name_list[self._image_idx])
+
+    def image_path(self, idx:int):
+        return os.path.join(self._image_folder, self._image_name_list[idx])
 
     def button_next_f(self):
-        answer = messagebox.askyesno(message='All unsaved values will disappear.\
-            \nContinue?')
-        if answer:
-            if len(self._image_name_list) > 0 :
-                self._image_idx = (self._image_idx+1)%len(self._image_name_list)
-                self._to_EngineQ.put({
-                    NEWIMAGE:os.path.join(self._image_folder,
-                            self._image_name_list[self._image_idx])
-                })
-                self._img_name_var.set(self._image_name_list[self._image_idx])
+        # Engine keeps the work on the image, and restores it when it is back
+        if len(self._image_name_list) > 0 :
+            self._image_idx = (self._image_idx+1)%len(self._image_name_list)
+            self.put_new_image()
 
     def button_prev_f(self):
-        answer = messagebox.askyesno(message='All unsaved values will disappear.\
-            \nContinue?')
-        if answer:
-            if len(self._image_name_list) > 0 :
-                self._image_idx = (self._image_idx-1)%len(self._image_name_list)
-                self._to_EngineQ.put({
-                    NEWIMAGE:os.path.join(self._image_folder,
-                            self._image_name_list[self._image_idx])
-                })
-                self._img_name_var.set(self._image_name_list[self._image_idx])
+        # Engine keeps the work on the image, and restores it when it is back
+        if len(self._image_name_list) > 0 :
+            self._image_idx = (self._image_idx-1)%len(self._image_name_list)
+            self.put_new_image()
 
     def button_draw_cancel_f(self):
         answer = messagebox.askyesno(message='This will delete all unapplied drawings.\
@@ -377,14 +402,19 @@ class Console(Process):
             self._to_EngineQ.put({FILL_DELETE:self.list_save.curselection()})
 
     def button_save_f(self):
-        save_dir = filedialog.askopenfilename(title='Select Excel File',
-                    filetypes=[('Excel files','*.xlsx')])
-        if save_dir == '':
+        self._to_EngineQ.put({FILL_SAVE:(
+                              self._image_name_list[self._image_idx],
+                              self._image_folder)})
+
+    def button_export_f(self):
+        export_dir = filedialog.asksaveasfilename(title='Export Results',
+                    defaultextension='.xlsx',
+                    filetypes=[('Excel files','*.xlsx'), ('CSV files','*.csv')])
+        if export_dir == '':
             pass
         else:
-            self._to_EngineQ.put({FILL_SAVE:(save_dir, 
-                                self._image_name_list[self._image_idx],
-                                self._image_folder)})
+            self._to_EngineQ.put({FILL_EXPORT:(export_dir,
+                                               self._image_folder)})
 
     def spinbox_fill_micro_change(self, *args):
         val = self._micro_var.get()
@@ -407,15 +437,20 @@ class Console(Process):
         if not self._to_ConsoleQ.empty():
             q = self._to_ConsoleQ.get()
             for k,v in q.items():
+                start = time.time()
+                if k == TERMINATE:
+                    # Viewer was closed
+                    self.root.destroy()
+                    return
                 # if k == SET_MEM:
                 #     self.mem_color = tuple(v)
                 # elif k == SET_CELL:
                 #     self.cell_color = tuple(v)
                 if k == MODE_DRAW_MEM:
-                    self._draw_mode_var.set('Draw membrane\nUndo:z\nStop:'\
+                    self._draw_mode_var.set('Draw membrane\nUndo:z, Redo:y\nStop:'\
                                 'Right click\nPress Apply(Enter) when finished')
                 elif k == MODE_DRAW_CELL:
-                    self._draw_mode_var.set('Erase membrane\nUndo:z'
+                    self._draw_mode_var.set('Erase membrane\nUndo:z, Redo:y'
                         '\nPress Apply(Enter) when finished\n*Recommend applying every time')
                 elif k == MODE_NONE:
                     self._draw_mode_var.set(self._default_draw_mode_str)
@@ -423,8 +458,9 @@ class Console(Process):
                     self.clip_mode_buttons()
                 elif k == MODE_CANCEL_CLIP:
                     self.normal_mode_buttons()
+                    self._mask_stats_var.set('')
                 elif k == MODE_FILL_CELL:
-                    self._draw_mode_var.set('Click to fill a cell')
+                    self._draw_mode_var.set('Click to fill a cell\nUndo:z, Redo:y')
                 elif k == MODE_FILL_MP_RATIO:
                     self._draw_mode_var.set('Set micrometer to pixel ratio')
                 elif k == FILL_MP_RATIO:
@@ -433,4 +469,13 @@ class Console(Process):
                     self.list_items = v
                 elif k == MESSAGE_BOX:
                     self.message_box(v)
+                elif k == MASK_PROGRESS:
+                    self._mask_progress_var.set('' if v >= 100 else f'{v}%')
+                elif k == MASK_STATS:
+                    count, coverage = v
+                    self._mask_stats_var.set(
+                        f'{count} cells, {coverage*100:.1f}%')
+                # Message boxes count until they are closed
+                self._profiler.record(message_name(k), start,
+                                      time.time() - start)
         self.root.after(16, self.update)
\ No newline at end of file
@@ -19,11 +19,11 @@ def button_set_new_mask_f(q):
     q.put({NEWMASK:None})
 
 def button_ratio_f(ratio, q):
-    print(ratio.get())
-    answer = messagebox.askyesno(message='This will reset your mask.\
-        \nContinue?')
-    if answer:
-        q.put({SET_RATIO:ratio.get()})
+    q.put({SET_RATIO:ratio.get()})
+
+def scale_ratio_f(value, q):
+    # Manual edits are kept, so the mask follows the slider
+    q.put({SET_RATIO:float(value)})
 
 def button_confirm_f(q):
     q.put({MODE_CONFIRM_CLIP:None})
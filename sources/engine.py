@@ -1,17 +1,28 @@
 import numpy as np
 from multiprocessing import Process, Queue
-from PIL import Image
 from .common.constants import *
 from skimage import draw
-from skimage.transform import resize
-from openpyxl import load_workbook
 import os
-import tensorflow as tf
-from tensorflow import keras
-from .model_loader import get_model
-
-# To limit loop rate
-from pygame.time import Clock
+import sqlite3
+import threading
+import time
+from .prefetch import Prefetcher
+from .inbox import Inbox
+from .mask_job import MaskWorker
+from .frame_buffer import FrameBuffer
+from .compositor import Compositor, colorize, changed_rects
+from .cell_index import CellIndex
+from .prob_map import ProbMap
+from .history import History, MaskDelta, FillDelta, SlideDelta
+from .results import ResultStore
+from .save_pool import SavePool
+from .layer import SparseLayer, union_box
+from .packed import PackedMask, PackedLabels
+from .session import Session, session_path, clip_store_path, image_key, \
+                     points_to_list, points_from_list
+from .clip_store import ClipStore
+from .pyramid import Pyramid, display_step
+from .profiler import Profiler, timed, message_name
 
 class Engine(Process):
     """
@@ -19,16 +30,94 @@ class Engine(Process):
     """
     # If the image is not updated, check if self._updated is switched to True
     def __init__(self, to_EngineQ:Queue, to_ConsoleQ:Queue,
-                 imageQ:Queue, eventQ:Queue, etcQ:Queue):
+                 imageQ:Queue, etcQ:Queue,
+                 predictor_options:dict=None,
+                 history_max_bytes:int=HISTORY_MAX_BYTES,
+                 profile_options:dict=None,
+                 work_size:tuple=WORK_SIZE):
+        """
+        to_EngineQ : Messages from both Console and Viewer
+        predictor_options : Keyword arguments of Predictor, e.g. tiling
+        history_max_bytes : Memory for undo of each of the two histories
+        profile_options : Keyword arguments of Profiler; Disabled if None
+        work_size : (Width, Height) images are worked on at;
+                    None for native resolution
+        """
         super().__init__(daemon=True)
+        # Connected cells of the mask, for filling
+        self._cell_index = CellIndex()
+        # Undo & Redo; Edits in current clip, and results of the slide
+        self._clip_history = History(history_max_bytes)
+        self._slide_history = History(history_max_bytes)
         # Initial image and mask
         self.image = np.zeros((300,300,3), dtype=np.uint8)
         # Queues
         self._to_EngineQ = to_EngineQ
         self._to_ConsoleQ = to_ConsoleQ
         self._imageQ = imageQ
-        self._eventQ = eventQ
         self._etcQ = etcQ
+        # Created in run()
+        self._inbox = None
+        self._profile_options = profile_options or {}
+        self._profiler = None
+        # Saved results; Opened for the image folder when saving
+        self._results = None
+        # Writes images of saved clips; Created on first save
+        self._save_pool = None
+        # {image path : number of its saves being written}; Counted down
+        # by SavePool threads
+        self._saving = {}
+        self._saving_lock = threading.Lock()
+        # ClipStores of images that were left while their saves were being
+        # written, by image path; Closed when the saves are done
+        self._closing_stores = {}
+        # Next file number of each image's save folder
+        self._save_numbers = {}
+        self._predictor_options = predictor_options or {}
+        # Mask model; Loaded in a background thread by run()
+        self._predictor = None
+        self._model_loading = None
+        # Loads neighbouring images in background; Created in run()
+        self._prefetcher = None
+        self._image_path = None
+        # Probability maps (ProbMap) of current image, {(path, clip box):map}
+        self._prob_masks = {}
+        # ProbMap the mask is thresholded from, and the threshold in percent
+        self.prob_mask = None
+        self._mask_ratio = DEFAULT_MASK_RATIO
+        # Threshold from the slider, applied once per batch of messages
+        self._pending_ratio = None
+        # Applied manual edits, kept when the threshold changes:
+        # (Width, Height, 1) labels and (Width, Height, 1) bool cover,
+        # and (Width, Height) bool of edited pixels that are LABEL_CELL,
+        # and the bounding box of the edits
+        self._edit_labels = None
+        self._edit_cover = None
+        self._edit_cells = None
+        self._edit_box = None
+        self._clip_box = None
+        # AI mask is computed in background; Worker is created in run()
+        self._mask_worker = None
+        self._mask_job = None
+        # Apply the AI mask as soon as the job is done
+        self._mask_pending = False
+        self._mask_progress = None
+        # Shared memory for frames; Created in run() when the first frame
+        # is sent, because it cannot be pickled to the Engine process
+        self._frame_buffer = None
+        # Previous frame, still in the buffer, to find what changed
+        self._last_frame = None
+        # Frames larger than DISPLAY_SIZE are composed here at full size,
+        # and subsampled by this step; Viewer positions are multiplied by it
+        self._work_frame = None
+        # Labels of the mask frame, composed before colors are looked up
+        self._label_frame = None
+        # Labels of the last frame if it was of the mask, subsampled
+        self._last_labels = None
+        self._palette = np.array(LABEL_COLORS, dtype=np.uint8)
+        self._display_step = 1
+        # Keeps flattened layers, so only changed layers are drawn again
+        self._compositor = Compositor()
         # Modes about sending images to Viewer
         self._mask_mode = False
         self._updated = True
@@ -42,8 +131,14 @@ class Engine(Process):
         self._box_start_pos = None
         # Clipped mode
         self._clipped_mode = False
-        self._clipped_masks = []
-        self._clipped_imgs = []
+        # Confirmed clips are written to a ClipStore of the image at once;
+        # Only their ids are kept here
+        self._clip_store = None
+        self._clips = []
+        # Ids of clips already in the ResultStore; Saving adds only others
+        self._saved_clips = set()
+        # Clip box of each box layer
+        self._clip_boxes = []
         # (Color_of_layer(R,G,B), Bool mask(Width, Height, 1))
         self._layers = []
         self._cell_layers = []
@@ -51,9 +146,16 @@ class Engine(Process):
         self._always_on_layers = []
         self._is_drawing = False
         self._line_start_pos = None
+        # Brush positions not drawn yet, and the last drawn one
+        self._stroke_points = []
+        self._stroke_last = None
         self._show_box = True
         # Modes related to filling
         # Ratio = (micrometer / pixel)**2  -> Because it's area ratio
+        # Calibration is in native pixels; _mp_ratio is per work pixel
+        self.work_size = work_size
+        # Native pixels per work pixel of current image, along each axis
+        self.native_scale = (1.0, 1.0)
         self._mp_ratio = DEFAULT_MP_RATIO
         self._mp_ratio_pixel = DEFAULT_MP_PIXEL
         self._mp_ratio_micrometer = DEFAULT_MP_MICRO
@@ -88,18 +190,27 @@ class Engine(Process):
     @property
     def mask(self):
         """
-        This is the mask on which engine computes
+        This is the mask on which engine computes;
+        (width, height, 1) LABEL_* of each pixel
         """
         return self._mask.copy()
 
     @mask.setter
     def mask(self, mask:np.array):
         """
-        Must be a shape of (width, height, 3) and same as current image
+        Must be a shape of (width, height, 1), with the width and height
+        of current image
         """
-        if mask.shape != self.shape:
+        if mask.shape != self.shape[:2] + (1,):
             raise TypeError('Inappropriate shape of mask')
         self._mask = mask.astype(np.uint8)
+        self._cell_index.invalidate()
+
+    def _cell_pixels(self):
+        """
+        Bool array (Width, Height) of pixels that are LABEL_CELL in the mask
+        """
+        return self._mask[...,0] == LABEL_CELL
 
     @property
     def cell_color(self):
@@ -151,111 +262,588 @@ class Engine(Process):
         self._cell_counts = []
         self._box_layers = []
         self._always_on_layers = []
-        self._clipped_imgs = []
-        self._clipped_masks = []
+        self._clips = []
+        self._saved_clips = set()
+        self._clip_boxes = []
         self._is_drawing = False
         self._line_start_pos = None
         self._box_start_pos = None
         self.mode = None
         self._mask_mode = False
+        self._slide_history.clear()
         self._updated = True
 
     def load_image(self, path:str):
-        #TODO: Resize image?
-        im = Image.open(path).resize((1200,900))
-        self.image = np.asarray(im).swapaxes(0,1)
+        # Work on the last image is kept, to be restored when it is back
+        self._leave_image()
+        if self._clipped_mode:
+            self._clipped_mode = False
+            self._to_ConsoleQ.put({MODE_CANCEL_CLIP:None})
+        cached = None
+        if self._prefetcher is not None:
+            cached = self._prefetcher.get(path)
+        if cached is None:
+            pyramid, prob_mask = read_image(path, self.work_size), None
+            if self._prefetcher is not None:
+                self._prefetcher.put(path, pyramid)
+        else:
+            pyramid, prob_mask = cached
+        self.image = pyramid.work
+        self.native_scale = pyramid.scale
+        self._image_path = path
+        self._prob_masks = {}
+        if prob_mask is not None:
+            if not isinstance(prob_mask, ProbMap):
+                prob_mask = ProbMap(prob_mask)
+            self._prob_masks[(path, None)] = prob_mask
         self.reset()
+        self.restore_session()
+        self._updated = True
+        self.speculate_mask()
+
+    def session(self):
+        """
+        Returns Session of the work on current image: Results of the slide,
+        AI masks, calibration, and the mask, edits and layers of the clip
+        """
+        session = Session()
+        # The start dot of a line being drawn is not kept
+        layers = self._layers[:-1] \
+            if self.mode == MODE_DRAW_MEM and self._is_drawing \
+            else self._layers
+        view = {
+            'clip_box':points_to_list(self._clip_box)
+                       if self._clipped_mode else None,
+            'mask':session.put_labels('mask', PackedLabels(self._mask)),
+            'prob_mask':None if self.prob_mask is None else
+                        session.put('prob_mask', self.prob_mask.levels,
+                                    raw=True),
+            'edits':None if self._edit_cover is None else {
+                'labels':session.put_labels('edits/labels',
+                                            PackedLabels(self._edit_labels)),
+                'cover':session.put_mask('edits/cover',
+                                         PackedMask(self._edit_cover))},
+            'layers':[session.put_layer(f'layers/{i}', layer)
+                      for i, layer in enumerate(layers)],
+            'cell_layers':[session.put_layer(f'cell_layers/{i}', layer)
+                           for i, layer in enumerate(self._cell_layers)],
+            'mask_mode':self._mask_mode,
+        }
+        prob_masks = []
+        for i, ((path, box), prob_mask) in enumerate(self._prob_masks.items()):
+            if path != self._image_path:
+                continue
+            prob_masks.append({
+                'box':None if box is None else points_to_list(box),
+                'levels':session.put(f'prob_masks/{i}', prob_mask.levels,
+                                     raw=True),
+                'histogram':prob_mask.histogram.tolist()})
+        image = self._backup_image if self._clipped_mode else self._image
+        session.state = {
+            'image':self._image_path,
+            'image_key':image_key(image),
+            'shape':list(image.shape),
+            'calibration':[self._mp_ratio_pixel, self._mp_ratio_micrometer],
+            'mask_ratio':self._mask_ratio,
+            'cell_counts':[int(count) for count in self._cell_counts],
+            'clip_boxes':[points_to_list(box) for box in self._clip_boxes],
+            'box_layers':[session.put_layer(f'box_layers/{i}', layer)
+                          for i, layer in enumerate(self._box_layers)],
+            'clips':list(self._clips),
+            'saved_clips':sorted(self._saved_clips),
+            'prob_masks':prob_masks,
+            'view':view,
+        }
+        return session
+
+    def _leave_image(self):
+        """
+        Keep the work on current image, and close its ClipStore.
+        If its saves are still being written, they read from the store;
+        It is then closed by close_stores() when they are done.
+        """
+        saving = self.is_saving(self._image_path)
+        self.save_session(compact=not saving)
+        if self._clip_store is not None:
+            if saving:
+                self._closing_stores[self._image_path] = self._clip_store
+            else:
+                self._clip_store.close()
+            self._clip_store = None
+        self.close_stores()
+
+    def is_saving(self, image_path:str):
+        with self._saving_lock:
+            return image_path in self._saving
+
+    def close_stores(self):
+        """
+        Compact and close ClipStores of left images whose saves are done
+        """
+        for path, store in list(self._closing_stores.items()):
+            if self.is_saving(path):
+                continue
+            del self._closing_stores[path]
+            if path is None:
+                # Temporary store, of clips of no image file
+                store.close()
+                continue
+            try:
+                session = Session.read(session_path(path))
+                state = session.state
+                if len(store) > len(state['clips']):
+                    state['clips'], saved = compact_clips(store,
+                        state['clips'], set(state['saved_clips']))
+                    state['saved_clips'] = sorted(saved)
+                    session.write(session_path(path))
+            except (OSError, ValueError, KeyError) as e:
+                self._to_ConsoleQ.put({MESSAGE_BOX:f'Failed to keep the '\
+                    f'work on {os.path.basename(path)}\n{e}'})
+            store.close()
+
+    def save_session(self, compact:bool=False):
+        """
+        Write the work on current image to its session file, if there is
+        any work, or a session to update
+
+        compact : Also drop deleted clips from the ClipStore; Only when
+                  leaving the image, as the history may still have them
+        """
+        if self._image_path is None:
+            return
+        if compact and self._clip_store is not None and \
+            len(self._clip_store) > len(self._clips):
+            self._clips, self._saved_clips = compact_clips(
+                self._clip_store, self._clips, self._saved_clips)
+        path = session_path(self._image_path)
+        worked = len(self._box_layers) > 0 or len(self._prob_masks) > 0 \
+                 or self.prob_mask is not None or len(self._layers) > 0 \
+                 or self._edit_cover is not None
+        if not worked and not os.path.exists(path):
+            return
+        try:
+            self.session().write(path)
+        except OSError as e:
+            self._to_ConsoleQ.put({MESSAGE_BOX:f'Failed to keep the work on '\
+                f'{os.path.basename(self._image_path)}\n{e}'})
+
+    def restore_session(self):
+        """
+        Restore the work on current image from its session file, if there
+        is one of this image.
+
+        All of the session is read before any of it is kept, so a damaged
+        one leaves the image as it was loaded.
+        """
+        path = session_path(self._image_path)
+        if not os.path.exists(path):
+            return
+        name = os.path.basename(self._image_path)
+        try:
+            session = Session.read(path)
+            state = session.state
+            if state['shape'] != list(self._image.shape) or \
+                state['image_key'] != image_key(self._image):
+                # The image changed since, or its work size did
+                return
+            store = self.clip_store()
+            clips = list(state['clips'])
+            if any(clip_id not in store for clip_id in clips):
+                self._to_ConsoleQ.put({MESSAGE_BOX:f'Failed to restore the '\
+                    f'work on {name}\nClips are missing from {store.path}'})
+                return
+            pixel, micrometer = (float(v) for v in state['calibration'])
+            mask_ratio = float(state['mask_ratio'])
+            prob_masks = {}
+            for entry in state['prob_masks']:
+                box = entry['box']
+                key = (self._image_path,
+                       None if box is None else points_from_list(box))
+                prob_masks[key] = ProbMap(session.get(entry['levels']),
+                    np.asarray(entry['histogram'], dtype=np.int64))
+            cell_counts = [int(count) for count in state['cell_counts']]
+            clip_boxes = [points_from_list(box)
+                          for box in state['clip_boxes']]
+            box_layers = [session.get_layer(ref)
+                          for ref in state['box_layers']]
+            saved_clips = set(state.get('saved_clips', []))
+            view = state['view']
+            clip_box = None
+            image = self._image
+            if view['clip_box'] is not None:
+                clip_box = points_from_list(view['clip_box'])
+                (r0, c0), (r1, c1) = clip_box
+                image = image[r0:r1, c0:c1]
+            prob_mask = None
+            if view['prob_mask'] is not None:
+                prob_mask = ProbMap(session.get(view['prob_mask']))
+            mask = session.get_labels(view['mask']).unpack()
+            if mask.shape != image.shape[:2] + (1,):
+                raise ValueError(f'Mask of {mask.shape} on an image of '\
+                                 f'{image.shape}')
+            edits = None
+            if view['edits'] is not None:
+                edit_labels = session.get_labels(
+                    view['edits']['labels']).unpack()
+                cover = session.get_mask(view['edits']['cover'])
+                edits = (edit_labels, cover.unpack(), cover.bounding_box())
+            layers = [session.get_layer(ref) for ref in view['layers']]
+            cell_layers = [session.get_layer(ref)
+                           for ref in view['cell_layers']]
+            mask_mode = bool(view['mask_mode'])
+        except (OSError, ValueError, KeyError, TypeError, IndexError) as e:
+            self._to_ConsoleQ.put({MESSAGE_BOX:f'Failed to restore the work '\
+                f'on {name}\n{e}'})
+            return
+        self._mp_ratio_pixel, self._mp_ratio_micrometer = pixel, micrometer
+        self._mask_ratio = mask_ratio
+        for key, prob_map in prob_masks.items():
+            self._prob_masks.setdefault(key, prob_map)
+        self._cell_counts = cell_counts
+        self._clip_boxes = clip_boxes
+        self._box_layers = box_layers
+        self._clips = clips
+        self._saved_clips = saved_clips
+        if clip_box is not None:
+            self._clip_box = clip_box
+            self._backup_image = self.image
+            self.image = image
+            self._clipped_mode = True
+            self._to_ConsoleQ.put({MODE_CLIP:None})
+        if prob_mask is not None:
+            self.prob_mask = prob_mask
+        self.mask = mask
+        if edits is not None:
+            self._edit_labels, self._edit_cover, self._edit_box = edits
+            self._edit_cells = self._edit_labels[...,0] == LABEL_CELL
+        self._layers = layers
+        self._cell_layers = cell_layers
+        self._mask_mode = mask_mode
         self._updated = True
 
+    def load_model(self):
+        # TensorFlow is imported here, so that only the Engine process
+        # (not Console, Viewer or the main process) pays for it
+        from .inference import Predictor
+        self._predictor = Predictor(MASK_MODEL, **self._predictor_options)
+
+    @property
+    def predictor(self):
+        """
+        Waits if the model is still being loaded in background
+        """
+        if self._model_loading is not None:
+            self._model_loading.join()
+        return self._predictor
+
+    def predict(self, image:np.array, progress=None):
+        return self.predictor.predict(image, progress)
+
     def set_empty_mask(self):
         """
         Set a new empty mask that is the same shape as current image
         """
-        self.mask = np.zeros_like(self.image)
+        self.mask = np.zeros(self.shape[:2] + (1,), dtype=np.uint8)
+        self.prob_mask = None
+        self._clip_history.clear()
+        self._edit_labels = None
+        self._edit_cover = None
+        self._edit_cells = None
+        self._edit_box = None
         self._updated = True
 
-    def set_new_mask(self):
+    def _mask_target(self):
         """
-        ratio : if ratio * dist_to_memcolor > (1-ratio) * dist_to_cellcolor,
-        the pixel is considered as cell
+        Returns (key, image) to predict for the AI mask of current image.
+        Tiled prediction does not depend on the extent of the image,
+        so the whole image is predicted once and cropped for clips.
+        """
+        if self._predictor_options.get('tiled'):
+            image = self._backup_image if self._clipped_mode else self._image
+            return (self._image_path, None), image
+        box = self._clip_box if self._clipped_mode else None
+        return (self._image_path, box), self._image
+
+    def _known_prob_mask(self):
+        """
+        Probability map of current image, or None if not predicted yet
+        """
+        key, _ = self._mask_target()
+        prob_mask = self._prob_masks.get(key)
+        if prob_mask is not None and self._clipped_mode and key[1] is None:
+            (r0, c0), (r1, c1) = self._clip_box
+            prob_mask = prob_mask[r0:r1, c0:c1]
+        return prob_mask
+
+    def _keep_prob_mask(self, key, image, prob_mask):
+        prob_mask = ProbMap(prob_mask)
+        self._prob_masks[key] = prob_mask
+        if key[1] is None and self._prefetcher is not None:
+            # Only added to the pyramid of the path, if still cached
+            self._prefetcher.put(key[0], None, prob_mask)
+
+    def set_new_mask(self, ratio:float=None):
+        """
+        Predict (if needed) and apply the AI mask, waiting for the model.
+
+        ratio : Threshold of cell probability in percent (0~100);
+                None to keep the current threshold
         
         ** This will reset all layers
         """
-        # Default ratio
-        ratio = 0.3
-        casted_input = resize(self.image, (200,200), preserve_range=True,
-                            anti_aliasing=True)[np.newaxis,:].astype(np.float32)
-        raw_output = self._mask_model(casted_input).numpy()[0]
-        self.prob_mask = resize(raw_output, self.shape, preserve_range=True,
-                           anti_aliasing=True)
-        self.mask = (self.prob_mask > ratio) * CELL
-        self._tmp_mask = self.mask
-        self.mode = None
-        self.mask_mode = True
+        if self._known_prob_mask() is None:
+            key, image = self._mask_target()
+            self._keep_prob_mask(key, image, self.predict(image))
+        if ratio is None:
+            ratio = self._mask_ratio
+        self.set_prob_mask(self._known_prob_mask(), ratio)
+        if self._to_ConsoleQ is not None:
+            self.put_mask_stats()
+
+    def request_new_mask(self):
+        """
+        Apply the AI mask now if it is known, or as soon as it is predicted
+        in background.
+        """
+        if self._known_prob_mask() is not None:
+            self.set_new_mask()
+        else:
+            self._mask_pending = True
+            self._mask_progress = None
+            self.start_mask_job()
+
+    def start_mask_job(self):
+        """
+        Start predicting the AI mask of current image in background.
+        A job of another image is cancelled.
+        """
+        if self._mask_worker is None:
+            return
+        key, image = self._mask_target()
+        if self._mask_job is not None:
+            if self._mask_job.key == key:
+                return
+            self._mask_job.cancel()
+            self._mask_job = None
+        if key not in self._prob_masks:
+            self._mask_job = self._mask_worker.submit(key, image)
+
+    def speculate_mask(self):
+        """
+        Start the AI mask before it is asked, if it is likely to be used:
+        The mask is only used for clips, and whole images are only
+        predicted with tiling.
+        """
+        if self._clipped_mode or self._predictor_options.get('tiled'):
+            self.start_mask_job()
+        elif self._mask_job is not None:
+            self._mask_job.cancel()
+            self._mask_job = None
+        if self._mask_pending:
+            self._mask_pending = False
+            self._to_ConsoleQ.put({MASK_PROGRESS:100})
+
+    def check_mask_job(self):
+        """
+        Report progress of the background job, and keep its result
+        """
+        job = self._mask_job
+        if job is None:
+            return
+        if self._mask_pending:
+            progress = int(job.progress * 100)
+            if progress != self._mask_progress:
+                self._mask_progress = progress
+                self._to_ConsoleQ.put({MASK_PROGRESS:progress})
+        if not job.done:
+            return
+        self._mask_job = None
+        if job.error is not None:
+            if self._mask_pending:
+                self._mask_pending = False
+                self._to_ConsoleQ.put({MASK_PROGRESS:100})
+                self._to_ConsoleQ.put({MESSAGE_BOX:
+                    f'AI mask failed: {job.error}'})
+            return
+        if job.result is None:
+            return
+        self._keep_prob_mask(job.key, job.image, job.result)
+        if self._mask_pending and job.key == self._mask_target()[0]:
+            self._mask_pending = False
+            self._to_ConsoleQ.put({MASK_PROGRESS:100})
+            self.set_new_mask()
+
+    def set_prob_mask(self, prob_mask:np.array, ratio:float=DEFAULT_MASK_RATIO):
+        """
+        prob_mask : ProbMap, or (Width, Height) cell probability
+                    of current image
+        ratio : Threshold of cell probability in percent (0~100)
+
+        ** This will reset all layers and manual edits
+        """
+        if not isinstance(prob_mask, ProbMap):
+            prob_mask = ProbMap(prob_mask)
+        self.prob_mask = prob_mask
+        self._edit_labels = None
+        self._edit_cover = None
+        self._edit_cells = None
+        self._edit_box = None
+        self._clip_history.clear()
         self._layers = []
-        self._updated = True
-        # ####### DEBUG
-        # import matplotlib.pyplot as plt
-        # print(casted_input.dtype)
-        # print(casted_input[0][0][:10])
-        # print(self.image.dtype)
-        # fig = plt.figure()
-        # ax = fig.add_subplot(1,2,1)
-        # ax.imshow(casted_input[0])
-        # ax = fig.add_subplot(1,2,2)
-        # ax.imshow(raw_output)
-        # plt.show()
+        self.mode = None
+        self.change_mask_ratio(ratio)
 
     def change_mask_ratio(self, ratio:float):
-        ratio /= 100
-        self.mask = (self.prob_mask > ratio) * CELL
-        self._tmp_mask = self.mask
-        self.mode = None
+        """
+        Threshold the probability map again.
+        Manual edits and layers are kept on top of it, but a filled cell
+        is removed, as it may not be a cell anymore.
+        """
+        if self.prob_mask is None or self.prob_mask.shape != self.shape[:2]:
+            return
+        self._mask_ratio = ratio
+        cell = self.prob_mask.cells(ratio)
+        box = self._edit_box
+        if box is not None:
+            cell[box] = np.where(self._edit_cover[box][...,0],
+                                 self._edit_cells[box], cell[box])
+        # LABEL_CELL is 1 and LABEL_MEMBRANE is 0, so cell is the mask
+        mask = cell.view(np.uint8)[...,np.newaxis]
+        if box is not None:
+            np.copyto(mask[box], self._edit_labels[box],
+                      where=self._edit_cover[box])
+        # Not using the setter, to avoid copying
+        self._mask = mask
+        self._cell_index.build(cell)
+        fill = self._fill_state()
+        if fill is not None:
+            self._set_fill(None)
+            self._clip_history.record(FillDelta(fill, None))
         self.mask_mode = True
-        self._layers = []
         self._updated = True
+
+    def preview_mask_ratio(self, ratio:float):
+        """
+        Threshold from the slider; Only the last one of the messages
+        received at once is applied, by flush()
+        """
+        self._pending_ratio = ratio
+
+    def put_mask_stats(self):
+        """
+        Send (number of cells, share of cell pixels) at current threshold
+        """
+        if self.prob_mask is None or not self._cell_index.valid:
+            return
+        count = np.count_nonzero(self._cell_index.sizes() >= MIN_CELL_PIXELS)
+        coverage = self.prob_mask.coverage(self._mask_ratio)
+        self._to_ConsoleQ.put({MASK_STATS:(int(count), coverage)})
     
     def put_image(self):
-        if self._clipped_mode :
-            if self._mask_mode:
-                # To make drawing cell mode faster, fix other layers temporally
-                if self.mode == MODE_DRAW_CELL and self._is_drawing:
-                    tmp_draw_mask = self._tmp_mask.copy()
-                    for c, m in self._layers:
-                        np.multiply(tmp_draw_mask, np.logical_not(m), out=tmp_draw_mask)
-                        np.add(tmp_draw_mask, m * np.array(c,np.uint8), out=tmp_draw_mask)
-                    self._imageQ.put(tmp_draw_mask)
-                else :
-                    self._tmp_mask = self.mask
-                    for c, m in self._layers:
-                        np.multiply(self._tmp_mask, np.logical_not(m), out=self._tmp_mask)
-                        np.add(self._tmp_mask, m * np.array(c,np.uint8), out=self._tmp_mask)
-                    for c, m in self._cell_layers:
-                        np.multiply(self._tmp_mask, np.logical_not(m), out=self._tmp_mask)
-                        np.add(self._tmp_mask, m * np.array(c,np.uint8), out=self._tmp_mask)
-                    for c, m in self._always_on_layers:
-                        np.multiply(self._tmp_mask, np.logical_not(m), out=self._tmp_mask)
-                        np.add(self._tmp_mask, m * np.array(c,np.uint8), out=self._tmp_mask)
-                    self._imageQ.put(self._tmp_mask)
-            else:
-                tmp_image = self.image
-                for c, m in self._always_on_layers:
-                    np.multiply(tmp_image, np.logical_not(m), out=tmp_image)
-                    np.add(tmp_image, m * np.array(c,np.uint8), out=tmp_image)
-                self._imageQ.put(tmp_image)
-        else :
-            tmp_image = self.image
+        if self._clipped_mode and self._mask_mode:
+            base = self._mask
+            groups = self._mask_layer_groups()
+        elif self._clipped_mode:
+            base = self._image
+            groups = [('always_on', self._always_on_layers)]
+        else:
+            base = self._image
+            groups = []
             if self._show_box:
-                for c, m in self._always_on_layers:
-                    np.multiply(tmp_image, np.logical_not(m), out=tmp_image)
-                    np.add(tmp_image, m * np.array(c,np.uint8), out=tmp_image)
-                for c, m in self._box_layers:
-                    np.multiply(tmp_image, np.logical_not(m), out=tmp_image)
-                    np.add(tmp_image, m * np.array(c,np.uint8), out=tmp_image)
-            for c, m in self._always_on_layers:
-                np.multiply(tmp_image, np.logical_not(m), out=tmp_image)
-                np.add(tmp_image, m * np.array(c,np.uint8), out=tmp_image)
-            self._imageQ.put(tmp_image)
+                groups.append(('box', self._box_layers))
+            groups.append(('always_on', self._always_on_layers))
+        step = display_step(base.shape)
+        self._display_step = step
+        if base is self._mask:
+            # Composed as labels; Colors are looked up for the frame only
+            if self._label_frame is None or \
+                self._label_frame.shape != base.shape:
+                self._label_frame = np.empty_like(base)
+            labels = self._compositor.compose(base, groups,
+                                              self._label_frame)
+            labels = labels[::step, ::step]
+            frame = self.acquire_frame(labels.shape[:2] + (3,))
+            self.colorize_frame(labels, frame)
+            return
+        elif step == 1:
+            frame = self.acquire_frame(base.shape)
+            self._compositor.compose(base, groups, frame, self._palette)
+        else:
+            # Layers are kept at full size; Composed there, then subsampled
+            if self._work_frame is None or \
+                self._work_frame.shape != base.shape:
+                self._work_frame = np.empty_like(base)
+            self._compositor.compose(base, groups, self._work_frame,
+                                     self._palette)
+            display = self._work_frame[::step, ::step]
+            frame = self.acquire_frame(display.shape)
+            np.copyto(frame, display)
+        # Viewer only copies what changed since the last frame
+        if self._last_frame is not None and \
+            self._last_frame.shape == frame.shape:
+            rects = changed_rects(self._last_frame, frame, DIRTY_TILE)
+        else:
+            rects = None
+        self._last_frame = frame
+        self._last_labels = None
+        self.publish_frame(rects)
+
+    def colorize_frame(self, labels:np.array, frame:np.array):
+        """
+        Look up colors of labels into the acquired frame, and publish it.
+        Only tiles whose labels changed since the last frame are looked up;
+        The rest is copied from the last frame.
+        """
+        last = self._last_labels
+        if last is not None and last.shape == labels.shape and \
+            self._last_frame is not None and \
+            self._last_frame.shape == frame.shape:
+            rects = changed_rects(last, labels, DIRTY_TILE)
+            np.copyto(frame, self._last_frame)
+            for x, y, w, h in rects:
+                colorize(labels[x:x+w, y:y+h], self._palette,
+                         frame[x:x+w, y:y+h])
+        else:
+            rects = None
+            colorize(labels, self._palette, frame)
+        self._last_frame = frame
+        self._last_labels = np.copy(labels)
+        self.publish_frame(rects)
+
+    def _mask_layer_groups(self):
+        return [('layers', self._layers),
+                ('cell', self._cell_layers),
+                ('always_on', self._always_on_layers)]
+
+    def composite_mask(self):
+        """
+        Returns a new array of labels of the mask with all layers drawn on it
+        """
+        return self._compositor.compose(self._mask, self._mask_layer_groups(),
+                                        np.empty_like(self._mask))
+
+    def acquire_frame(self, shape:tuple):
+        """
+        Returns a shared memory array to draw the next frame on.
+        Call publish_frame() when finished.
+        """
+        if self._frame_buffer is None or \
+            not self._frame_buffer.fits(shape):
+            if self._frame_buffer is not None:
+                self._last_frame = None
+                self._frame_buffer.close()
+            self._frame_buffer = FrameBuffer(int(np.prod(shape)), FRAME_SLOTS)
+        return self._frame_buffer.acquire(shape)
+
+    def publish_frame(self, rects:list=None):
+        """
+        Notify Viewer that the acquired frame is ready.
+        Viewer only draws the latest notified frame.
+
+        rects : (x, y, width, height) of regions that changed since the
+                previous frame; None if the whole frame changed
+        """
+        self._imageQ.put({NEW_FRAME:(self._frame_buffer.publish(), rects)})
 
     def put_mode(self):
         if self.mode != None:
@@ -264,8 +852,36 @@ class Engine(Process):
             self._to_ConsoleQ.put({MODE_NONE:None})
         self._to_ConsoleQ.put({FILL_MP_RATIO:self._mp_ratio})
 
+    def set_calibration(self, pixel:float, micrometer:float):
+        """
+        pixel : Length in native pixels of a line that is micrometer long
+        """
+        self._mp_ratio_pixel = pixel
+        self._mp_ratio_micrometer = micrometer
+        self.update_mp_ratio()
+
+    def update_mp_ratio(self):
+        """
+        Area in micrometer^2 of a work pixel of current image
+        """
+        sx, sy = self.native_scale
+        self._mp_ratio = (self._mp_ratio_micrometer/self._mp_ratio_pixel)**2\
+                         * sx * sy
+        return self._mp_ratio
+
+    def measure_cells(self):
+        """
+        Yields (pixel count, area in micrometer^2, bounding box) of every
+        connected cell in the mask
+        """
+        if not self._cell_index.valid:
+            self._cell_index.build(self._cell_pixels())
+        mp_ratio = self.update_mp_ratio()
+        for _, count, box in self._cell_index.components():
+            yield count, count * mp_ratio, box
+
     def put_ratio_list(self):
-        self._mp_ratio = (self._mp_ratio_micrometer/self._mp_ratio_pixel)**2
+        self.update_mp_ratio()
         area_list = np.multiply(self._cell_counts, self._mp_ratio).tolist()
         self._to_ConsoleQ.put({FILL_LIST:area_list})
 
@@ -283,11 +899,11 @@ class Engine(Process):
         """
         Make a new layer and draw initial point (Red dot)
         """
-        new_layer = np.zeros((self.shape[0],self.shape[1],1),
-                             dtype=np.bool)
-        color = BOX_START
+        new_layer = SparseLayer(self.shape)
+        color = LABEL_START
         x, y = pos
-        new_layer[x:x+3, y:y+3] = True
+        d = 3 * self._display_step
+        new_layer.fill((slice(x, x+d), slice(y, y+d)))
         self._always_on_layers.append((color, new_layer))
         self._box_start_pos = pos
         self._is_drawing = True
@@ -309,18 +925,20 @@ class Engine(Process):
         """
         Draw Box
         """
-        _, last_layer = self._always_on_layers.pop()
-        color = BOX_COLOR
-        new_layer = np.zeros_like(last_layer)
-        del last_layer
+        self._always_on_layers.pop()
+        color = LABEL_BOX
+        new_layer = SparseLayer(self.shape)
         x0, y0 = self._box_start_pos
         x1, y1 = pos
         r0, c0 = min(x0, x1), min(y0, y1)
         r1, c1 = max(x0, x1), max(y0, y1)
-        new_layer[r0:r1+1,c0] = True
-        new_layer[r0:r1+1,c1] = True
-        new_layer[r0,c0:c1+1] = True
-        new_layer[r1,c0:c1+1] = True
+        # As wide as a pixel of the display
+        w = self._display_step
+        new_layer.grow((slice(r0, r1+1), slice(c0, c1+1)))
+        new_layer.fill((slice(r0, r1+1), slice(c0, c0+w)))
+        new_layer.fill((slice(r0, r1+1), slice(max(c1-w+1,0), c1+1)))
+        new_layer.fill((slice(r0, r0+w), slice(c0, c1+1)))
+        new_layer.fill((slice(max(r1-w+1,0), r1+1), slice(c0, c1+1)))
         self._box_layers.append((color, new_layer))
         self._box_start_pos = None
         self._is_drawing = False
@@ -341,9 +959,12 @@ class Engine(Process):
         r0, c0 = min(x0, x1), min(y0, y1)
         r1, c1 = max(x0, x1), max(y0, y1)
         self.image = self._backup_image[r0:r1,c0:c1]
+        self._clip_box = ((r0, c0), (r1, c1))
+        self._clip_boxes.append(self._clip_box)
         self._clipped_mode = True
         self._to_ConsoleQ.put({MODE_CLIP:None})
         self._updated = True
+        self.speculate_mask()
 
     def _clip_exit(self):
         """
@@ -352,6 +973,7 @@ class Engine(Process):
         """
         self.image = self._backup_image
         self._clipped_mode = False
+        self.speculate_mask()
         self._layers = []
         self._cell_layers = []
         self._to_ConsoleQ.put({MODE_CANCEL_CLIP:None})
@@ -364,19 +986,29 @@ class Engine(Process):
         Calls _clip_exit and erase the box too.
         """
         if self._clipped_mode:
+            # _clip_exit forgets the filled cell, but not its count
+            filled = len(self._cell_layers) > 0
             self._clip_exit()
-            if len(self._cell_layers) >0:
-                self.fill_delete([-1])
-            else: 
-                self._box_layers.pop()
+            if filled:
+                self._cell_counts.pop()
+            self._box_layers.pop()
+            self._clip_boxes.pop()
             self._updated = True
 
     def clip_confirm(self):
         if self._clipped_mode:
             if len(self._cell_layers) > 0 :
-                self._clipped_masks.append(self._tmp_mask)
-                self._clipped_imgs.append(self.image)
+                # Undo removes the clip, as if it was cancelled
+                before = self._slide_state()
+                before = (before[0][:-1], before[1][:-1], before[2][:-1]) \
+                         + before[3:]
+                self._clips.append(self.clip_store().append(
+                    self._image, PackedLabels(self.composite_mask())))
                 self._clip_exit()
+                self._slide_history.record(SlideDelta(before,
+                                                      self._slide_state()))
+                # Nothing confirmed is lost, even if the app crashes
+                self.save_session()
             # If press confirm without filling any cells, just cancel
             else :
                 self.clip_cancel()
@@ -385,11 +1017,11 @@ class Engine(Process):
         """
         Make a new layer and draw inital point (Red dot)
         """
-        new_layer = np.zeros((self.shape[0],self.shape[1],1),
-                             dtype=np.bool)
-        color = LINE_START
+        new_layer = SparseLayer(self.shape)
+        color = LABEL_START
         x, y = pos
-        new_layer[x:x+3, y:y+3] = True
+        d = 3 * self._display_step
+        new_layer.fill((slice(x, x+d), slice(y, y+d)))
         self._layers.append((color, new_layer))
         self._line_start_pos = pos
         self._is_drawing = True
@@ -399,14 +1031,17 @@ class Engine(Process):
         """
         Draw the line and start next line
         """
-        _, last_layer = self._layers.pop()
-        new_layer = np.zeros_like(last_layer)
-        color = MEMBRANE
-        del last_layer
+        self._layers.pop()
+        new_layer = SparseLayer(self.shape)
+        color = LABEL_MEMBRANE
         r0, c0 = self._line_start_pos
         r1, c1 = pos
-        rr, cc, _ = draw.line_aa(r0, c0, r1, c1)
-        new_layer[rr, cc] = True
+        if self._display_step == 1:
+            rr, cc, _ = draw.line_aa(r0, c0, r1, c1)
+            new_layer.fill_points(rr, cc)
+        else:
+            # As wide as a pixel of the display, so that it is shown
+            new_layer.stroke([(r0, c0), (r1, c1)], self._display_step / 2)
         self._layers.append((color, new_layer))
         self._line_start_pos = None
         self.draw_mem_start(pos)
@@ -425,14 +1060,57 @@ class Engine(Process):
     def draw_apply(self):
         if self._is_drawing:
             self.draw_stop()
-        tmp_mask = self.mask
-        for c, m in self._layers:
-            np.multiply(tmp_mask, np.logical_not(m), out=tmp_mask)
-            np.add(tmp_mask, m * np.array(c,np.uint8), out=tmp_mask)
-        self._layers = []
-        self.mask = tmp_mask
+        if len(self._layers) > 0:
+            region = union_box(self._layers)
+            if region is not None:
+                # Kept apart from the mask, to survive a new threshold
+                if self._edit_cover is None:
+                    self._edit_labels = np.zeros(self.shape[:2]+(1,),
+                                                 dtype=np.uint8)
+                    self._edit_cover = np.zeros(self.shape[:2]+(1,),
+                                                dtype=bool)
+                    self._edit_cells = np.zeros(self.shape[:2], dtype=bool)
+                before = self._edit_region(region)
+                for c, m in self._layers:
+                    m.paint_on(self._edit_labels, c)
+                    m.cover(self._edit_cover)
+                self._clip_history.record(
+                    MaskDelta(region, before, self._edit_region(region)))
+                self._edits_changed(region)
+            self._layers = []
         self._updated = True
 
+    def _edit_region(self, box:tuple):
+        """
+        Packed copies of (labels, cover) of the edit overlay in the box
+        """
+        return (PackedLabels(self._edit_labels[box]),
+                PackedMask(self._edit_cover[box]))
+
+    def _set_edit_region(self, box:tuple, state:tuple):
+        labels, cover = state
+        self._edit_labels[box] = labels.unpack()
+        self._edit_cover[box] = cover.unpack()
+        self._edits_changed(box)
+
+    def _edits_changed(self, box:tuple):
+        """
+        Draw the mask again in the box, where edits changed
+        """
+        labels = self._edit_labels[box]
+        cover = self._edit_cover[box]
+        self._edit_cells[box] = labels[...,0] == LABEL_CELL
+        self._edit_box = bounding_box(self._edit_cover[...,0])
+        if self.prob_mask is not None and \
+            self.prob_mask.shape == self.shape[:2]:
+            cell = self.prob_mask[box].cells(self._mask_ratio)
+        else:
+            cell = np.zeros(cover.shape[:2], dtype=bool)
+        mask = cell.view(np.uint8)[...,np.newaxis]
+        np.copyto(mask, labels, where=cover)
+        self._mask[box] = mask
+        self._cell_index.update(self._cell_pixels(), box)
+
     def draw_undo(self):
         if len(self._layers)>0 :
             self._layers.pop()
@@ -457,81 +1135,99 @@ class Engine(Process):
 
 
     def draw_cell_start(self, pos):
-        new_layer = np.zeros((self.shape[0],self.shape[1],1),
-                             dtype=np.bool)
-        color = CELL
-        new_layer[pos[0]-5:pos[0]+6,pos[1]-5:pos[1]+6] = True
+        new_layer = SparseLayer(self.shape)
+        color = LABEL_CELL
+        new_layer.stroke([pos], BRUSH_RADIUS * self._display_step)
         self._layers.append((color, new_layer))
+        self._stroke_last = pos
+        self._stroke_points = []
         self._is_drawing = True
         self._updated = True
         self._etcQ.put({BIG_CURSOR_ON:None})
         self._etcQ.put({MOUSEPOS_ON:None})
 
     def draw_cell_continue(self, pos):
+        """
+        Only collects the position; draw_cell_flush() draws every
+        collected position at once
+        """
+        self._stroke_points.append(pos)
+
+    def draw_cell_flush(self):
+        """
+        Draw collected positions as one stroke, joined to the last one
+        """
+        if len(self._stroke_points) == 0:
+            return
         _, last_layer = self._layers[-1]
-        last_layer[pos[0]-5:pos[0]+6,pos[1]-5:pos[1]+6] = True
+        last_layer.stroke([self._stroke_last] + self._stroke_points,
+                          BRUSH_RADIUS * self._display_step)
+        self._stroke_last = self._stroke_points[-1]
+        self._stroke_points = []
         self._updated = True
 
     def draw_cell_end(self):
+        self.draw_cell_flush()
         self._is_drawing = False
         self._updated = True
         self._etcQ.put({BIG_CURSOR_OFF:None})
         self._etcQ.put({MOUSEPOS_OFF:None})
 
     def fill_cell(self, pos):
-        new_layer = np.zeros((self.shape[0],self.shape[1],1),
-                             dtype=np.bool)
-        pos_stack = [pos]
-        mask = self.mask
-        pix_count = 0
-        while len(pos_stack) > 0:
-            x, y = pos_stack.pop()
-            while (mask[x,y] == CELL).all() and x>=0:
-                x -= 1
-            x += 1
-            above, below = False, False
-            while x < self.shape[0] and (mask[x,y]==CELL).all():
-                mask[x,y] = COUNT
-                new_layer[x,y] = True
-                pix_count += 1
-                if (not above) and (y>0) and (mask[x,y-1]==CELL).all():
-                    pos_stack.append([x,y-1])
-                    above = True
-                elif (above) and (y>0) and (mask[x,y-1]!=CELL).any():
-                    above = False
-                if (not below) and (y<self.shape[1]-1) and (mask[x,y+1]==CELL).all():
-                    pos_stack.append([x,y+1])
-                    below = True
-                elif (below) and (y<self.shape[1]-1) and (mask[x,y+1]!=CELL).any():
-                    below = False
-                x += 1
+        if not self._cell_index.valid:
+            self._cell_index.build(self._cell_pixels())
+        label = self._cell_index.label_at(pos)
+        if label > 0:
+            box, component = self._cell_index.component(label)
+            fill = (box, PackedMask(component), self._cell_index.count(label))
+        else:
+            fill = ((slice(0,0), slice(0,0)),
+                    PackedMask(np.zeros((0,0), dtype=bool)), 0)
         # Only one cell per clip
+        before = self._fill_state()
+        self._set_fill(fill)
+        self._clip_history.record(FillDelta(before, fill))
+
+    def _fill_state(self):
+        """
+        Filled cell of the clip as (box, PackedMask of the box,
+        pixel count), or None if no cell is filled
+        """
+        if len(self._cell_layers) == 0:
+            return None
+        _, layer = self._cell_layers[-1]
+        return layer.box, PackedMask(layer.mask[...,0]), self._cell_counts[-1]
+
+    def _set_fill(self, fill):
+        """
+        fill : (box, PackedMask of the box, pixel count), or None
+        """
         if len(self._cell_layers) > 0:
             self._cell_layers.pop()
             self._cell_counts.pop()
-        self._cell_layers.append((COUNT, new_layer))
-        self._cell_counts.append(pix_count)
+        if fill is not None:
+            box, component, count = fill
+            new_layer = SparseLayer(self.shape, box,
+                                    component.unpack()[...,np.newaxis])
+            self._cell_layers.append((LABEL_COUNT, new_layer))
+            self._cell_counts.append(count)
         self._updated = True
-    
-    def fill_undo(self):
-        if len(self._cell_layers) > 0: 
-            self._cell_layers.pop()
-            self._cell_counts.pop()
-            self._updated = True
 
     def fill_ratio_start(self, pos):
-        new_layer = np.zeros((self.shape[0],self.shape[1],1),
-                             dtype=np.bool)
-        color = LINE_START
+        new_layer = SparseLayer(self.shape)
+        color = LABEL_START
         x, y = pos
-        new_layer[x-2:x+3, y-2:y+3] = True
+        d = 2 * self._display_step
+        new_layer.fill((slice(x-d, x+d+1), slice(y-d, y+d+1)))
         self._always_on_layers.append((color, new_layer))
         self._mp_ratio_start_pos = pos
         self._is_drawing = True
         self._updated = True
 
     def fill_ratio_end(self, pos):
-        pixel_dist = np.sqrt(np.sum(np.subtract(self._mp_ratio_start_pos,pos)**2))
+        # In native pixels
+        pixel_dist = np.sqrt(np.sum((np.subtract(self._mp_ratio_start_pos,pos)
+                                     * self.native_scale)**2))
         self._mp_ratio_pixel = pixel_dist
         self._always_on_layers.pop()
         self._is_drawing = False
@@ -547,184 +1243,446 @@ class Engine(Process):
 
     def fill_delete(self, indices):
         if len(self._cell_counts) > 0:
+            before = self._slide_state()
             for idx in indices:
                 # self._cell_layers.pop(idx)
                 self._cell_counts.pop(idx)
                 self._box_layers.pop(idx)
+                self._clip_boxes.pop(idx)
+                self._clips.pop(idx)
+            self._slide_history.record(SlideDelta(before,
+                                                  self._slide_state()))
             self._updated = True
 
-    def fill_save(self, excel_dir, image_name, image_folder):
-        try :
-            wb = load_workbook(excel_dir)
-        except :
-            self._to_ConsoleQ.put({MESSAGE_BOX:'Cannot open Workbook!'})
+    def _slide_state(self):
+        """
+        Copies of the lists of results of the slide
+        """
+        return (list(self._box_layers), list(self._cell_counts),
+                list(self._clip_boxes), list(self._clips))
+
+    def _set_slide(self, state:tuple):
+        box_layers, cell_counts, clip_boxes, clips = state
+        self._box_layers = list(box_layers)
+        self._cell_counts = list(cell_counts)
+        self._clip_boxes = list(clip_boxes)
+        self._clips = list(clips)
+        self._updated = True
+
+    def undo(self):
+        """
+        Revert the last edit of current clip, or the last result of
+        the slide if not clipped
+        """
+        history = self._clip_history if self._clipped_mode \
+                  else self._slide_history
+        edit = history.undo()
+        if edit is not None:
+            self._apply_edit(edit, edit.before)
+
+    def redo(self):
+        history = self._clip_history if self._clipped_mode \
+                  else self._slide_history
+        edit = history.redo()
+        if edit is not None:
+            self._apply_edit(edit, edit.after)
+
+    def _apply_edit(self, edit, state):
+        if isinstance(edit, MaskDelta):
+            self._set_edit_region(edit.box, state)
+        elif isinstance(edit, FillDelta):
+            self._set_fill(state)
+        elif isinstance(edit, SlideDelta):
+            count = len(self._cell_counts)
+            self._set_slide(state)
+            self._report_slide('Undo' if state is edit.before else 'Redo',
+                               count)
+        self._updated = True
+
+    def _report_slide(self, action:str, count:int):
+        """
+        Tell that undo or redo changed the results of the slide, from count
+        of them; They are out of view, unlike edits of a clip
+        """
+        change = len(self._cell_counts) - count
+        if change < 0:
+            self._to_ConsoleQ.put({MESSAGE_BOX:f'{action} removed '\
+                f'{-change} confirmed clip(s) from the results.'})
+        elif change > 0:
+            self._to_ConsoleQ.put({MESSAGE_BOX:f'{action} brought back '\
+                f'{change} clip(s) to the results.'})
+
+    def clip_store(self):
+        """
+        ClipStore of current image, kept open
+        """
+        path = None if self._image_path is None \
+               else clip_store_path(self._image_path)
+        if self._clip_store is None or self._clip_store.path != path:
+            if self._clip_store is not None:
+                self._clip_store.close()
+            # Still open if the image was left while saving
+            self._clip_store = self._closing_stores.pop(self._image_path,
+                                                        None)
+            if self._clip_store is None:
+                self._clip_store = ClipStore(path)
+        return self._clip_store
+
+    def results(self, image_folder:str):
+        """
+        ResultStore of the image folder, kept open
+        """
+        path = os.path.join(image_folder, 'save', RESULTS_DB_NAME)
+        if self._results is None or self._results.path != path:
+            if self._results is not None:
+                self._results.close()
+            self._results = ResultStore(path)
+        return self._results
+
+    def fill_save(self, image_name, image_folder):
+        """
+        Add clips that are not saved yet to the ResultStore, and write
+        their images
+        """
+        self.update_mp_ratio()
+        new = [i for i, clip_id in enumerate(self._clips)
+               if clip_id not in self._saved_clips]
+        if len(new) == 0:
+            self._to_ConsoleQ.put({MESSAGE_BOX:f'{image_name} has no new '\
+                'clips to save.'})
             return
-        ws = wb.worksheets[0]
-        row, col = 1, 1
-        while ws.cell(row, col).value != None:
-            col += 1
-        for area in self._cell_counts:
-            ws.cell(row, col).value = area * self._mp_ratio
-            ws.cell(row, col+1).value = image_name
-            row += 1
+        cells = [(self._cell_counts[i] * self._mp_ratio, self._cell_counts[i],
+                  self._clip_boxes[i]) for i in new]
         try:
-            wb.save(excel_dir)
-        except:
-            self._to_ConsoleQ.put({MESSAGE_BOX:'Failed to Save'})
+            self.results(image_folder).add_cells(image_name, cells,
+                self._mp_ratio_pixel, self._mp_ratio_micrometer)
+        except (sqlite3.Error, OSError) as e:
+            self._to_ConsoleQ.put({MESSAGE_BOX:f'Failed to Save\n{e}'})
             return
+        clips = [self._clips[i] for i in new]
+        self._saved_clips.update(clips)
+        self.save_session()
+        # Images are written in background; Console hears when they are done
+        folder = os.path.join(image_folder,'save',image_name)
+        start_num = self.save_number(folder, len(clips))
+        files = []
+        # Clips are read from the store by the workers, one by one
+        store = self.clip_store()
+        for i, clip_id in enumerate(clips):
+            name = image_name + str(i+start_num)
+            files.append((os.path.join(folder, 'mask', name + '_mask.png'),
+                          store.mask(clip_id), self._palette))
+            files.append((os.path.join(folder, 'img', name + '.png'),
+                          store.image(clip_id), None))
+        if self._save_pool is None:
+            self._save_pool = SavePool(SAVE_WORKERS, self.save_done)
+        with self._saving_lock:
+            self._saving[self._image_path] = \
+                self._saving.get(self._image_path, 0) + 1
+        self._save_pool.save((self._image_path, image_name), files)
+
+    def save_number(self, folder:str, n:int):
+        """
+        Reserve n file numbers in a save folder; Returns the first one.
+        Counted from the disk only once, as earlier saves may still be
+        being written.
+        """
+        if folder not in self._save_numbers:
+            img_folder = os.path.join(folder, 'img')
+            self._save_numbers[folder] = len(
+                [f for f in os.listdir(img_folder) if f.endswith('.png')]
+                ) if os.path.isdir(img_folder) else 0
+        start_num = self._save_numbers[folder]
+        self._save_numbers[folder] += n
+        return start_num
+
+    def save_done(self, save, errors):
+        """
+        Called from a SavePool thread
+
+        save : (image path, image name)
+        """
+        image_path, image_name = save
+        with self._saving_lock:
+            self._saving[image_path] -= 1
+            if self._saving[image_path] == 0:
+                del self._saving[image_path]
+        if self._inbox is not None:
+            self._inbox.put({SAVE_DONE:image_path})
+        if errors:
+            self._to_ConsoleQ.put({MESSAGE_BOX:f'Failed to Save {image_name}'\
+                f'\n{errors[0]}'})
         else:
-            self._to_ConsoleQ.put({MESSAGE_BOX:'Saved Successfully.'\
-                '\nDon\'t forget to check.'})
-        # Saving the mask image
-        mask_folder = os.path.join(image_folder,'save',image_name,'mask')
-        img_folder = os.path.join(image_folder,'save',image_name,'img')
-        if not os.path.exists(mask_folder):
-            os.makedirs(mask_folder)
-        if not os.path.exists(img_folder):
-            os.makedirs(img_folder)
-        start_num = len(os.listdir(img_folder))
-        for i, mask, img in zip(range(len(self._clipped_imgs)), 
-                                self._clipped_masks,
-                                self._clipped_imgs):
-            mask_save = Image.fromarray(mask.swapaxes(0,1))
-            img_save = Image.fromarray(img.swapaxes(0,1))
-            mask_name = image_name + str(i+start_num) + '_mask.png'
-            img_name = image_name + str(i+start_num) + '.png'
-            filename_mask = os.path.join(mask_folder, mask_name)
-            filename_img = os.path.join(img_folder, img_name)
-            mask_save.save(filename_mask)
-            img_save.save(filename_img)
+            self._to_ConsoleQ.put({MESSAGE_BOX:f'Saved {image_name} '\
+                'Successfully.\nDon\'t forget to check.'})
 
+    def fill_export(self, path, image_folder):
+        """
+        Write every result saved in the image folder to a .xlsx or .csv
+        """
+        try:
+            n = self.results(image_folder).export(path)
+        except (sqlite3.Error, OSError) as e:
+            self._to_ConsoleQ.put({MESSAGE_BOX:f'Failed to Export\n{e}'})
+        else:
+            self._to_ConsoleQ.put({MESSAGE_BOX:f'Exported {n} cells.'})
+
+    def flush(self):
+        """
+        Apply what was collected from messages received at once
+        """
+        self.draw_cell_flush()
+        if self._pending_ratio is not None:
+            self.change_mask_ratio(self._pending_ratio)
+            self._pending_ratio = None
+            self.put_mask_stats()
+
+    def handle_command(self, k, v):
+        """
+        Handle a message from Console
+        """
+        # Loading & Showing modes
+        if k == NEWIMAGE:
+            self.load_image(v)
+        elif k == NEWMASK:
+            self.request_new_mask()
+        elif k == PREFETCH:
+            self._prefetcher.request(v)
+        elif k == MODE_IMAGE:
+            self.mask_mode = False
+        elif k == MODE_MASK:
+            self.mask_mode = True
+        # # Set colors & ratio
+        # elif k == SET_MEM:
+        #     self.mode = MODE_SET_MEM
+        # elif k == SET_CELL:
+        #     self.mode = MODE_SET_CELL
+        # Box Drawing
+        elif k == DRAW_BOX:
+            self.mode = MODE_DRAW_BOX
+            self._etcQ.put({CROSS_CURSOR_ON:None})
+            self._updated = True
+        elif k == MODE_CANCEL_CLIP:
+            self.clip_cancel()
+        elif k == SET_RATIO:
+            self.preview_mask_ratio(v)
+        elif k == MODE_CONFIRM_CLIP:
+            self.clip_confirm()
+        elif k == MODE_SHOW_BOX:
+            self._show_box = True
+            self._updated = True
+        elif k == MODE_HIDE_BOX:
+            self._show_box = False
+            self._updated = True
+        #Drawing modes
+        elif k == DRAW_MEM:
+            self.mode = MODE_DRAW_MEM
+            self._updated = True
+        elif k == DRAW_CELL:
+            self.mode = MODE_DRAW_CELL
+            self.draw_cell_mode_init()
+        elif k == DRAW_OFF:
+            self.draw_apply()
+        elif k == DRAW_CANCEL:
+            self.draw_cancel()
+        #Counting modes
+        elif k == FILL_CELL:
+            self.mode = MODE_FILL_CELL
+            self.draw_apply()
+        elif k == FILL_MP_RATIO:
+            self.mode = MODE_FILL_MP_RATIO
+            self._updated = True
+        elif k == FILL_DELETE:
+            self.fill_delete(v)
+        elif k == FILL_SAVE:
+            self.fill_save(*v)
+        elif k == FILL_EXPORT:
+            self.fill_export(*v)
+        elif k == FILL_MICRO:
+            self._mp_ratio_micrometer = v
+            self._updated = True
+
+    def work_pos(self, pos:tuple):
+        """
+        Position in the image of a position in the frame Viewer shows
+        """
+        x, y = pos
+        return (x * self._display_step, y * self._display_step)
+
+    def handle_event(self, k, v):
+        """
+        Handle a mouse or keyboard event from Viewer
+        """
+        if k in (MOUSEDOWN, MOUSEPOS):
+            v = self.work_pos(v)
+        if k == MOUSEDOWN:
+            # v : mouse pos which came from Viewer
+            # # Set color
+            # if self.mode == MODE_SET_MEM:
+            #     self.set_mem_color(v)
+            #     self._color_mode = None
+            #     self._to_ConsoleQ.put({SET_MEM:self.mem_color})
+            # elif self.mode == MODE_SET_CELL:
+            #     self.set_cell_color(v)
+            #     self._color_mode = None
+            #     self._to_ConsoleQ.put({SET_CELL:self.cell_color})
+            # Box mode
+            if self.mode == MODE_DRAW_BOX:
+                if not self._is_drawing:
+                    self.draw_box_start(v)
+                else:
+                    self.draw_box_end(v)
+            # Drawing mode
+            if self.mode == MODE_DRAW_MEM:
+                if not self._is_drawing:
+                    self.draw_mem_start(v)
+                else:
+                    self.draw_mem_end(v)
+            elif self.mode == MODE_DRAW_CELL:
+                self.draw_cell_start(v)
+            # Counting mode
+            elif self.mode == MODE_FILL_CELL:
+                self.fill_cell(v)
+            elif self.mode == MODE_FILL_MP_RATIO:
+                if not self._is_drawing:
+                    self.fill_ratio_start(v)
+                else :
+                    self.fill_ratio_end(v)
+        elif k == MOUSEDOWN_RIGHT:
+            if self.mode == MODE_DRAW_MEM:
+                self.draw_stop()
+        elif k == MOUSEUP:
+            if self.mode == MODE_DRAW_CELL:
+                self.draw_cell_end()
+        elif k == MOUSEPOS:
+            if self.mode == MODE_DRAW_CELL:
+                if self._is_drawing:
+                    self.draw_cell_continue(v)
+        # Keyboard events
+        elif k == K_Z:
+            # Layers not applied yet are undone first
+            if (self.mode == MODE_DRAW_CELL or\
+                self.mode == MODE_DRAW_MEM) and len(self._layers) > 0:
+                self.draw_undo()
+            else:
+                self.undo()
+        elif k == K_Y:
+            self.redo()
+        elif k == K_ENTER:
+            if self.mode == MODE_DRAW_MEM or\
+            self.mode == MODE_DRAW_CELL:
+                self.draw_apply()
 
     def run(self):
         mainloop = True
-        self._clock = Clock()
-        self._mask_model = get_model('hr_5_3_0')
+        # Console, Viewer and the mask worker all send to this
+        self._inbox = Inbox(self._to_EngineQ)
+        self._profiler = Profiler('Engine', **self._profile_options)
+        self._to_ConsoleQ = timed(self._to_ConsoleQ, self._profiler, 'console')
+        self._imageQ = timed(self._imageQ, self._profiler, 'image')
+        self._etcQ = timed(self._etcQ, self._profiler, 'etc')
+        # Loading TensorFlow and the weights takes seconds;
+        # Do not make the first frame wait for it
+        self._model_loading = threading.Thread(target=self.load_model,
+                                               daemon=True)
+        self._model_loading.start()
+        # Without tiling, the prediction of a clip cannot be cropped from
+        # the whole image, so only loading is done in advance
+        self._prefetcher = Prefetcher(
+            lambda path: read_image(path, self.work_size),
+            (lambda pyramid: self.predict(pyramid.work))
+            if self._predictor_options.get('tiled') else None)
+        self._mask_worker = MaskWorker(self.predict,
+            lambda job: self._inbox.put({MASK_DONE:None}))
         while mainloop:
-            self._clock.tick(60)
-            if not self._to_EngineQ.empty():
-                q = self._to_EngineQ.get()
+            # Sleep until a message arrives; While a mask is awaited, also
+            # wake up now and then to report its progress
+            timeout = MASK_PROGRESS_INTERVAL \
+                if self._mask_pending and self._mask_job is not None else None
+            messages = self._inbox.receive(timeout)
+            self._profiler.sample('inbox depth', len(messages))
+            for sent, q in messages:
                 for k, v in q.items():
+                    start = time.time()
+                    # Brush positions and thresholds are applied in one go,
+                    # but before anything that may depend on them
+                    if k not in (MOUSEPOS, SET_RATIO):
+                        self.flush()
                     if k == TERMINATE:
                         mainloop = False
-                    # Loading & Showing modes
-                    elif k == NEWIMAGE:
-                        self.load_image(v)
-                    elif k == NEWMASK:
-                        self.set_new_mask()
-                    elif k == MODE_IMAGE:
-                        self.mask_mode = False
-                    elif k == MODE_MASK:
-                        self.mask_mode = True
-                    # # Set colors & ratio
-                    # elif k == SET_MEM:
-                    #     self.mode = MODE_SET_MEM
-                    # elif k == SET_CELL:
-                    #     self.mode = MODE_SET_CELL
-                    # Box Drawing
-                    elif k == DRAW_BOX:
-                        self.mode = MODE_DRAW_BOX
-                        self._etcQ.put({CROSS_CURSOR_ON:None})
-                        self._updated = True
-                    elif k == MODE_CANCEL_CLIP:
-                        self.clip_cancel()
-                    elif k == SET_RATIO:
-                        self.mask_mode = True
-                        self.change_mask_ratio(v)
-                    elif k == MODE_CONFIRM_CLIP:
-                        self.clip_confirm()
-                    elif k == MODE_SHOW_BOX:
-                        self._show_box = True
-                        self._updated = True
-                    elif k == MODE_HIDE_BOX:
-                        self._show_box = False
-                        self._updated = True
-                    #Drawing modes
-                    elif k == DRAW_MEM:
-                        self.mode = MODE_DRAW_MEM
-                        self._updated = True
-                    elif k == DRAW_CELL:
-                        self.mode = MODE_DRAW_CELL
-                        self.draw_cell_mode_init()
-                    elif k == DRAW_OFF:
-                        self.draw_apply()
-                    elif k == DRAW_CANCEL:
-                        self.draw_cancel()
-                    #Counting modes
-                    elif k == FILL_CELL:
-                        self.mode = MODE_FILL_CELL
-                        self.draw_apply()
-                    elif k == FILL_MP_RATIO:
-                        self.mode = MODE_FILL_MP_RATIO
-                        self._updated = True
-                    elif k == FILL_DELETE:
-                        self.fill_delete(v)
-                    elif k == FILL_SAVE:
-                        self.fill_save(*v)
-                    elif k == FILL_MICRO:
-                        self._mp_ratio_micrometer = v
-                        self._updated = True
-
-            if not self._eventQ.empty():
-                q = self._eventQ.get()
-                for k,v in q.items():
-                    if k == MOUSEDOWN:
-                        # v : mouse pos which came from Viewer
-                        # # Set color
-                        # if self.mode == MODE_SET_MEM:
-                        #     self.set_mem_color(v)
-                        #     self._color_mode = None
-                        #     self._to_ConsoleQ.put({SET_MEM:self.mem_color})
-                        # elif self.mode == MODE_SET_CELL:
-                        #     self.set_cell_color(v)
-                        #     self._color_mode = None
-                        #     self._to_ConsoleQ.put({SET_CELL:self.cell_color})
-                        # Box mode
-                        if self.mode == MODE_DRAW_BOX:
-                            if not self._is_drawing:
-                                self.draw_box_start(v)
-                            else:
-                                self.draw_box_end(v)
-                        # Drawing mode
-                        if self.mode == MODE_DRAW_MEM:
-                            if not self._is_drawing:
-                                self.draw_mem_start(v)
-                            else:
-                                self.draw_mem_end(v)
-                        elif self.mode == MODE_DRAW_CELL:
-                            self.draw_cell_start(v)
-                        # Counting mode
-                        elif self.mode == MODE_FILL_CELL:
-                            self.fill_cell(v)
-                        elif self.mode == MODE_FILL_MP_RATIO:
-                            if not self._is_drawing:
-                                self.fill_ratio_start(v)
-                            else :
-                                self.fill_ratio_end(v)
-                    elif k == MOUSEDOWN_RIGHT:
-                        if self.mode == MODE_DRAW_MEM:
-                            self.draw_stop()
-                    elif k == MOUSEUP:
-                        if self.mode == MODE_DRAW_CELL:
-                            self.draw_cell_end()
-                    elif k == MOUSEPOS:
-                        if self.mode == MODE_DRAW_CELL:
-                            if self._is_drawing:
-                                self.draw_cell_continue(v)
-                    # Keyboard events
-                    elif k == K_Z:
-                        if self.mode == MODE_DRAW_CELL or\
-                            self.mode == MODE_DRAW_MEM:
-                            self.draw_undo()
-                        elif self.mode == MODE_FILL_CELL:
-                            self.fill_undo()
-                    elif k == K_ENTER:
-                        if self.mode == MODE_DRAW_MEM or\
-                        self.mode == MODE_DRAW_CELL:
-                            self.draw_apply()
-
+                    elif k == MASK_DONE:
+                        # Only wakes up the loop; check_mask_job does the rest
+                        pass
+                    elif k == SAVE_DONE:
+                        self.close_stores()
+                    elif k in EVENTS:
+                        self.handle_event(k, v)
+                    else:
+                        self.handle_command(k, v)
+                    end = time.time()
+                    name = message_name(k)
+                    if sent is not None:
+                        # From sending until handling started
+                        self._profiler.record(f'{name} wait', sent,
+                                              start - sent)
+                    self._profiler.record(name, start, end - start)
+            # Drawn once for everything received at once
+            with self._profiler.span('flush'):
+                self.flush()
+            self.check_mask_job()
             if self._updated:
-                self.put_image()
+                with self._profiler.span('put_image'):
+                    self.put_image()
                 self.put_ratio_list()
                 self.put_mode()
-                self._updated = False
\ No newline at end of file
+                self._updated = False
+        self._leave_image()
+        self.close()
+        self._profiler.close()
+
+    def close(self):
+        """
+        Wait for pending saves, and release shared memory and files
+        """
+        if self._save_pool is not None:
+            self._save_pool.shutdown()
+            self._save_pool = None
+        self.close_stores()
+        if self._clip_store is not None:
+            self._clip_store.close()
+            self._clip_store = None
+        if self._frame_buffer is not None:
+            self._frame_buffer.close()
+            self._frame_buffer = None
+            self._last_frame = None
+        if self._results is not None:
+            self._results.close()
+            self._results = None
+
+
+def bounding_box(pixels:np.array):
+    """
+    Returns (slice, slice) around True pixels of a 2D bool array,
+    or None if there is none
+    """
+    rows = np.flatnonzero(pixels.any(axis=1))
+    cols = np.flatnonzero(pixels.any(axis=0))
+    if len(rows) == 0:
+        return None
+    return (slice(rows[0], rows[-1]+1), slice(cols[0], cols[-1]+1))
+
+def compact_clips(store:ClipStore, clips:list, saved_clips:set):
+    """
+    Drop clips that are not in clips from store
+
+    Returns (clips, saved_clips) by their new ids
+    """
+    new_clips = store.compact(clips)
+    return new_clips, {new for old, new in zip(clips, new_clips)
+                       if old in saved_clips}
+
+def read_image(path:str, work_size:tuple=WORK_SIZE):
+    """
+    Returns Pyramid of the image; Its work level is what is worked on
+    """
+    return Pyramid.open(path, work_size)
@@ -0,0 +1,138 @@
+import numpy as np
+from multiprocessing import shared_memory
+
+# Frame number written to a slot header while the slot is being overwritten
+WRITING = -1
+
+class FrameBuffer():
+    """
+    Ring of frame slots in shared memory, written by Engine.
+
+    Only a small notification (name, slot, frame_no, shape) crosses the
+    image queue. The memory layout is a header of int64s
+    (number of slots, then frame number of each slot) followed by the slots.
+    """
+    def __init__(self, capacity:int, slots:int=3):
+        """
+        Arguments:
+        capacity : Maximum number of bytes a frame can have
+        slots : Number of frames in the ring
+        """
+        self.capacity = capacity
+        self.slots = slots
+        self._shm = shared_memory.SharedMemory(
+            create=True, size=_header_size(slots) + capacity*slots)
+        header = np.ndarray((slots+1,), dtype=np.int64, buffer=self._shm.buf)
+        header[0] = slots
+        self._frame_nos = header[1:]
+        self._frame_nos[:] = WRITING
+        self._frame_no = 0
+        self._writing = None
+
+    @property
+    def name(self):
+        return self._shm.name
+
+    def fits(self, shape:tuple):
+        return int(np.prod(shape)) <= self.capacity
+
+    def acquire(self, shape:tuple):
+        """
+        Returns a writable uint8 array of the next slot.
+        Call publish() when the frame is complete.
+        """
+        if not self.fits(shape):
+            raise ValueError('Frame does not fit in the buffer')
+        self._frame_no += 1
+        slot = self._frame_no % self.slots
+        # Readers that are copying this slot will notice the change
+        self._frame_nos[slot] = WRITING
+        self._writing = (slot, tuple(shape))
+        return _slot_array(self._shm, self.slots, self.capacity, slot, shape)
+
+    def publish(self):
+        """
+        Mark the acquired slot as complete.
+        Returns the notification to put into the image queue.
+        """
+        slot, shape = self._writing
+        self._frame_nos[slot] = self._frame_no
+        self._writing = None
+        return (self.name, slot, self._frame_no, shape)
+
+    def close(self):
+        self._frame_nos = None
+        _close_shm(self._shm)
+        self._shm.unlink()
+
+
+class FrameReader():
+    """
+    Viewer side of FrameBuffer.
+    Attaches to whichever buffer the latest notification points to.
+    """
+    def __init__(self):
+        self._shm = None
+        self._frame_nos = None
+
+    def _attach(self, name:str):
+        self.close()
+        # Spawned processes share one resource tracker, so attaching does
+        # not hand the segment's ownership over from Engine
+        self._shm = shared_memory.SharedMemory(name=name)
+        slots = int(np.ndarray((1,), dtype=np.int64, buffer=self._shm.buf)[0])
+        header = np.ndarray((slots+1,), dtype=np.int64, buffer=self._shm.buf)
+        self._frame_nos = header[1:]
+        self._slots = slots
+        self._capacity = (self._shm.size - _header_size(slots)) // slots
+
+    def frame(self, notification:tuple):
+        """
+        Returns a read-only view of the frame, or None if the slot was
+        already overwritten by a newer frame, or the buffer is gone.
+        Check valid() again after copying from the view.
+        """
+        name, slot, frame_no, shape = notification
+        if self._shm is None or self._shm.name != name:
+            try:
+                self._attach(name)
+            except FileNotFoundError:
+                # Engine outgrew that buffer and unlinked it; The frame is
+                # stale, a notification for the new buffer follows
+                return None
+        if self._frame_nos[slot] != frame_no:
+            return None
+        frame = _slot_array(self._shm, self._slots, self._capacity,
+                            slot, shape)
+        frame.flags.writeable = False
+        return frame
+
+    def valid(self, notification:tuple):
+        """
+        True if the slot still holds the frame of the notification
+        """
+        _, slot, frame_no, _ = notification
+        return self._frame_nos is not None and \
+               self._frame_nos[slot] == frame_no
+
+    def close(self):
+        if self._shm is not None:
+            self._frame_nos = None
+            _close_shm(self._shm)
+            self._shm = None
+
+
+def _header_size(slots):
+    return 8 * (slots+1)
+
+def _slot_array(shm, slots, capacity, slot, shape):
+    return np.ndarray(shape, dtype=np.uint8, buffer=shm.buf,
+                      offset=_header_size(slots) + slot*capacity)
+
+def _close_shm(shm):
+    try:
+        shm.close()
+    except BufferError:
+        # Some frame views are still alive; the mapping is released
+        # when they are garbage collected
+        pass
@@ -0,0 +1,113 @@
+import numpy as np
+from collections import deque
+from .common.constants import *
+from .layer import SparseLayer
+from .packed import PackedMask, PackedLabels
+
+class History():
+    """
+    Undo and redo stacks of edits.
+
+    An edit is any object with an nbytes attribute; History only keeps
+    them, Engine applies them. When the edits take more than max_bytes,
+    the oldest ones are dropped first.
+    """
+    def __init__(self, max_bytes:int=HISTORY_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._undo = deque()
+        self._redo = deque()
+        self.nbytes = 0
+
+    def record(self, edit):
+        """
+        Keep a new edit; Edits that were undone cannot be redone anymore
+        """
+        while self._redo:
+            self.nbytes -= self._redo.pop().nbytes
+        self._undo.append(edit)
+        self.nbytes += edit.nbytes
+        self._evict()
+
+    def undo(self):
+        """
+        Returns the edit to revert, or None if there is none
+        """
+        if not self._undo:
+            return None
+        edit = self._undo.pop()
+        self._redo.append(edit)
+        return edit
+
+    def redo(self):
+        """
+        Returns the edit to apply again, or None if there is none
+        """
+        if not self._redo:
+            return None
+        edit = self._redo.pop()
+        self._undo.append(edit)
+        return edit
+
+    def clear(self):
+        self._undo.clear()
+        self._redo.clear()
+        self.nbytes = 0
+
+    def __len__(self):
+        return len(self._undo) + len(self._redo)
+
+    def _evict(self):
+        # Oldest first: bottom of the undo stack, then the far end of redo
+        while self.nbytes > self.max_bytes and self._undo:
+            self.nbytes -= self._undo.popleft().nbytes
+        while self.nbytes > self.max_bytes and self._redo:
+            self.nbytes -= self._redo.popleft().nbytes
+
+
+class MaskDelta():
+    """
+    Manual edits of a region of the mask: (PackedLabels, PackedMask) of
+    labels and cover of the edit overlay in the box, before and after
+    """
+    def __init__(self, box:tuple, before:tuple, after:tuple):
+        self.box = box
+        self.before = before
+        self.after = after
+        self.nbytes = sum(a.nbytes for a in before + after)
+
+
+class FillDelta():
+    """
+    Filled cell of a clip, before and after.
+    Each is None, or (box, PackedMask of the box, pixel count).
+    """
+    def __init__(self, before, after):
+        self.before = before
+        self.after = after
+        self.nbytes = sum(s[1].nbytes for s in (before, after)
+                          if s is not None)
+
+
+class SlideDelta():
+    """
+    Results kept for the slide (boxes, cell counts, clipped masks and
+    images), before and after. Each is a tuple of lists.
+    """
+    def __init__(self, before:tuple, after:tuple):
+        self.before = before
+        self.after = after
+        # Arrays in both states are alive anyway;
+        # The others are only kept alive by the history
+        old = {id(a):a for a in _arrays(before)}
+        new = {id(a):a for a in _arrays(after)}
+        self.nbytes = sum(a.nbytes for i, a in {**old, **new}.items()
+                          if (i in old) != (i in new))
+
+
+def _arrays(items):
+    for item in items:
+        if isinstance(item, (tuple, list)):
+            yield from _arrays(item)
+        elif isinstance(item, (np.ndarray, SparseLayer, PackedMask,
+                               PackedLabels)):
+            yield item
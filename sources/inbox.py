@@ -0,0 +1,44 @@
+import time
+import queue
+
+class Inbox():
+    """
+    Queue of messages to Engine, stamped with the time they were sent.
+
+    Console, Viewer and Engine's own worker threads all send to the same
+    Queue, so Engine can sleep on it until anything happens.
+    Each process wraps the Queue it was given; put() can be used like
+    Queue.put().
+    """
+    def __init__(self, q):
+        """
+        Arguments:
+        q : multiprocessing Queue shared by every sender and Engine
+        """
+        self._queue = q
+
+    def put(self, message:dict):
+        # Wall clock, because monotonic clocks may not be shared by processes
+        self._queue.put((time.time(), message))
+
+    def receive(self, timeout:float=None):
+        """
+        Wait until a message arrives, then take every pending message.
+
+        Arguments:
+        timeout : Seconds to wait; None waits forever
+
+        Returns list of (time sent, message); Empty if timed out.
+        Time sent is None if the message was put into the Queue directly.
+        """
+        try:
+            messages = [self._queue.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        while True:
+            try:
+                messages.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return [m if isinstance(m, tuple) else (None, m) for m in messages]
+
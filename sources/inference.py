@@ -0,0 +1,233 @@
+import numpy as np
+import tensorflow as tf
+from skimage.transform import resize
+from .common.constants import *
+from .model_loader import get_model
+from .prob_cache import ProbCache
+
+class Predictor():
+    """
+    Compiled and batched inference of a mask model.
+
+    The model is traced once by tf.function with a fixed input signature,
+    so calls do not go through eager Python dispatch of every layer.
+    """
+    def __init__(self, model_name:str=MASK_MODEL,
+                 batch_size:int=DEFAULT_BATCH_SIZE, tiled:bool=False,
+                 tile_size:int=DEFAULT_TILE_SIZE,
+                 tile_overlap:int=DEFAULT_TILE_OVERLAP,
+                 tile_scale:float=DEFAULT_TILE_SCALE,
+                 cache_dir:str=PROB_CACHE_DIR,
+                 cache_max_bytes:int=PROB_CACHE_MAX_BYTES):
+        """
+        Arguments:
+        model_name : Name of the model function, passed to get_model
+        batch_size : Maximum number of tiles given to the model at once
+        tiled : If True, predict overlapping tiles of the image instead of
+                the whole image resized to the model input
+        tile_size : Size of a tile in the scaled image
+        tile_overlap : Pixels shared by neighbouring tiles
+        tile_scale : Scale of the image before cutting tiles (1 = as is)
+        cache_dir : Directory to cache probability maps, None to disable
+        cache_max_bytes : Size limit of the cache directory
+        """
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.tiled = tiled
+        self.tile_size = tile_size
+        self.tile_overlap = tile_overlap
+        self.tile_scale = tile_scale
+        self._cache = None
+        if cache_dir is not None:
+            self._cache = ProbCache(cache_dir, cache_max_bytes)
+        self._model = get_model(model_name)
+        logits = self._model.logits
+        @tf.function(input_signature=[
+            tf.TensorSpec((None,)+MODEL_INPUT_SIZE+(3,), tf.float32)])
+        def infer(tiles):
+            return tf.math.sigmoid(logits(tiles, training=False))
+        self._infer = infer
+
+    def predict_tiles(self, tiles:np.array, progress=None):
+        """
+        tiles : (N, 200, 200, 3) float32 array
+        progress : function(fraction) called after every batch.
+                   It may raise an exception to stop predicting.
+        Returns (N, 200, 200) probability array
+        """
+        probs = np.empty(tiles.shape[:3], dtype=np.float32)
+        for i in range(0, len(tiles), self.batch_size):
+            batch = tf.constant(tiles[i:i+self.batch_size], dtype=tf.float32)
+            probs[i:i+self.batch_size] = self._infer(batch).numpy()
+            if progress is not None:
+                progress(min(1.0, (i+self.batch_size) / len(tiles)))
+        return probs
+
+    def predict(self, image:np.array, progress=None):
+        """
+        image : (Width, Height, 3) uint8 array
+        progress : See predict_tiles
+        Returns (Width, Height) probability array
+        """
+        return self.predict_batch([image], progress)[0]
+
+    def predict_batch(self, images:list, progress=None):
+        """
+        images : list of (Width, Height, 3) uint8 arrays, any size
+        progress : See predict_tiles
+        Returns list of (Width, Height) probability arrays, one per image
+        """
+        if len(images) == 0:
+            return []
+        if self._cache is None:
+            return self._predict_uncached(images, progress)
+        keys = [self._cache.key(image, self.settings) for image in images]
+        probs = [self._cache.get(key) for key in keys]
+        missing = [i for i, prob in enumerate(probs) if prob is None]
+        predicted = self._predict_uncached([images[i] for i in missing],
+                                           progress)
+        for i, prob in zip(missing, predicted):
+            probs[i] = self._cache.put(keys[i], prob)
+        return probs
+
+    @property
+    def settings(self):
+        """
+        Everything other than the image that changes the prediction
+        """
+        settings = f'{self.model_name}|{MODEL_INPUT_SIZE}'
+        if self.tiled:
+            settings += f'|tiled|{self.tile_size}|{self.tile_overlap}'\
+                        f'|{self.tile_scale}'
+        return settings
+
+    def _predict_uncached(self, images:list, progress=None):
+        if len(images) == 0:
+            return []
+        if self.tiled:
+            return self._predict_tiled(images, progress)
+        tiles = np.stack([preprocess(image) for image in images])
+        probs = self.predict_tiles(tiles, progress)
+        return [postprocess(prob, image.shape)
+                for prob, image in zip(probs, images)]
+
+    def _predict_tiled(self, images:list, progress=None):
+        """
+        Tiles of all images are predicted together, then blended per image
+        """
+        plans = [TilePlan(image.shape, self.tile_size, self.tile_overlap,
+                          self.tile_scale) for image in images]
+        tiles = np.concatenate([plan.cut(image)
+                                for plan, image in zip(plans, images)])
+        if self.tile_size != MODEL_INPUT_SIZE[0]:
+            tiles = np.stack([preprocess(tile) for tile in tiles])
+        probs = self.predict_tiles(tiles, progress)
+        results = []
+        start = 0
+        for plan in plans:
+            results.append(plan.blend(probs[start:start+len(plan)]))
+            start += len(plan)
+        return results
+
+
+class TilePlan():
+    """
+    Where to cut overlapping square tiles of an image,
+    and how to blend the predicted tiles back.
+    """
+    def __init__(self, shape:tuple, tile_size:int, overlap:int,
+                 scale:float=1.0):
+        """
+        Arguments:
+        shape : Shape of the original image
+        tile_size : Size of a tile in the scaled image
+        overlap : Pixels shared by neighbouring tiles, less than tile_size
+        scale : Scale of the image before cutting tiles
+        """
+        if not 0 <= overlap < tile_size:
+            raise ValueError('Overlap should be smaller than tile size')
+        self.shape = shape[:2]
+        self.scaled_shape = tuple(max(1, round(l*scale)) for l in self.shape)
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self._starts = [_tile_starts(l, tile_size, overlap)
+                        for l in self.scaled_shape]
+        # Tiles are weighted less near their borders, so seams fade out
+        ramp = _ramp(tile_size, overlap)
+        self._weight = ramp[:,np.newaxis] * ramp[np.newaxis,:]
+
+    def __len__(self):
+        return len(self._starts[0]) * len(self._starts[1])
+
+    def _positions(self):
+        for x in self._starts[0]:
+            for y in self._starts[1]:
+                yield x, y
+
+    def cut(self, image:np.array):
+        """
+        Returns (N, tile_size, tile_size, 3) float32 tiles
+        """
+        if self.scaled_shape != self.shape:
+            image = resize(image, self.scaled_shape, preserve_range=True,
+                           anti_aliasing=True)
+        # Images smaller than a tile are padded
+        pad = [(0, max(0, self.tile_size-l)) for l in self.scaled_shape]
+        image = np.pad(image, pad+[(0,0)], mode='edge')
+        t = self.tile_size
+        return np.stack([image[x:x+t, y:y+t] for x, y in self._positions()]
+                        ).astype(np.float32)
+
+    def blend(self, probs:np.array):
+        """
+        probs : (N, h, w) predicted tiles, resized to tile_size if needed
+        Returns (Width, Height) probability array of the original image
+        """
+        t = self.tile_size
+        padded = tuple(max(l, t) for l in self.scaled_shape)
+        total = np.zeros(padded, dtype=np.float32)
+        weight = np.zeros(padded, dtype=np.float32)
+        for prob, (x, y) in zip(probs, self._positions()):
+            if prob.shape != (t, t):
+                prob = resize(prob, (t, t), preserve_range=True)
+            total[x:x+t, y:y+t] += prob * self._weight
+            weight[x:x+t, y:y+t] += self._weight
+        prob = total / weight
+        prob = prob[:self.scaled_shape[0], :self.scaled_shape[1]]
+        if self.scaled_shape != self.shape:
+            prob = resize(prob, self.shape, preserve_range=True,
+                          anti_aliasing=True)
+        return prob
+
+
+def preprocess(image:np.array):
+    """
+    Resize an image to the model input
+    """
+    return resize(image, MODEL_INPUT_SIZE, preserve_range=True,
+                  anti_aliasing=True).astype(np.float32)
+
+def postprocess(prob:np.array, shape:tuple):
+    """
+    Resize model output back to the image
+    """
+    return resize(prob, shape[:2], preserve_range=True, anti_aliasing=True)
+
+def _tile_starts(length:int, tile_size:int, overlap:int):
+    """
+    Start positions of tiles covering length; The last tile ends at length
+    """
+    if length <= tile_size:
+        return [0]
+    stride = tile_size - overlap
+    starts = list(range(0, length-tile_size, stride))
+    starts.append(length-tile_size)
+    return starts
+
+def _ramp(tile_size:int, overlap:int):
+    """
+    1 in the middle, falling linearly to 1/(overlap+1) at both ends
+    """
+    i = np.arange(tile_size)
+    edge = np.minimum(i+1, tile_size-i)
+    return np.minimum(edge, overlap+1).astype(np.float32) / (overlap+1)
@@ -0,0 +1,136 @@
+import numpy as np
+from .brush import stroke, stroke_box, union
+from .compositor import paint
+
+# Box of a layer with nothing drawn
+_EMPTY = (slice(0,0), slice(0,0))
+
+class SparseLayer():
+    """
+    Bool mask of a whole image, of which only the crop around what is
+    drawn is kept. Memory and the cost of drawing it on a frame depend on
+    what is drawn, not on the size of the image.
+
+    box : (slice, slice) of the crop in the image
+    mask : (Width, Height, 1) bool array of the crop
+    """
+    def __init__(self, shape:tuple, box:tuple=None, mask:np.array=None):
+        """
+        Arguments:
+        shape : Shape of the image; Only (Width, Height) is used
+        box, mask : Initial crop; Empty if None
+        """
+        self.shape = tuple(shape[:2])
+        if box is None:
+            box = _EMPTY
+            mask = np.zeros((0,0,1), dtype=bool)
+        self.box = box
+        self.mask = mask
+
+    @property
+    def nbytes(self):
+        return self.mask.nbytes
+
+    def empty(self):
+        return self.mask.size == 0
+
+    def grow(self, box:tuple):
+        """
+        Make the crop cover box too; box is clipped to the image
+        """
+        box = self._clip(box)
+        if box is None:
+            return
+        outer = box if self.empty() else union(self.box, box)
+        if outer == self.box:
+            return
+        mask = np.zeros((outer[0].stop - outer[0].start,
+                         outer[1].stop - outer[1].start, 1), dtype=bool)
+        if not self.empty():
+            mask[self._local(self.box, outer)] = self.mask
+        self.box = outer
+        self.mask = mask
+
+    def fill(self, box:tuple):
+        """
+        Set a rectangle True; box is clipped to the image
+        """
+        box = self._clip(box)
+        if box is None:
+            return
+        self.grow(box)
+        self.mask[self._local(box, self.box)] = True
+
+    def fill_points(self, rows:np.array, cols:np.array):
+        """
+        Set pixels True; Those outside the image are skipped
+        """
+        inside = (rows >= 0) & (rows < self.shape[0]) & \
+                 (cols >= 0) & (cols < self.shape[1])
+        rows, cols = rows[inside], cols[inside]
+        if len(rows) == 0:
+            return
+        self.grow((slice(rows.min(), rows.max()+1),
+                   slice(cols.min(), cols.max()+1)))
+        self.mask[rows - self.box[0].start, cols - self.box[1].start] = True
+
+    def stroke(self, points:list, radius:float):
+        """
+        Draw a thick polyline; See brush.stroke
+        """
+        box = stroke_box(points, radius, self.shape)
+        if box is None:
+            return
+        self.grow(box)
+        origin = (self.box[0].start, self.box[1].start)
+        stroke(self.mask, np.subtract(points, origin), radius)
+
+    def paint_on(self, array:np.array, color):
+        """
+        Paint color on a whole-image array where the layer is True
+        """
+        if not self.empty():
+            paint(array[self.box], color, self.mask)
+
+    def cover(self, cover:np.array):
+        """
+        OR the layer into a whole-image bool array
+        """
+        if not self.empty():
+            region = cover[self.box]
+            np.logical_or(region, self.mask, out=region)
+
+    def dense(self):
+        """
+        Returns the layer as a (Width, Height, 1) bool array of the image
+        """
+        layer = np.zeros(self.shape + (1,), dtype=bool)
+        layer[self.box] = self.mask
+        return layer
+
+    def _clip(self, box):
+        starts = [max(s.start, 0) for s in box]
+        stops = [min(s.stop, n) for s, n in zip(box, self.shape)]
+        if any(stop <= start for start, stop in zip(starts, stops)):
+            return None
+        return tuple(slice(int(a), int(b)) for a, b in zip(starts, stops))
+
+    @staticmethod
+    def _local(box, outer):
+        """
+        box inside outer, in coordinates of outer
+        """
+        return tuple(slice(s.start - o.start, s.stop - o.start)
+                     for s, o in zip(box, outer))
+
+
+def union_box(layers:list):
+    """
+    (slice, slice) around the boxes of (label, SparseLayer) layers,
+    or None if nothing is drawn
+    """
+    box = None
+    for _, m in layers:
+        if not m.empty():
+            box = m.box if box is None else union(box, m.box)
+    return box
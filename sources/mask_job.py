@@ -0,0 +1,95 @@
+import threading
+import queue
+
+class JobCancelled(Exception):
+    pass
+
+
+class MaskJob():
+    """
+    Handle of a probability map being computed by MaskWorker
+    """
+    def __init__(self, key, image):
+        """
+        Arguments:
+        key : Anything that tells which image (and clip) this is for
+        image : (Width, Height, 3) array to predict
+        """
+        self.key = key
+        self.image = image
+        self.progress = 0.0
+        self.result = None
+        self.error = None
+        self._cancelled = threading.Event()
+        self._done = threading.Event()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    def cancel(self):
+        """
+        Stop as soon as possible; A cancelled job never has a result
+        """
+        self._cancelled.set()
+
+    def report(self, progress:float):
+        """
+        Called by the worker between steps.
+        Raises JobCancelled if the job was cancelled.
+        """
+        if self.cancelled:
+            raise JobCancelled
+        self.progress = progress
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+    def _finish(self, result=None, error=None):
+        self.result = result
+        self.error = error
+        self.progress = 1.0
+        self._done.set()
+
+
+class MaskWorker():
+    """
+    Thread that runs MaskJobs one at a time, in the order submitted
+    """
+    def __init__(self, predict, on_done=None):
+        """
+        Arguments:
+        predict : function(image, progress) -> probability map,
+                  that calls progress(fraction) between steps
+        on_done : function(job) called from the worker thread
+                  when a job is finished or cancelled
+        """
+        self._predict = predict
+        self._on_done = on_done
+        self._jobs = queue.Queue()
+        self._thread = threading.Thread(target=self._work, daemon=True)
+        self._thread.start()
+
+    def submit(self, key, image):
+        job = MaskJob(key, image)
+        self._jobs.put(job)
+        return job
+
+    def _work(self):
+        while True:
+            job = self._jobs.get()
+            if not job.cancelled:
+                try:
+                    job._finish(self._predict(job.image, job.report))
+                except JobCancelled:
+                    job._finish()
+                except Exception as e:
+                    job._finish(error=e)
+            else:
+                job._finish()
+            if self._on_done is not None:
+                self._on_done(job)
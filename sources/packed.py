@@ -0,0 +1,130 @@
+import numpy as np
+
+# Number of set bits of each byte
+_BIT_COUNT = np.unpackbits(np.arange(256, dtype=np.uint8)[:,np.newaxis],
+                           axis=1).sum(axis=1)
+
+class PackedMask():
+    """
+    Bool array kept as bits, 8 pixels a byte.
+
+    Each row (first axis) is packed on its own, so that area and bounding
+    box are found from the packed bytes without unpacking the array.
+    """
+    def __init__(self, array:np.array):
+        """
+        Arguments:
+        array : bool array of 2 or more dimensions, e.g. (Width, Height, 1)
+        """
+        array = np.asarray(array, dtype=bool)
+        self.shape = array.shape
+        row = int(np.prod(self.shape[1:]))
+        self.bits = np.packbits(array.reshape(self.shape[0], row), axis=1)
+
+    @classmethod
+    def from_bits(cls, shape:tuple, bits:np.array):
+        """
+        PackedMask of bits from another one with this shape
+        """
+        packed = cls.__new__(cls)
+        packed.shape = tuple(shape)
+        packed.bits = bits
+        return packed
+
+    @property
+    def nbytes(self):
+        return self.bits.nbytes
+
+    def unpack(self):
+        """
+        Returns a new bool array of the original shape
+        """
+        row = int(np.prod(self.shape[1:]))
+        return np.unpackbits(self.bits, axis=1, count=row)\
+                 .view(bool).reshape(self.shape)
+
+    def __array__(self, dtype=None, copy=None):
+        array = self.unpack()
+        return array if dtype is None else array.astype(dtype)
+
+    def area(self):
+        """
+        Number of True pixels
+        """
+        return int(_BIT_COUNT[self.bits].sum())
+
+    def bounding_box(self):
+        """
+        Returns (slice, slice) around True pixels of the first two axes,
+        or None if there is none
+        """
+        rows = np.flatnonzero(self.bits.any(axis=1))
+        if len(rows) == 0:
+            return None
+        # Only one packed row is unpacked
+        row = np.bitwise_or.reduce(self.bits[rows[0]:rows[-1]+1], axis=0)
+        width = int(np.prod(self.shape[2:]))
+        cols = np.unpackbits(row, count=self.shape[1]*width)\
+                 .reshape(self.shape[1], width).any(axis=1)
+        cols = np.flatnonzero(cols)
+        return (slice(int(rows[0]), int(rows[-1])+1),
+                slice(int(cols[0]), int(cols[-1])+1))
+
+
+class PackedLabels():
+    """
+    uint8 label array kept as one PackedMask per label in it, except 0.
+    A mask of a few labels takes a few bits a pixel.
+    """
+    def __init__(self, labels:np.array):
+        """
+        Arguments:
+        labels : uint8 array, e.g. (Width, Height, 1)
+        """
+        labels = np.asarray(labels, dtype=np.uint8)
+        self.shape = labels.shape
+        present = np.flatnonzero(np.bincount(labels.ravel(), minlength=256))
+        self.planes = {int(label):PackedMask(labels == label)
+                       for label in present if label != 0}
+
+    @classmethod
+    def from_planes(cls, shape:tuple, planes:dict):
+        """
+        PackedLabels of {label:PackedMask} of this shape
+        """
+        packed = cls.__new__(cls)
+        packed.shape = tuple(shape)
+        packed.planes = dict(planes)
+        return packed
+
+    @property
+    def nbytes(self):
+        return sum(plane.nbytes for plane in self.planes.values())
+
+    def unpack(self):
+        """
+        Returns a new uint8 array of the original shape
+        """
+        labels = np.zeros(self.shape, dtype=np.uint8)
+        for label, plane in self.planes.items():
+            labels[plane.unpack()] = label
+        return labels
+
+    def __array__(self, dtype=None, copy=None):
+        labels = self.unpack()
+        return labels if dtype is None else labels.astype(dtype)
+
+    def area(self, label:int):
+        """
+        Number of pixels of a label other than 0
+        """
+        plane = self.planes.get(label)
+        return 0 if plane is None else plane.area()
+
+    def bounding_box(self, label:int):
+        """
+        Returns (slice, slice) around pixels of a label other than 0,
+        or None if there is none
+        """
+        plane = self.planes.get(label)
+        return None if plane is None else plane.bounding_box()
@@ -0,0 +1,98 @@
+import threading
+from collections import OrderedDict
+from .common.constants import *
+
+class Prefetcher():
+    """
+    Background thread that loads images, and optionally computes their
+    probability maps, before they are asked for.
+
+    Results are kept in a bounded cache, least recently used first out.
+    """
+    def __init__(self, load, predict=None, capacity:int=PREFETCH_CACHE_SIZE):
+        """
+        Arguments:
+        load : function(path) -> image
+        predict : function(image) -> probability map, None to only load
+        capacity : Maximum number of images in the cache
+        """
+        self._load = load
+        self._predict = predict
+        self._capacity = capacity
+        # path -> [image, probability map or None]
+        self._cache = OrderedDict()
+        self._wanted = []
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._work, daemon=True)
+        self._thread.start()
+
+    def request(self, paths:list):
+        """
+        Prefetch paths in order. Replaces previous requests.
+        """
+        with self._cond:
+            self._wanted = list(paths)
+            self._cond.notify()
+
+    def get(self, path:str):
+        """
+        Returns (image, probability map or None), or None if not cached
+        """
+        with self._cond:
+            if path not in self._cache:
+                return None
+            self._cache.move_to_end(path)
+            return tuple(self._cache[path])
+
+    def put(self, path:str, image, prob=None):
+        """
+        Keep an image that was loaded elsewhere.
+        If image is None, prob is only kept if the path is still cached.
+        """
+        with self._cond:
+            self._store(path, image, prob)
+
+    def _store(self, path, image, prob):
+        if path in self._cache:
+            entry = self._cache[path]
+            entry[1] = prob if prob is not None else entry[1]
+            self._cache.move_to_end(path)
+        elif image is not None:
+            self._cache[path] = [image, prob]
+        while len(self._cache) > self._capacity:
+            self._cache.popitem(last=False)
+
+    def _next_job(self):
+        """
+        First wanted path that is not completely cached
+        """
+        while len(self._wanted) > 0:
+            path = self._wanted[0]
+            entry = self._cache.get(path)
+            if entry is None or (self._predict is not None and
+                                 entry[1] is None):
+                return path, entry
+            self._wanted.pop(0)
+        return None, None
+
+    def _work(self):
+        while True:
+            with self._cond:
+                path, entry = self._next_job()
+                while path is None:
+                    self._cond.wait()
+                    path, entry = self._next_job()
+            try:
+                image = self._load(path) if entry is None else entry[0]
+                prob = None
+                if self._predict is not None:
+                    prob = self._predict(image)
+            except Exception:
+                # Left as a cache miss; The image is loaded again, in the
+                # Engine loop, if it is opened
+                with self._cond:
+                    if path in self._wanted:
+                        self._wanted.remove(path)
+                continue
+            with self._cond:
+                self._store(path, image, prob)
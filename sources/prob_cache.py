@@ -0,0 +1,95 @@
+import os
+import hashlib
+import tempfile
+import numpy as np
+from .common.constants import *
+
+class ProbCache():
+    """
+    Probability maps saved on disk, so the same image is never predicted
+    twice with the same model and settings.
+
+    Maps are quantized to uint8 and compressed. When the cache grows over
+    max_bytes, least recently used files are removed first.
+    """
+    def __init__(self, directory:str=PROB_CACHE_DIR,
+                 max_bytes:int=PROB_CACHE_MAX_BYTES):
+        self._dir = directory
+        self._max_bytes = max_bytes
+        os.makedirs(self._dir, exist_ok=True)
+
+    def key(self, image:np.array, settings:str):
+        """
+        Hash of image pixels and everything else that changes the prediction
+        """
+        h = hashlib.blake2b(digest_size=20)
+        h.update(f'{settings}|{image.shape}|{image.dtype}'.encode())
+        h.update(np.ascontiguousarray(image).data)
+        return h.hexdigest()
+
+    def _path(self, key:str):
+        return os.path.join(self._dir, key + '.npz')
+
+    def get(self, key:str):
+        """
+        Returns float32 probability map, or None if not cached
+        """
+        path = self._path(key)
+        try:
+            with np.load(path) as data:
+                prob = dequantize(data['prob'])
+            # Mark as recently used
+            os.utime(path)
+        except (OSError, KeyError, ValueError):
+            return None
+        return prob
+
+    def put(self, key:str, prob:np.array):
+        """
+        Returns the probability map as it will be read from the cache
+        """
+        quantized = quantize(prob)
+        # Write to a temporary file first, so that other processes never
+        # read a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=self._dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez_compressed(f, prob=quantized)
+            os.replace(tmp_path, self._path(key))
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self.evict()
+        return dequantize(quantized)
+
+    def evict(self):
+        """
+        Remove least recently used files until under max_bytes
+        """
+        entries = []
+        total = 0
+        for f in os.listdir(self._dir):
+            if not f.endswith('.npz'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self._dir, f))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, f))
+            total += stat.st_size
+        entries.sort()
+        for _, size, f in entries:
+            if total <= self._max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self._dir, f))
+            except OSError:
+                pass
+            total -= size
+
+
+def quantize(prob:np.array):
+    return np.round(np.clip(prob, 0, 1) * 255).astype(np.uint8)
+
+def dequantize(quantized:np.array):
+    return quantized.astype(np.float32) / 255
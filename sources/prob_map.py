@@ -0,0 +1,55 @@
+import numpy as np
+from .prob_cache import quantize
+
+class ProbMap():
+    """
+    Cell probability quantized to 256 levels, with its histogram.
+
+    A threshold only compares uint8s, and the share of pixels over a
+    threshold is known without looking at the pixels.
+    """
+    def __init__(self, prob:np.array, histogram:np.array=None):
+        """
+        Arguments:
+        prob : (Width, Height) float probability (0~1),
+               or uint8 levels (0~255)
+        histogram : Of the levels, if known; Counted if None
+        """
+        if prob.dtype == np.uint8:
+            self.levels = prob
+        else:
+            self.levels = quantize(prob)
+        if histogram is None:
+            histogram = np.bincount(self.levels.ravel(), minlength=256)
+        self.histogram = np.asarray(histogram)
+
+    @property
+    def shape(self):
+        return self.levels.shape
+
+    def __getitem__(self, box):
+        """
+        ProbMap of a part, e.g. prob_map[r0:r1, c0:c1]
+        """
+        return ProbMap(self.levels[box])
+
+    def cells(self, ratio:float):
+        """
+        Bool array (Width, Height) of pixels over the threshold
+
+        ratio : Threshold of cell probability in percent (0~100)
+        """
+        return self.levels > _level(ratio)
+
+    def coverage(self, ratio:float):
+        """
+        Share (0~1) of pixels over the threshold
+        """
+        if self.levels.size == 0:
+            return 0.0
+        return float(self.histogram[_level(ratio)+1:].sum() / self.levels.size)
+
+
+def _level(ratio):
+    # probability > ratio/100, on the quantized scale
+    return int(np.clip(np.floor(ratio / 100 * 255), 0, 255))
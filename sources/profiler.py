@@ -0,0 +1,212 @@
+import os
+import json
+import time
+import numpy as np
+from contextlib import nullcontext
+from .common import constants
+from .common.constants import *
+
+# Returned by span() when disabled
+_NULL = nullcontext()
+
+class Profiler():
+    """
+    Where time goes in one process: durations of spans, and samples of
+    counters such as queue depths.
+
+    When disabled, span() returns a shared no-op context and the other
+    methods return at once, so they can stay in hot paths.
+    """
+    def __init__(self, process:str, enabled:bool=False, trace_dir:str=None):
+        """
+        Arguments:
+        process : Name of the process, used in the report and trace file
+        enabled : Collect anything at all
+        trace_dir : Also keep every span and sample, and write them to a
+                    trace file in this directory on close(); Implies enabled
+        """
+        self.process = process
+        self.enabled = enabled or trace_dir is not None
+        self.trace_dir = trace_dir
+        # {name : [seconds, ...]}
+        self._durations = {}
+        # {name : [count, total, max]}
+        self._samples = {}
+        self._events = [] if trace_dir is not None else None
+        # Durations are measured with perf_counter, but placed on the
+        # wall clock so traces of processes line up
+        self._perf0 = time.perf_counter()
+        self._wall0 = time.time()
+
+    def span(self, name:str):
+        """
+        Context that records how long its block took
+        """
+        if not self.enabled:
+            return _NULL
+        return _Span(self, name)
+
+    def record(self, name:str, start:float, seconds:float):
+        """
+        Arguments:
+        start : time.time() when it started
+        seconds : How long it took
+        """
+        if not self.enabled:
+            return
+        self._durations.setdefault(name, []).append(seconds)
+        if self._events is not None and len(self._events) < TRACE_MAX_EVENTS:
+            self._events.append({'name':name, 'ph':'X', 'ts':start*1e6,
+                                 'dur':seconds*1e6, 'pid':os.getpid(),
+                                 'tid':0})
+
+    def sample(self, name:str, value:float):
+        """
+        Record a value of a counter, e.g. depth of a queue
+        """
+        if not self.enabled:
+            return
+        stats = self._samples.setdefault(name, [0, 0, value])
+        stats[0] += 1
+        stats[1] += value
+        stats[2] = max(stats[2], value)
+        if self._events is not None and len(self._events) < TRACE_MAX_EVENTS:
+            self._events.append({'name':name, 'ph':'C', 'ts':time.time()*1e6,
+                                 'pid':os.getpid(), 'args':{name:value}})
+
+    def wall(self, perf:float):
+        """
+        time.time() at a time.perf_counter() value
+        """
+        return self._wall0 + (perf - self._perf0)
+
+    def report(self):
+        """
+        Returns tables of spans in milliseconds, and of counters
+        """
+        lines = [f'{self.process} profile',
+                 f'{"span":<28} {"count":>7} {"total":>9} {"mean":>8} '
+                 f'{"p50":>8} {"p99":>8} {"max":>8}']
+        for name, times in sorted(self._durations.items(),
+                                  key=lambda item: -sum(item[1])):
+            times = np.asarray(times) * 1000
+            p50, p99 = np.percentile(times, [50, 99])
+            lines.append(f'{name:<28} {len(times):>7} {times.sum():>9.1f} '
+                         f'{times.mean():>8.2f} {p50:>8.2f} {p99:>8.2f} '
+                         f'{times.max():>8.2f}')
+        if self._samples:
+            lines.append(f'{"counter":<28} {"count":>7} {"total":>9} '
+                         f'{"mean":>8} {"max":>8}')
+            for name, (n, total, max_value) in sorted(self._samples.items()):
+                lines.append(f'{name:<28} {n:>7} {total:>9g} '
+                             f'{total/n:>8.2f} {max_value:>8g}')
+        return '\n'.join(lines)
+
+    def close(self):
+        """
+        Print the report and write the trace file, if enabled
+        """
+        if not self.enabled:
+            return
+        print(self.report())
+        if self.trace_dir is None:
+            return
+        os.makedirs(self.trace_dir, exist_ok=True)
+        path = os.path.join(self.trace_dir,
+                            f'{self.process}-{os.getpid()}.json')
+        # Chrome trace event format; Open with chrome://tracing or Perfetto
+        meta = {'name':'process_name', 'ph':'M', 'pid':os.getpid(),
+                'args':{'name':self.process}}
+        with open(path, 'w') as f:
+            json.dump({'traceEvents':[meta] + self._events}, f)
+        print(f'Trace written to {path}')
+
+
+class _Span():
+    def __init__(self, profiler, name):
+        self._profiler = profiler
+        self._name = name
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter()
+        self._profiler.record(self._name, self._profiler.wall(self._start),
+                              end - self._start)
+        return False
+
+
+class TimedQueue():
+    """
+    Queue whose put() and get() are timed, and whose depth is sampled
+    after put(). Anything else is passed to the Queue.
+    """
+    def __init__(self, q, profiler:Profiler, name:str):
+        self._queue = q
+        self._profiler = profiler
+        self._name = name
+        # qsize() is not implemented on macOS
+        self._sized = True
+
+    def put(self, *args, **kwargs):
+        start = time.perf_counter()
+        self._queue.put(*args, **kwargs)
+        end = time.perf_counter()
+        self._profiler.record(f'{self._name}.put', self._profiler.wall(start),
+                              end - start)
+        if self._sized:
+            try:
+                self._profiler.sample(f'{self._name} depth',
+                                      self._queue.qsize())
+            except NotImplementedError:
+                self._sized = False
+
+    def get(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return self._queue.get(*args, **kwargs)
+        finally:
+            end = time.perf_counter()
+            self._profiler.record(f'{self._name}.get',
+                                  self._profiler.wall(start), end - start)
+
+    def __getattr__(self, name):
+        return getattr(self._queue, name)
+
+
+def timed(q, profiler:Profiler, name:str):
+    """
+    The queue wrapped in TimedQueue if profiler is enabled, else as is
+    """
+    if profiler.enabled:
+        return TimedQueue(q, profiler, name)
+    return q
+
+def message_name(key):
+    """
+    Name of the constant of a message type, e.g. 'MOUSEDOWN'
+    """
+    return _NAMES.get(key, str(key))
+
+# Constants that are message types, in the order of constants.py
+_MESSAGES = ('NEWIMAGE', 'NEWMASK', 'PREFETCH', 'MASK_PROGRESS', 'MASK_DONE',
+             'MASK_STATS', 'SAVE_DONE',
+             'MODE_MASK', 'MODE_IMAGE', 'MODE_NONE', 'MODE_SET_MEM',
+             'MODE_SET_CELL', 'MODE_DRAW_MEM', 'MODE_DRAW_CELL',
+             'MODE_FILL_CELL', 'MODE_FILL_MP_RATIO', 'MODE_DRAW_BOX',
+             'MODE_SHOW_BOX', 'MODE_HIDE_BOX', 'MODE_CANCEL_CLIP',
+             'MODE_CLIP', 'MODE_CONFIRM_CLIP',
+             'SET_MEM', 'SET_CELL', 'SET_RATIO',
+             'DRAW_OFF', 'DRAW_MEM', 'DRAW_CELL', 'DRAW_CANCEL', 'DRAW_BOX',
+             'FILL_CELL', 'FILL_MP_RATIO', 'FILL_LIST', 'FILL_DELETE',
+             'FILL_SAVE', 'FILL_MICRO', 'FILL_EXPORT',
+             'TERMINATE',
+             'MOUSEDOWN', 'MOUSEUP', 'MOUSEPOS', 'MOUSEDOWN_RIGHT',
+             'MOUSEPOS_ON', 'MOUSEPOS_OFF', 'BIG_CURSOR_ON', 'BIG_CURSOR_OFF',
+             'CROSS_CURSOR_ON', 'CROSS_CURSOR_OFF',
+             'MESSAGE_BOX', 'NEW_FRAME',
+             'K_Z', 'K_Y', 'K_ENTER')
+
+_NAMES = {getattr(constants, name):name for name in _MESSAGES}
@@ -0,0 +1,68 @@
+import math
+import numpy as np
+from PIL import Image
+from .common.constants import *
+
+class Pyramid():
+    """
+    Resolutions of one slide:
+
+    native : The file as is. Only its shape is kept; calibration is in its
+             pixels, and areas are scaled to it, so they do not depend on
+             the work size.
+    work : What the AI mask is predicted for, and masks are drawn, filled
+           and thresholded on. The native image, or the native image fit
+           in work_size with its aspect ratio kept.
+    display : What Viewer shows; The work level subsampled by
+              display_step(), so that it fits DISPLAY_SIZE.
+
+    The model input is made from the work level by Predictor.
+    """
+    def __init__(self, native:Image.Image, work_size:tuple=WORK_SIZE):
+        """
+        Arguments:
+        native : RGB image of the slide
+        work_size : (Width, Height) the work level has to fit in;
+                    None to work at native resolution
+        """
+        self.native_shape = native.size + (3,)
+        size = fit_size(native.size, work_size)
+        if size != native.size:
+            native = native.resize(size)
+        # (Width, Height, 3) as everywhere else
+        self.work = np.asarray(native).swapaxes(0,1)
+        # Native pixels per work pixel, along each axis
+        self.scale = (self.native_shape[0] / self.work.shape[0],
+                      self.native_shape[1] / self.work.shape[1])
+
+    @classmethod
+    def open(cls, path:str, work_size:tuple=WORK_SIZE):
+        return cls(Image.open(path).convert('RGB'), work_size)
+
+
+def fit_size(size:tuple, bound:tuple):
+    """
+    Largest size not over bound with the aspect ratio of size;
+    size itself if it fits, or if bound is None
+    """
+    if bound is None or (size[0] <= bound[0] and size[1] <= bound[1]):
+        return tuple(size)
+    ratio = min(bound[0] / size[0], bound[1] / size[1])
+    return (max(1, round(size[0]*ratio)), max(1, round(size[1]*ratio)))
+
+def display_step(shape:tuple, display_size:tuple=DISPLAY_SIZE):
+    """
+    Smallest integer step, so that array[::step, ::step] of an array of
+    shape fits in display_size
+    """
+    return max(1, math.ceil(shape[0] / display_size[0]),
+               math.ceil(shape[1] / display_size[1]))
+
+def parse_size(text:str):
+    """
+    'WIDTHxHEIGHT' to (width, height); 'native' to None
+    """
+    if text.lower() == 'native':
+        return None
+    width, height = text.lower().split('x')
+    return (int(width), int(height))
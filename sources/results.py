@@ -0,0 +1,141 @@
+import os
+import csv
+import time
+import sqlite3
+
+# Columns of exported tables, in order
+COLUMNS = ('session', 'saved_at', 'image', 'area', 'pixels',
+           'mp_pixel', 'mp_micro', 'clip_r0', 'clip_c0', 'clip_r1', 'clip_c1')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id INTEGER PRIMARY KEY,
+    started_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS cells (
+    id INTEGER PRIMARY KEY,
+    session INTEGER NOT NULL REFERENCES sessions(id),
+    saved_at REAL NOT NULL,
+    image TEXT NOT NULL,
+    area REAL NOT NULL,
+    pixels INTEGER NOT NULL,
+    mp_pixel REAL,
+    mp_micro REAL,
+    clip_r0 INTEGER,
+    clip_c0 INTEGER,
+    clip_r1 INTEGER,
+    clip_c1 INTEGER
+);
+CREATE INDEX IF NOT EXISTS cells_image ON cells(image);
+CREATE INDEX IF NOT EXISTS cells_session ON cells(session);
+"""
+
+class ResultStore():
+    """
+    Measured cells, appended to a SQLite database.
+
+    Saving only inserts the new rows, so it does not slow down as results
+    pile up. Spreadsheets are made on demand by export().
+    """
+    def __init__(self, path:str):
+        """
+        Arguments:
+        path : Database file; Created if it does not exist
+        """
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._db = sqlite3.connect(path)
+        self._db.executescript(_SCHEMA)
+        self._session = None
+
+    @property
+    def session(self):
+        """
+        Id of this session; Started on first use
+        """
+        if self._session is None:
+            with self._db:
+                cur = self._db.execute(
+                    'INSERT INTO sessions(started_at) VALUES (?)',
+                    (time.time(),))
+            self._session = cur.lastrowid
+        return self._session
+
+    def add_cells(self, image:str, cells:list, mp_pixel:float=None,
+                  mp_micro:float=None):
+        """
+        Append cells of an image in one transaction
+
+        Arguments:
+        image : Name of the image
+        cells : list of (area, pixel count, clip box); clip box is
+                ((r0, c0), (r1, c1)) or None
+        mp_pixel, mp_micro : Calibration the areas were computed with
+        """
+        session = self.session
+        saved_at = time.time()
+        rows = []
+        for area, pixels, box in cells:
+            (r0, c0), (r1, c1) = box if box is not None else \
+                                 ((None, None), (None, None))
+            rows.append((session, saved_at, image, float(area), int(pixels),
+                         mp_pixel, mp_micro, r0, c0, r1, c1))
+        with self._db:
+            self._db.executemany(
+                'INSERT INTO cells(session, saved_at, image, area, pixels, '
+                'mp_pixel, mp_micro, clip_r0, clip_c0, clip_r1, clip_c1) '
+                'VALUES (?,?,?,?,?,?,?,?,?,?,?)', rows)
+        return len(rows)
+
+    def rows(self, session:int=None, image:str=None):
+        """
+        Yields tuples of COLUMNS, in the order saved
+        """
+        query = f'SELECT {", ".join(COLUMNS)} FROM cells'
+        conditions, params = [], []
+        if session is not None:
+            conditions.append('session = ?')
+            params.append(session)
+        if image is not None:
+            conditions.append('image = ?')
+            params.append(image)
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        yield from self._db.execute(query + ' ORDER BY id', params)
+
+    def export(self, path:str, session:int=None, image:str=None):
+        """
+        Write results to a .xlsx or .csv file, chosen by the extension
+
+        Returns number of cells written
+        """
+        if os.path.splitext(path)[1].lower() == '.csv':
+            return export_csv(path, self.rows(session, image))
+        return export_xlsx(path, self.rows(session, image))
+
+    def close(self):
+        self._db.close()
+
+
+def export_csv(path:str, rows):
+    n = 0
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(COLUMNS)
+        for row in rows:
+            writer.writerow(row)
+            n += 1
+    return n
+
+def export_xlsx(path:str, rows):
+    # Write-only mode streams rows instead of keeping every cell object
+    from openpyxl import Workbook
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet('cells')
+    ws.append(COLUMNS)
+    n = 0
+    for row in rows:
+        ws.append(row)
+        n += 1
+    wb.save(path)
+    return n
@@ -0,0 +1,97 @@
+import os
+import threading
+import tempfile
+import numpy as np
+from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
+from .common.constants import *
+from .compositor import colorize
+
+class SavePool():
+    """
+    Threads that encode and write images of saved clips.
+
+    PIL releases the GIL while compressing, so files are encoded
+    concurrently. Every file is written to a temporary name first and
+    renamed, so a crash never leaves a partial file.
+    """
+    def __init__(self, workers:int=SAVE_WORKERS, on_done=None):
+        """
+        Arguments:
+        workers : Number of threads
+        on_done : function(name, errors) called from a worker thread
+                  when every file of a save is written;
+                  errors is a list of exceptions, empty if all succeeded
+        """
+        self._executor = ThreadPoolExecutor(workers,
+                                            thread_name_prefix='save')
+        self._on_done = on_done
+
+    def save(self, name:str, files:list):
+        """
+        Write files in background
+
+        Arguments:
+        name : Anything that tells which save this is, given to on_done
+        files : list of (path, array, palette); See write_png
+        """
+        job = _SaveJob(name, len(files), self._on_done)
+        if len(files) == 0:
+            job.finish()
+        for path, array, palette in files:
+            future = self._executor.submit(write_png, path, array, palette)
+            future.add_done_callback(job.file_done)
+
+    def shutdown(self):
+        """
+        Wait until every save is written
+        """
+        self._executor.shutdown(wait=True)
+
+
+class _SaveJob():
+    def __init__(self, name, n_files, on_done):
+        self.name = name
+        self.errors = []
+        self._left = n_files
+        self._on_done = on_done
+        self._lock = threading.Lock()
+
+    def file_done(self, future):
+        with self._lock:
+            if future.exception() is not None:
+                self.errors.append(future.exception())
+            self._left -= 1
+            last = self._left == 0
+        if last:
+            self.finish()
+
+    def finish(self):
+        if self._on_done is not None:
+            self._on_done(self.name, self.errors)
+
+
+def write_png(path:str, array:np.array, palette:np.array=None):
+    """
+    Write a (Width, Height, 3) array as RGB PNG, atomically
+
+    array : Or anything np.asarray() makes one of, e.g. PackedLabels;
+            Unpacked here, in the worker thread
+    palette : If given, array is (Width, Height, 1) labels,
+              and is written in the colors of the labels
+    """
+    folder = os.path.dirname(path)
+    os.makedirs(folder, exist_ok=True)
+    array = np.asarray(array)
+    if palette is not None:
+        array = colorize(array, palette)
+    image = Image.fromarray(np.ascontiguousarray(array.swapaxes(0,1)))
+    fd, tmp_path = tempfile.mkstemp(dir=folder, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            image.save(f, format='PNG')
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
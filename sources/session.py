@@ -0,0 +1,184 @@
+import os
+import json
+import zlib
+import hashlib
+import tempfile
+import numpy as np
+from .common.constants import *
+from .packed import PackedMask, PackedLabels
+from .layer import SparseLayer
+
+_MAGIC = b'ADSESSN1'
+# Arrays start at multiples of this in the file
+_ALIGN = 64
+
+class Session():
+    """
+    Work on one image, in one file.
+
+    state is anything JSON can keep; Arrays are kept apart from it and
+    named in it. Large arrays that compress poorly (e.g. probability maps)
+    are stored raw and read as they are. Others (packed masks) are
+    compressed.
+
+    Arrays are read into memory, not memory-mapped: A mapped file cannot
+    be replaced on Windows, and the session of an open image is written
+    again on every confirmed clip.
+
+    File: magic, length of the header, JSON header of state and where each
+    array is, then the arrays.
+    """
+    def __init__(self, state:dict=None, arrays:dict=None):
+        self.state = {} if state is None else state
+        # {name : (array, raw)}
+        self._arrays = {} if arrays is None else arrays
+
+    def put(self, name:str, array:np.array, raw:bool=False):
+        """
+        Keep an array; Returns its name, to be put in state
+
+        raw : Store as is, instead of compressing
+        """
+        self._arrays[name] = (np.ascontiguousarray(array), raw)
+        return name
+
+    def get(self, name:str):
+        return self._arrays[name][0]
+
+    def put_mask(self, name:str, mask:PackedMask):
+        return {'shape':list(mask.shape), 'bits':self.put(name, mask.bits)}
+
+    def get_mask(self, ref:dict):
+        return PackedMask.from_bits(ref['shape'], self.get(ref['bits']))
+
+    def put_labels(self, name:str, labels:PackedLabels):
+        return {'shape':list(labels.shape),
+                'planes':{str(label):self.put_mask(f'{name}/{label}', plane)
+                          for label, plane in labels.planes.items()}}
+
+    def get_labels(self, ref:dict):
+        return PackedLabels.from_planes(ref['shape'],
+            {int(label):self.get_mask(plane)
+             for label, plane in ref['planes'].items()})
+
+    def put_layer(self, name:str, layer:tuple):
+        """
+        layer : (label, SparseLayer)
+        """
+        label, sparse = layer
+        return {'label':int(label), 'shape':list(sparse.shape),
+                'box':box_to_list(sparse.box),
+                'mask':self.put_mask(name, PackedMask(sparse.mask))}
+
+    def get_layer(self, ref:dict):
+        return (ref['label'], SparseLayer(ref['shape'],
+                                          box_from_list(ref['box']),
+                                          self.get_mask(ref['mask']).unpack()))
+
+    def write(self, path:str):
+        """
+        Write atomically; A crash never leaves a partial session
+        """
+        index = {}
+        chunks = []
+        offset = 0
+        for name, (array, raw) in self._arrays.items():
+            data = array.tobytes()
+            if not raw:
+                data = zlib.compress(data, 1)
+            index[name] = {'dtype':array.dtype.str, 'shape':list(array.shape),
+                           'raw':raw, 'offset':offset, 'nbytes':len(data)}
+            chunks.append(data)
+            offset += len(data)
+            pad = -offset % _ALIGN
+            chunks.append(bytes(pad))
+            offset += pad
+        header = json.dumps({'state':self.state, 'arrays':index}).encode()
+        start = len(_MAGIC) + 8 + len(header)
+        start += -start % _ALIGN
+        folder = os.path.dirname(path)
+        os.makedirs(folder, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=folder, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(_MAGIC)
+                f.write(np.uint64(len(header)).tobytes())
+                f.write(header)
+                f.write(bytes(start - f.tell()))
+                for chunk in chunks:
+                    f.write(chunk)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    @classmethod
+    def read(cls, path:str):
+        """
+        Raises OSError or ValueError if it cannot be read
+        """
+        with open(path, 'rb') as f:
+            if f.read(len(_MAGIC)) != _MAGIC:
+                raise ValueError(f'Not a session file: {path}')
+            try:
+                length = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+                header = json.loads(f.read(length))
+                start = len(_MAGIC) + 8 + length
+                start += -start % _ALIGN
+                arrays = {}
+                for name, entry in header['arrays'].items():
+                    dtype = np.dtype(entry['dtype'])
+                    shape = tuple(entry['shape'])
+                    f.seek(start + entry['offset'])
+                    data = f.read(entry['nbytes'])
+                    if not entry['raw']:
+                        data = zlib.decompress(data)
+                    array = np.frombuffer(data, dtype=dtype).reshape(shape)
+                    arrays[name] = (array, entry['raw'])
+                return cls(header['state'], arrays)
+            except (KeyError, TypeError, AttributeError, zlib.error) as e:
+                raise ValueError(f'Damaged session file: {path}: {e}') \
+                    from e
+
+
+def session_path(image_path:str):
+    """
+    Session file of an image, in SESSION_FOLDER next to it
+    """
+    folder, name = os.path.split(image_path)
+    return os.path.join(folder, SESSION_FOLDER, name + '.session')
+
+def clip_store_path(image_path:str):
+    """
+    ClipStore file of an image, next to its session file
+    """
+    folder, name = os.path.split(image_path)
+    return os.path.join(folder, SESSION_FOLDER, name + '.clips')
+
+def image_key(image:np.array):
+    """
+    Hash of the pixels of an image, to tell if a session is still of it
+    """
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f'{image.shape}'.encode())
+    h.update(np.ascontiguousarray(image).data)
+    return h.hexdigest()
+
+def points_to_list(points:tuple):
+    """
+    ((x, y), ...) e.g. a clip box, to JSON
+    """
+    return [[int(v) for v in p] for p in points]
+
+def points_from_list(points:list):
+    return tuple(tuple(p) for p in points)
+
+def box_to_list(box:tuple):
+    """
+    (slice, slice) to JSON
+    """
+    return [[int(s.start), int(s.stop)] for s in box]
+
+def box_from_list(box:list):
+    return tuple(slice(start, stop) for start, stop in box)
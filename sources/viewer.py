@@ -1,8 +1,12 @@
 import pygame
+import time
 import numpy as np
 from multiprocessing import Queue
 from multiprocessing import Process
 from .common.constants import *
+from .frame_buffer import FrameReader
+from .inbox import Inbox
+from .profiler import Profiler, timed
 
 class Viewer(Process) :
     """
@@ -10,7 +14,7 @@ class Viewer(Process) :
     """
     def __init__(self, width:int, height:int, event_queue:Queue,
                  image_queue:Queue, etc_queue:Queue, termQ:Queue,
-                 fps=60):
+                 fps=60, profile_options:dict=None):
         """
         Initialize Viewer
 
@@ -18,8 +22,10 @@ class Viewer(Process) :
         width : Width of the screen (Default 720)
         height : Height of the screen (Default 720)
         event_queue: a Queue to put events that happended in Viewer
-        image_queue: a Queue to get image array
+                     (the same Queue Engine gets commands from)
+        image_queue: a Queue to get notifications of new frames
         etc_queue: a Queue to get any meta info
+        profile_options: Keyword arguments of Profiler; Disabled if None
         """
         super().__init__(daemon=True)
         self.size = (width, height)
@@ -30,12 +36,18 @@ class Viewer(Process) :
         self._put_mouse_pos = False
         self._termQ = termQ
         self._show_cursor = False
+        self._profile_options = profile_options or {}
 
     def run(self) :
         """
         Run viewer's mainloop
         """
         mainloop = True
+        self._profiler = Profiler('Viewer', **self._profile_options)
+        # Stamped, so Engine can tell how long events waited
+        self._event_queue = Inbox(timed(self._event_queue, self._profiler,
+                                        'engine'))
+        self._image_queue = timed(self._image_queue, self._profiler, 'image')
         pygame.init()
         self._clock = pygame.time.Clock()
         self._screen = pygame.display.set_mode(self.size, pygame.RESIZABLE)
@@ -48,16 +60,41 @@ class Viewer(Process) :
         self._big_cursor.add(self._allgroup)
         self._cross_cursor.add(self._allgroup)
         self._mouse_prev = pygame.mouse.get_pos()
+        self._frame_reader = FrameReader()
+        # Latest frame not drawn yet, and its regions that are not drawn;
+        # None means the whole frame
+        notification = None
+        frame_rects = []
         while mainloop :
-            self._clock.tick(self._fps)
-            if not self._image_queue.empty():
-                image = self._image_queue.get()
-                if image.shape[0:2] != self.size:
-                    self.size = image.shape[0:2]
-                    self._screen = pygame.display.set_mode(self.size)
-                    self._background = pygame.Surface(self.size)
-                pygame.surfarray.blit_array(self._background, image)
-                self._screen.blit(self._background, (0,0))
+            interval = self._clock.tick(self._fps) / 1000
+            start = time.time()
+            self._profiler.record('frame interval', start - interval,
+                                  interval)
+            # Only the latest frame matters; skip the stale ones,
+            # but keep the regions they changed
+            received = 0
+            while not self._image_queue.empty():
+                notification, rects = self._image_queue.get()[NEW_FRAME]
+                received += 1
+                if rects is None or frame_rects is None:
+                    frame_rects = None
+                else:
+                    frame_rects = frame_rects + rects
+            if received > 1:
+                self._profiler.sample('dropped frames', received - 1)
+            screen_rects = []
+            if notification is not None:
+                with self._profiler.span('draw_frame'):
+                    drawn = self.draw_frame(notification, frame_rects)
+                if drawn is None:
+                    self._profiler.sample('torn frames', 1)
+                else:
+                    screen_rects = drawn
+                    notification = None
+                    frame_rects = []
+                    # Cursors may have been drawn over
+                    for sprite in self._allgroup:
+                        sprite.dirty = 1
             if not self._etc_queue.empty():
                 q = self._etc_queue.get()
                 for k, v in q.items():
@@ -96,6 +133,8 @@ class Viewer(Process) :
             # Keyboard events
                     if event.key == pygame.K_z:
                         self._event_queue.put({K_Z:None})
+                    elif event.key == pygame.K_y:
+                        self._event_queue.put({K_Y:None})
                     elif event.key == pygame.K_RETURN:
                         self._event_queue.put({K_ENTER:None})
             # Mouse events
@@ -112,10 +151,55 @@ class Viewer(Process) :
                 self._event_queue.put({MOUSEPOS:pygame.mouse.get_pos()})
             self._allgroup.update()
             self._allgroup.clear(self._screen, self._background)
-            self._allgroup.draw(self._screen)
-            pygame.display.flip()
+            screen_rects += self._allgroup.draw(self._screen)
+            # Nothing is sent to the display if nothing changed
+            if screen_rects:
+                with self._profiler.span('display.update'):
+                    pygame.display.update(screen_rects)
+            self._profiler.record('frame', start, time.time() - start)
+        self._frame_reader.close()
+        self._profiler.close()
         self._termQ.put(TERMINATE)
 
+    def draw_frame(self, notification:tuple, rects:list=None):
+        """
+        Copy changed regions of a frame from shared memory to the screen.
+        If Engine already overwrote it, a newer notification is on its way.
+
+        Arguments:
+        notification : Notification from Engine's FrameBuffer
+        rects : (x, y, width, height) of regions to copy;
+                None to copy the whole frame
+
+        Returns list of Rects of the screen that were drawn,
+        or None if the frame was overwritten before it was drawn.
+        """
+        image = self._frame_reader.frame(notification)
+        if image is None:
+            return None
+        if image.shape[0:2] != self.size:
+            self.size = image.shape[0:2]
+            self._screen = pygame.display.set_mode(self.size)
+            self._background = pygame.Surface(self.size)
+            rects = None
+        if rects is None:
+            rects = [(0, 0) + self.size]
+        # Writes straight into the background's pixels
+        pixels = pygame.surfarray.pixels3d(self._background)
+        for x, y, w, h in rects:
+            pixels[x:x+w, y:y+h] = image[x:x+w, y:y+h]
+        # Unlocks the background
+        del pixels
+        del image
+        if not self._frame_reader.valid(notification):
+            return None
+        drawn = []
+        for rect in rects:
+            rect = pygame.Rect(rect)
+            self._screen.blit(self._background, rect, rect)
+            drawn.append(rect)
+        return drawn
+
     @property
     def size(self):
         """
@@ -143,8 +227,10 @@ class Cursor(pygame.sprite.DirtySprite):
         self.visible = True
     
     def update(self):
-        self.rect.center = pygame.mouse.get_pos()
-        self.dirty = 1
+        pos = pygame.mouse.get_pos()
+        if self.rect.center != pos:
+            self.rect.center = pos
+            self.dirty = 1
 
 class BigCursor(pygame.sprite.DirtySprite):
     def __init__(self):
@@ -155,8 +241,10 @@ class BigCursor(pygame.sprite.DirtySprite):
         self.visible = False
 
     def update(self):
-        self.rect.center = pygame.mouse.get_pos()
-        self.dirty = 1
+        pos = pygame.mouse.get_pos()
+        if self.rect.center != pos:
+            self.rect.center = pos
+            self.dirty = 1
 
 class CrossCursor(pygame.sprite.DirtySprite):
     def __init__(self):
@@ -172,18 +260,25 @@ class CrossCursor(pygame.sprite.DirtySprite):
         self.visible = False
 
     def update(self):
-        self.rect.center = pygame.mouse.get_pos()
-        self.dirty = 1
+        pos = pygame.mouse.get_pos()
+        if self.rect.center != pos:
+            self.rect.center = pos
+            self.dirty = 1
 
 #testing
 if __name__ == '__main__':
     import time
+    from .frame_buffer import FrameBuffer
     imgQ = Queue()
     evntQ = Queue()
     etcQ = Queue()
-    v = Viewer(720, 300, evntQ, imgQ, etcQ)
+    termQ = Queue()
+    v = Viewer(720, 300, evntQ, imgQ, etcQ, termQ)
     v.start()
     time.sleep(3)
     newimg = np.ones((600,600,3), dtype=np.uint8)*100
-    imgQ.put(newimg)
-    time.sleep(3)
\ No newline at end of file
+    frame_buffer = FrameBuffer(newimg.nbytes, FRAME_SLOTS)
+    np.copyto(frame_buffer.acquire(newimg.shape), newimg)
+    imgQ.put({NEW_FRAME:(frame_buffer.publish(), None)})
+    time.sleep(3)
+    frame_buffer.close()
\ No newline at end of file
@@ -0,0 +1,50 @@
+import queue
+import numpy as np
+import pytest
+from sources.common.constants import *
+
+class Sink():
+    """
+    Stands in for the queues of Console and Viewer of a headless Engine.
+    Texts of message boxes are kept in order; get() waits for the next one,
+    e.g. to know when a save is written
+    """
+    def __init__(self):
+        self.messages = []
+        self._boxes = queue.Queue()
+
+    def put(self, message):
+        if MESSAGE_BOX in message:
+            self.messages.append(message[MESSAGE_BOX])
+            self._boxes.put(message[MESSAGE_BOX])
+
+    def get(self, timeout:float=None):
+        return self._boxes.get(timeout=timeout)
+
+
+@pytest.fixture
+def engine():
+    """
+    Engine run in this process; Its Sink is engine.sink
+    """
+    from sources.engine import Engine
+    sink = Sink()
+    engine = Engine(None, sink, sink, sink)
+    engine.sink = sink
+    yield engine
+    engine.close()
+
+@pytest.fixture
+def images(tmp_path):
+    """
+    Paths of two random (60, 80) images, a.png and b.png
+    """
+    from PIL import Image
+    rng = np.random.default_rng(1)
+    paths = []
+    for name in ('a.png', 'b.png'):
+        path = str(tmp_path / name)
+        Image.fromarray(rng.integers(0, 256, (60, 80, 3), dtype=np.uint8))\
+             .save(path)
+        paths.append(path)
+    return paths
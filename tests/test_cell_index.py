@@ -0,0 +1,103 @@
+import numpy as np
+import pytest
+from scipy import ndimage
+from sources.cell_index import CellIndex
+
+def assert_same_components(index, cell):
+    """
+    Components of index are those of a full labelling of cell
+    """
+    labels, n = ndimage.label(cell)
+    expected = sorted(np.bincount(labels.ravel())[1:].tolist())
+    assert sorted(index.sizes().tolist()) == expected
+    for label, count, box in index.components():
+        component_box, component = index.component(label)
+        assert component_box == box
+        assert component.sum() == count
+        # Every pixel of the component is one full component of cell
+        full = labels[box][component]
+        assert len(np.unique(full)) == 1
+        assert np.count_nonzero(labels == full[0]) == count
+
+def random_cell(shape, rng, p=0.55):
+    return ndimage.binary_opening(rng.random(shape) < p)
+
+def test_build():
+    cell = random_cell((40, 30), np.random.default_rng(0))
+    index = CellIndex()
+    assert not index.valid
+    index.build(cell)
+    assert index.valid
+    assert_same_components(index, cell)
+
+def test_build_empty():
+    index = CellIndex()
+    index.build(np.zeros((10, 10), dtype=bool))
+    assert len(index.sizes()) == 0
+    assert list(index.components()) == []
+    assert index.label_at((3, 3)) == 0
+
+def test_update_not_built():
+    index = CellIndex()
+    index.update(np.ones((5, 5), dtype=bool), (slice(0, 2), slice(0, 2)))
+    assert not index.valid
+
+@pytest.mark.parametrize('seed', range(5))
+def test_update_matches_build(seed):
+    rng = np.random.default_rng(seed)
+    shape = (50, 40)
+    cell = random_cell(shape, rng)
+    index = CellIndex()
+    index.build(cell)
+    for _ in range(10):
+        r0, c0 = rng.integers(0, shape[0]), rng.integers(0, shape[1])
+        region = (slice(r0, min(shape[0], r0 + rng.integers(1, 12))),
+                  slice(c0, min(shape[1], c0 + rng.integers(1, 12))))
+        cell = cell.copy()
+        cell[region] = rng.random(cell[region].shape) < 0.5
+        index.update(cell, region)
+        assert_same_components(index, cell)
+
+def test_update_merges():
+    cell = np.zeros((10, 20), dtype=bool)
+    cell[2:8, 2:8] = True
+    cell[2:8, 10:16] = True
+    index = CellIndex()
+    index.build(cell)
+    assert len(index.sizes()) == 2
+    cell[4, 8:10] = True
+    index.update(cell, (slice(4, 5), slice(8, 10)))
+    assert index.sizes().tolist() == [36 + 36 + 2]
+    assert index.label_at((2, 2)) == index.label_at((7, 15))
+
+def test_update_splits():
+    cell = np.zeros((10, 20), dtype=bool)
+    cell[2:8, 2:16] = True
+    index = CellIndex()
+    index.build(cell)
+    cell[:, 9] = False
+    index.update(cell, (slice(0, 10), slice(9, 10)))
+    assert sorted(index.sizes().tolist()) == [6*6, 6*7]
+    assert index.label_at((2, 2)) != index.label_at((7, 15))
+    assert index.label_at((5, 9)) == 0
+
+def test_update_at_border():
+    cell = np.zeros((10, 10), dtype=bool)
+    cell[:3, :3] = True
+    index = CellIndex()
+    index.build(cell)
+    cell[0, :] = True
+    index.update(cell, (slice(0, 1), slice(0, 10)))
+    assert_same_components(index, cell)
+    cell[:, -1] = True
+    index.update(cell, (slice(0, 10), slice(9, 10)))
+    assert_same_components(index, cell)
+
+def test_update_to_empty():
+    cell = np.ones((6, 6), dtype=bool)
+    index = CellIndex()
+    index.build(cell)
+    cell[:] = False
+    index.update(cell, (slice(0, 6), slice(0, 6)))
+    assert len(index.sizes()) == 0
+    assert list(index.components()) == []
@@ -0,0 +1,244 @@
+import os
+import threading
+import numpy as np
+import pytest
+from sources.clip_store import ClipStore
+from sources.packed import PackedLabels
+
+def make_clip(rng, shape=(13, 9)):
+    image = rng.integers(0, 256, shape + (3,), dtype=np.uint8)
+    labels = rng.integers(0, 3, shape + (1,)).astype(np.uint8)
+    return image, labels
+
+def assert_clip(store, clip_id, clip):
+    image, mask = store.get(clip_id)
+    np.testing.assert_array_equal(image, clip[0])
+    np.testing.assert_array_equal(mask.unpack(), clip[1])
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'session' / 'x.png.clips')
+
+def test_append_get(path):
+    rng = np.random.default_rng(0)
+    store = ClipStore(path)
+    clips = [make_clip(rng, shape) for shape in [(13, 9), (1, 1), (8, 16)]]
+    ids = [store.append(image, PackedLabels(labels))
+           for image, labels in clips]
+    assert len(store) == 3
+    assert all(clip_id in store for clip_id in ids)
+    for clip_id, clip in zip(ids, clips):
+        assert_clip(store, clip_id, clip)
+    store.close()
+
+def test_reopen(path):
+    rng = np.random.default_rng(1)
+    store = ClipStore(path)
+    clips = [make_clip(rng) for _ in range(3)]
+    ids = [store.append(image, PackedLabels(labels))
+           for image, labels in clips]
+    store.close()
+    store = ClipStore(path)
+    assert len(store) == 3
+    for clip_id, clip in zip(ids, clips):
+        assert_clip(store, clip_id, clip)
+    store.close()
+
+def test_empty_mask_and_image(path):
+    store = ClipStore(path)
+    labels = np.zeros((6, 5, 1), dtype=np.uint8)
+    image = np.zeros((6, 5, 3), dtype=np.uint8)
+    clip_id = store.append(image, PackedLabels(labels))
+    empty_id = store.append(np.zeros((0, 0, 3), dtype=np.uint8),
+                            PackedLabels(np.zeros((0, 0, 1), dtype=np.uint8)))
+    store.close()
+    store = ClipStore(path)
+    assert_clip(store, clip_id, (image, labels))
+    image, mask = store.get(empty_id)
+    assert image.shape == (0, 0, 3)
+    assert mask.unpack().shape == (0, 0, 1)
+    store.close()
+
+def test_cache_is_bounded(path):
+    rng = np.random.default_rng(2)
+    store = ClipStore(path, cache_clips=2)
+    clips = [make_clip(rng) for _ in range(5)]
+    ids = [store.append(image, PackedLabels(labels))
+           for image, labels in clips]
+    assert len(store._cache) == 2
+    for clip_id, clip in zip(ids, clips):
+        assert_clip(store, clip_id, clip)
+        assert len(store._cache) <= 2
+    store.close()
+
+def test_lazy_parts(path):
+    rng = np.random.default_rng(3)
+    store = ClipStore(path, cache_clips=0)
+    image, labels = make_clip(rng)
+    clip_id = store.append(image, PackedLabels(labels))
+    np.testing.assert_array_equal(np.asarray(store.image(clip_id)), image)
+    np.testing.assert_array_equal(np.asarray(store.mask(clip_id)), labels)
+    store.close()
+
+def test_temporary_store():
+    rng = np.random.default_rng(4)
+    store = ClipStore(None)
+    clip = make_clip(rng)
+    clip_id = store.append(clip[0], PackedLabels(clip[1]))
+    assert_clip(store, clip_id, clip)
+    assert store.compact([clip_id]) == [clip_id]
+    store.close()
+
+@pytest.mark.parametrize('cut', [1, 10, 100])
+def test_truncated_last_record_dropped(path, cut):
+    rng = np.random.default_rng(5)
+    store = ClipStore(path)
+    clips = [make_clip(rng) for _ in range(3)]
+    ids = [store.append(image, PackedLabels(labels))
+           for image, labels in clips]
+    store.close()
+    size = os.path.getsize(path)
+    with open(path, 'r+b') as f:
+        f.truncate(size - cut)
+    store = ClipStore(path)
+    assert len(store) == 2
+    assert ids[2] not in store
+    for clip_id, clip in zip(ids[:2], clips[:2]):
+        assert_clip(store, clip_id, clip)
+    # The partial record is cut off, so new clips follow whole ones
+    assert os.path.getsize(path) == ids[2]
+    clip = make_clip(rng)
+    clip_id = store.append(clip[0], PackedLabels(clip[1]))
+    store.close()
+    store = ClipStore(path)
+    assert len(store) == 3
+    assert_clip(store, clip_id, clip)
+    store.close()
+
+@pytest.mark.parametrize('damage', [b'JUNK', b'CLIP\xff\xff\xff\x7f',
+                                    b'CLIP\x05\x00\x00\x00{"a":',
+                                    b'CLIP\x02\x00\x00\x0042',
+                                    b'CLIP\x02\x00\x00\x00{}'])
+def test_damaged_record_dropped(path, damage):
+    rng = np.random.default_rng(6)
+    store = ClipStore(path)
+    clip = make_clip(rng)
+    clip_id = store.append(clip[0], PackedLabels(clip[1]))
+    store.close()
+    with open(path, 'ab') as f:
+        f.write(damage)
+    store = ClipStore(path)
+    assert len(store) == 1
+    assert_clip(store, clip_id, clip)
+    store.close()
+
+def test_empty_file(path):
+    os.makedirs(os.path.dirname(path))
+    open(path, 'wb').close()
+    store = ClipStore(path)
+    assert len(store) == 0
+    store.close()
+
+def test_compact(path):
+    rng = np.random.default_rng(7)
+    store = ClipStore(path)
+    clips = [make_clip(rng) for _ in range(4)]
+    ids = [store.append(image, PackedLabels(labels))
+           for image, labels in clips]
+    size = os.path.getsize(path)
+    new_ids = store.compact([ids[3], ids[1]])
+    assert len(store) == 2
+    assert os.path.getsize(path) < size
+    assert_clip(store, new_ids[0], clips[3])
+    assert_clip(store, new_ids[1], clips[1])
+    assert os.listdir(os.path.dirname(path)) == [os.path.basename(path)]
+    # Still appendable, and readable after reopening
+    clip = make_clip(rng)
+    clip_id = store.append(clip[0], PackedLabels(clip[1]))
+    store.close()
+    store = ClipStore(path)
+    assert len(store) == 3
+    assert_clip(store, new_ids[0], clips[3])
+    assert_clip(store, clip_id, clip)
+    store.close()
+
+def test_compact_to_nothing(path):
+    rng = np.random.default_rng(8)
+    store = ClipStore(path)
+    clip = make_clip(rng)
+    store.append(clip[0], PackedLabels(clip[1]))
+    assert store.compact([]) == []
+    assert len(store) == 0
+    assert os.path.getsize(path) == 0
+    store.close()
+
+def test_read_from_threads(path):
+    rng = np.random.default_rng(9)
+    store = ClipStore(path, cache_clips=1)
+    clips = [make_clip(rng) for _ in range(6)]
+    ids = [store.append(image, PackedLabels(labels))
+           for image, labels in clips]
+    errors = []
+    def read():
+        try:
+            for _ in range(20):
+                for clip_id, clip in zip(ids, clips):
+                    assert_clip(store, clip_id, clip)
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=read) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    store.close()
+
+
+def test_engine_leaves_image_while_saving(engine, images, tmp_path,
+                                          monkeypatch):
+    from sources import save_pool
+    from sources.common.constants import LABEL_BOX
+    from sources.layer import SparseLayer
+    rng = np.random.default_rng(10)
+    a, b = images
+    # Saves are held until released
+    release = threading.Event()
+    write_png = save_pool.write_png
+    def held_write_png(*args):
+        release.wait(10)
+        write_png(*args)
+    monkeypatch.setattr(save_pool, 'write_png', held_write_png)
+    try:
+        engine.load_image(a)
+        for _ in range(3):
+            image, labels = make_clip(rng)
+            engine._clips.append(engine.clip_store().append(
+                image, PackedLabels(labels)))
+            engine._cell_counts.append(100)
+            engine._clip_boxes.append(((0, 0), (13, 9)))
+            engine._box_layers.append((LABEL_BOX, SparseLayer(engine.shape)))
+        engine.fill_delete([0])
+        engine.fill_save('a.png', str(tmp_path))
+        store = engine.clip_store()
+        engine.load_image(b)
+        # Not waited for; The store stays open for the workers
+        assert not release.is_set()
+        assert engine._closing_stores == {a:store}
+        assert not store._file.closed
+        assert len(store) == 3
+        release.set()
+        assert engine.sink.get(10) == ('Saved a.png Successfully.\n'
+                                      'Don\'t forget to check.')
+        assert len(engine.sink.messages) == 1
+        engine.close_stores()
+        assert engine._closing_stores == {}
+        assert store._file.closed
+        # Compacted, and the session knows the new ids
+        engine.load_image(a)
+        assert len(engine.clip_store()) == 2
+        assert engine._saved_clips == set(engine._clips)
+        assert all(clip_id in engine.clip_store() for clip_id in engine._clips)
+        assert len(os.listdir(tmp_path / 'save' / 'a.png' / 'img')) == 2
+    finally:
+        release.set()
@@ -0,0 +1,167 @@
+import numpy as np
+import pytest
+from skimage import draw
+from sources.common.constants import *
+from sources.history import History, SlideDelta
+from sources.layer import SparseLayer
+
+class Edit():
+    def __init__(self, nbytes):
+        self.nbytes = nbytes
+
+def test_undo_redo_order():
+    history = History()
+    edits = [Edit(1) for _ in range(3)]
+    for edit in edits:
+        history.record(edit)
+    assert history.undo() is edits[2]
+    assert history.undo() is edits[1]
+    assert history.redo() is edits[1]
+    assert history.undo() is edits[1]
+    assert history.undo() is edits[0]
+    assert history.undo() is None
+    assert history.redo() is edits[0]
+
+def test_record_drops_redo():
+    history = History()
+    history.record(Edit(1))
+    history.record(Edit(2))
+    history.undo()
+    history.record(Edit(4))
+    assert history.redo() is None
+    assert history.nbytes == 5
+    assert len(history) == 2
+
+def test_empty_history():
+    history = History()
+    assert history.undo() is None
+    assert history.redo() is None
+    assert len(history) == 0
+
+def test_oldest_dropped_over_max_bytes():
+    history = History(max_bytes=10)
+    edits = [Edit(4) for _ in range(3)]
+    for edit in edits:
+        history.record(edit)
+    assert history.nbytes == 8
+    assert history.undo() is edits[2]
+    assert history.undo() is edits[1]
+    assert history.undo() is None
+
+def test_edit_larger_than_max_bytes():
+    history = History(max_bytes=10)
+    history.record(Edit(4))
+    history.record(Edit(20))
+    assert history.nbytes == 0
+    assert history.undo() is None
+
+def test_clear():
+    history = History()
+    history.record(Edit(3))
+    history.undo()
+    history.clear()
+    assert history.nbytes == 0
+    assert history.redo() is None
+
+def test_slide_delta_counts_only_arrays_not_in_both():
+    kept = SparseLayer((10, 10))
+    kept.fill((slice(0, 5), slice(0, 5)))
+    dropped = np.zeros(100, dtype=np.uint8)
+    delta = SlideDelta(([kept, dropped], [1, 2]), ([kept], [1]))
+    assert delta.nbytes == dropped.nbytes
+
+
+SHAPE = (80, 60)
+CENTER = (40, 30)
+
+def disk_prob():
+    """
+    Probability of one round cell in the middle, walled by membrane;
+    0.5 outside the wall
+    """
+    prob = np.full(SHAPE, 0.5, dtype=np.float32)
+    rr, cc = draw.disk(CENTER, 14, shape=SHAPE)
+    prob[rr, cc] = 0
+    rr, cc = draw.disk(CENTER, 10, shape=SHAPE)
+    prob[rr, cc] = 1
+    return prob
+
+@pytest.fixture
+def engine(engine):
+    engine.image = np.zeros(SHAPE + (3,), dtype=np.uint8)
+    return engine
+
+def start_clip(engine):
+    engine.draw_box_start((0, 0))
+    engine.draw_box_end((SHAPE[0], SHAPE[1]))
+    engine.set_prob_mask(disk_prob(), ratio=30)
+
+def test_undo_threshold_change_brings_fill_back(engine):
+    start_clip(engine)
+    engine.fill_cell(CENTER)
+    count = engine._cell_counts[-1]
+    assert count > 0
+    # 0.5 outside the wall joins the cells at 30%, but not at 60%
+    engine.change_mask_ratio(60)
+    assert engine._cell_layers == []
+    assert engine._cell_counts == []
+    engine.undo()
+    assert engine._cell_counts == [count]
+    assert len(engine._cell_layers) == 1
+    engine.redo()
+    assert engine._cell_counts == []
+
+def test_threshold_change_keeps_confirmed_counts(engine):
+    start_clip(engine)
+    engine.fill_cell(CENTER)
+    engine.clip_confirm()
+    confirmed = list(engine._cell_counts)
+    start_clip(engine)
+    engine.fill_cell(CENTER)
+    engine.change_mask_ratio(60)
+    assert engine._cell_counts == confirmed
+    assert len(engine._box_layers) == len(engine._cell_counts) + 1
+    engine.undo()
+    engine.clip_cancel()
+    assert engine._cell_counts == confirmed
+    assert len(engine._box_layers) == len(confirmed)
+
+def test_undo_edit_after_threshold_change(engine):
+    start_clip(engine)
+    plain = {ratio:engine.prob_mask.cells(ratio) for ratio in (30, 60)}
+    # A membrane line across the cell
+    engine.draw_mem_start((CENTER[0], 0))
+    engine.draw_mem_end((CENTER[0], SHAPE[1]-1))
+    engine.draw_apply()
+    assert not engine._mask[CENTER[0], CENTER[1], 0]
+    # Edits are kept over a new threshold
+    engine.change_mask_ratio(60)
+    assert not engine._mask[CENTER[0], CENTER[1], 0]
+    engine.undo()
+    np.testing.assert_array_equal(engine._mask[...,0], plain[60])
+    engine.redo()
+    assert not engine._mask[CENTER[0], CENTER[1], 0]
+    engine.undo()
+    engine.change_mask_ratio(30)
+    np.testing.assert_array_equal(engine._mask[...,0], plain[30])
+
+def test_undo_confirmed_clip_is_told(engine):
+    start_clip(engine)
+    engine.fill_cell(CENTER)
+    engine.clip_confirm()
+    count = engine._cell_counts[-1]
+    assert engine.sink.messages == []
+    # Z outside of a clip undoes the confirmed clip, out of view
+    engine.handle_event(K_Z, None)
+    assert engine._cell_counts == []
+    assert engine.sink.messages == \
+           ['Undo removed 1 confirmed clip(s) from the results.']
+    engine.handle_event(K_Y, None)
+    assert engine._cell_counts == [count]
+    assert engine.sink.messages[-1] == \
+           'Redo brought back 1 clip(s) to the results.'
+    # Edits of a clip are in view, and not told
+    start_clip(engine)
+    engine.fill_cell(CENTER)
+    engine.handle_event(K_Z, None)
+    assert len(engine.sink.messages) == 2
@@ -0,0 +1,111 @@
+import numpy as np
+import pytest
+from sources.brush import stroke
+from sources.layer import SparseLayer, union_box
+
+SHAPE = (40, 30)
+
+def dense_stroke(points, radius):
+    layer = np.zeros(SHAPE + (1,), dtype=bool)
+    stroke(layer, points, radius)
+    return layer
+
+def test_empty_layer():
+    layer = SparseLayer(SHAPE + (3,))
+    assert layer.shape == SHAPE
+    assert layer.empty()
+    assert layer.nbytes == 0
+    assert not layer.dense().any()
+    assert layer.dense().shape == SHAPE + (1,)
+    array = np.zeros(SHAPE + (1,), dtype=np.uint8)
+    layer.paint_on(array, 7)
+    assert not array.any()
+    cover = np.zeros(SHAPE + (1,), dtype=bool)
+    layer.cover(cover)
+    assert not cover.any()
+
+def test_fill():
+    layer = SparseLayer(SHAPE)
+    layer.fill((slice(5, 8), slice(2, 4)))
+    assert layer.box == (slice(5, 8), slice(2, 4))
+    assert layer.mask.shape == (3, 2, 1)
+    assert layer.mask.all()
+
+def test_grow_keeps_what_is_drawn():
+    layer = SparseLayer(SHAPE)
+    layer.fill((slice(5, 8), slice(2, 4)))
+    layer.fill((slice(20, 21), slice(25, 27)))
+    assert layer.box == (slice(5, 21), slice(2, 27))
+    expected = np.zeros(SHAPE + (1,), dtype=bool)
+    expected[5:8, 2:4] = True
+    expected[20:21, 25:27] = True
+    np.testing.assert_array_equal(layer.dense(), expected)
+
+def test_fill_clipped_to_image():
+    layer = SparseLayer(SHAPE)
+    layer.fill((slice(-5, 3), slice(28, 40)))
+    assert layer.box == (slice(0, 3), slice(28, 30))
+    layer = SparseLayer(SHAPE)
+    layer.fill((slice(50, 60), slice(0, 5)))
+    assert layer.empty()
+
+def test_fill_points_outside_skipped():
+    layer = SparseLayer(SHAPE)
+    layer.fill_points(np.array([-1, 0, 39, 40]), np.array([0, 0, 29, 5]))
+    expected = np.zeros(SHAPE + (1,), dtype=bool)
+    expected[0, 0] = expected[39, 29] = True
+    np.testing.assert_array_equal(layer.dense(), expected)
+    layer = SparseLayer(SHAPE)
+    layer.fill_points(np.array([-3]), np.array([100]))
+    assert layer.empty()
+
+@pytest.mark.parametrize('points', [
+    [(20, 15), (25, 10)],
+    # At and across the borders of the image
+    [(0, 0)],
+    [(39, 29)],
+    [(-3, 10), (10, -3)],
+    [(35, 25), (45, 35)],
+    [(20, 0), (20, 29)],
+])
+def test_stroke_like_dense(points):
+    layer = SparseLayer(SHAPE)
+    layer.stroke(points, 4.5)
+    np.testing.assert_array_equal(layer.dense(), dense_stroke(points, 4.5))
+    for s, n in zip(layer.box, SHAPE):
+        assert 0 <= s.start <= s.stop <= n
+
+def test_stroke_outside_image():
+    layer = SparseLayer(SHAPE)
+    layer.stroke([(-20, -20), (-10, -15)], 3)
+    assert layer.empty()
+
+def test_strokes_add_up():
+    layer = SparseLayer(SHAPE)
+    expected = np.zeros(SHAPE + (1,), dtype=bool)
+    for points in ([(5, 5), (10, 5)], [(35, 28)], [(0, 20), (3, 29)]):
+        layer.stroke(points, 2.5)
+        stroke(expected, points, 2.5)
+    np.testing.assert_array_equal(layer.dense(), expected)
+
+def test_paint_and_cover():
+    layer = SparseLayer(SHAPE)
+    layer.stroke([(0, 0), (10, 10)], 2)
+    array = np.zeros(SHAPE + (1,), dtype=np.uint8)
+    layer.paint_on(array, 3)
+    np.testing.assert_array_equal(array[...,0] == 3, layer.dense()[...,0])
+    cover = np.zeros(SHAPE + (1,), dtype=bool)
+    cover[30, 20] = True
+    layer.cover(cover)
+    expected = layer.dense()
+    expected[30, 20] = True
+    np.testing.assert_array_equal(cover, expected)
+
+def test_union_box():
+    a, b, empty = SparseLayer(SHAPE), SparseLayer(SHAPE), SparseLayer(SHAPE)
+    a.fill((slice(1, 3), slice(4, 6)))
+    b.fill((slice(10, 12), slice(0, 2)))
+    assert union_box([]) is None
+    assert union_box([(1, empty)]) is None
+    assert union_box([(1, a), (2, empty), (3, b)]) == \
+           (slice(1, 12), slice(0, 6))
@@ -0,0 +1,113 @@
+import numpy as np
+import pytest
+from sources.packed import PackedMask, PackedLabels
+
+# Widths that do not fill the last byte of a packed row, and one that does
+SHAPES = [(1, 1, 1), (7, 3, 1), (5, 9, 1), (13, 17, 1), (4, 16, 1), (6, 11)]
+
+@pytest.mark.parametrize('shape', SHAPES)
+def test_mask_round_trip(shape):
+    array = np.random.default_rng(0).random(shape) > 0.5
+    packed = PackedMask(array)
+    assert packed.shape == shape
+    assert packed.unpack().dtype == bool
+    np.testing.assert_array_equal(packed.unpack(), array)
+    np.testing.assert_array_equal(np.asarray(packed), array)
+
+def test_mask_padding_bits_are_not_read():
+    # 9 pixels a row takes 2 bytes; The 7 bits after them must not show
+    array = np.ones((3, 9, 1), dtype=bool)
+    packed = PackedMask(array)
+    assert packed.bits.shape == (3, 2)
+    np.testing.assert_array_equal(packed.unpack(), array)
+
+def test_mask_from_bits():
+    array = np.random.default_rng(1).random((5, 11, 1)) > 0.5
+    packed = PackedMask(array)
+    copy = PackedMask.from_bits(list(packed.shape), packed.bits.copy())
+    assert copy.shape == array.shape
+    np.testing.assert_array_equal(copy.unpack(), array)
+
+@pytest.mark.parametrize('shape', [(0, 0, 1), (0, 5, 1), (5, 0, 1)])
+def test_mask_empty_shape(shape):
+    packed = PackedMask(np.zeros(shape, dtype=bool))
+    assert packed.unpack().shape == shape
+    assert packed.area() == 0
+    assert packed.bounding_box() is None
+
+def test_mask_nothing_set():
+    packed = PackedMask(np.zeros((8, 9, 1), dtype=bool))
+    assert packed.area() == 0
+    assert packed.bounding_box() is None
+    assert not packed.unpack().any()
+
+@pytest.mark.parametrize('shape', SHAPES)
+def test_area(shape):
+    rng = np.random.default_rng(5)
+    for p in (0.1, 0.5, 1.0):
+        array = rng.random(shape) < p
+        assert PackedMask(array).area() == array.sum()
+
+@pytest.mark.parametrize('shape', SHAPES)
+def test_bounding_box(shape):
+    rng = np.random.default_rng(2)
+    for _ in range(20):
+        array = np.zeros(shape, dtype=bool)
+        r0, c0 = rng.integers(shape[0]), rng.integers(shape[1])
+        r1 = rng.integers(r0, shape[0]) + 1
+        c1 = rng.integers(c0, shape[1]) + 1
+        array[r0, c0] = True
+        array[r1-1, c1-1] = True
+        assert PackedMask(array).bounding_box() == \
+               (slice(r0, r1), slice(c0, c1))
+
+def test_bounding_box_last_column():
+    array = np.zeros((4, 9, 1), dtype=bool)
+    array[2, 8] = True
+    assert PackedMask(array).bounding_box() == (slice(2, 3), slice(8, 9))
+
+@pytest.mark.parametrize('shape', SHAPES)
+def test_labels_round_trip(shape):
+    labels = np.random.default_rng(3).integers(0, 5, shape).astype(np.uint8)
+    packed = PackedLabels(labels)
+    assert set(packed.planes) == set(np.unique(labels)) - {0}
+    unpacked = packed.unpack()
+    assert unpacked.dtype == np.uint8
+    np.testing.assert_array_equal(unpacked, labels)
+    np.testing.assert_array_equal(np.asarray(packed), labels)
+    for label in range(5):
+        assert packed.area(label if label else 9) == \
+               (0 if label == 0 else (labels == label).sum())
+
+def test_labels_bounding_box():
+    labels = np.zeros((6, 10, 1), dtype=np.uint8)
+    labels[1:3, 4:9] = 2
+    labels[5, 0] = 1
+    packed = PackedLabels(labels)
+    assert packed.bounding_box(2) == (slice(1, 3), slice(4, 9))
+    assert packed.bounding_box(1) == (slice(5, 6), slice(0, 1))
+    assert packed.bounding_box(3) is None
+
+def test_labels_high_label():
+    labels = np.zeros((3, 5, 1), dtype=np.uint8)
+    labels[1, 2] = 255
+    packed = PackedLabels(labels)
+    assert list(packed.planes) == [255]
+    np.testing.assert_array_equal(packed.unpack(), labels)
+
+def test_labels_all_zero():
+    packed = PackedLabels(np.zeros((4, 7, 1), dtype=np.uint8))
+    assert packed.planes == {}
+    assert packed.nbytes == 0
+    assert not packed.unpack().any()
+
+def test_labels_empty_shape():
+    packed = PackedLabels(np.zeros((0, 0, 1), dtype=np.uint8))
+    assert packed.unpack().shape == (0, 0, 1)
+
+def test_labels_from_planes():
+    labels = np.random.default_rng(4).integers(0, 3, (6, 13, 1))\
+               .astype(np.uint8)
+    packed = PackedLabels(labels)
+    copy = PackedLabels.from_planes(list(packed.shape), packed.planes)
+    np.testing.assert_array_equal(copy.unpack(), labels)
@@ -0,0 +1,231 @@
+import os
+import numpy as np
+import pytest
+from sources.common.constants import *
+from sources.layer import SparseLayer
+from sources.packed import PackedMask, PackedLabels
+from sources.session import Session, session_path, clip_store_path, \
+    image_key, points_to_list, points_from_list, box_to_list, box_from_list
+
+def make_session():
+    rng = np.random.default_rng(0)
+    session = Session()
+    labels = rng.integers(0, 3, (13, 7, 1)).astype(np.uint8)
+    layer = SparseLayer((20, 20))
+    layer.stroke([(2, 3), (9, 15)], 2.5)
+    session.state = {
+        'levels':session.put('levels', rng.integers(0, 256, (13, 7),
+                                                    dtype=np.uint8), raw=True),
+        'floats':session.put('floats', rng.random((5, 3))),
+        'empty':session.put('empty', np.zeros((0, 4), dtype=np.uint8),
+                            raw=True),
+        'mask':session.put_mask('mask', PackedMask(labels > 0)),
+        'labels':session.put_labels('labels', PackedLabels(labels)),
+        'layer':session.put_layer('layer', (LABEL_CELL, layer)),
+        'text':'ü',
+    }
+    return session, labels, layer
+
+def test_round_trip(tmp_path):
+    session, labels, layer = make_session()
+    path = str(tmp_path / 'a' / 'x.session')
+    session.write(path)
+    read = Session.read(path)
+    state = read.state
+    assert state['text'] == 'ü'
+    for name in ('levels', 'floats', 'empty'):
+        expected = session.get(state[name])
+        array = read.get(state[name])
+        assert array.dtype == expected.dtype
+        np.testing.assert_array_equal(array, expected)
+    np.testing.assert_array_equal(read.get_mask(state['mask']).unpack(),
+                                  labels > 0)
+    np.testing.assert_array_equal(read.get_labels(state['labels']).unpack(),
+                                  labels)
+    label, read_layer = read.get_layer(state['layer'])
+    assert label == LABEL_CELL
+    assert read_layer.box == layer.box
+    np.testing.assert_array_equal(read_layer.dense(), layer.dense())
+
+def test_write_again_after_read(tmp_path):
+    # Arrays read from a file are written back to the same file
+    session, _, _ = make_session()
+    path = str(tmp_path / 'x.session')
+    session.write(path)
+    read = Session.read(path)
+    read.state['text'] = 'again'
+    read.write(path)
+    again = Session.read(path)
+    assert again.state['text'] == 'again'
+    np.testing.assert_array_equal(again.get('levels'), session.get('levels'))
+    assert [f for f in os.listdir(tmp_path)] == ['x.session']
+
+def test_empty_session(tmp_path):
+    path = str(tmp_path / 'x.session')
+    Session().write(path)
+    read = Session.read(path)
+    assert read.state == {}
+
+def test_missing_file(tmp_path):
+    with pytest.raises(OSError):
+        Session.read(str(tmp_path / 'none.session'))
+
+def test_not_a_session(tmp_path):
+    path = tmp_path / 'x.session'
+    path.write_bytes(b'PNG not a session at all')
+    with pytest.raises(ValueError):
+        Session.read(str(path))
+
+def test_empty_file(tmp_path):
+    path = tmp_path / 'x.session'
+    path.write_bytes(b'')
+    with pytest.raises(ValueError):
+        Session.read(str(path))
+
+def written(tmp_path):
+    session, _, _ = make_session()
+    path = tmp_path / 'x.session'
+    session.write(str(path))
+    return path, path.read_bytes()
+
+@pytest.mark.parametrize('keep', [0.01, 0.1, 0.5, 0.9])
+def test_truncated(tmp_path, keep):
+    path, data = written(tmp_path)
+    path.write_bytes(data[:int(len(data) * keep)])
+    with pytest.raises(ValueError):
+        Session.read(str(path))
+
+def test_last_array_truncated(tmp_path):
+    path, data = written(tmp_path)
+    # Only padding follows the last array
+    path.write_bytes(data[:len(data.rstrip(b'\0')) - 1])
+    with pytest.raises(ValueError):
+        Session.read(str(path))
+
+def test_corrupt_header(tmp_path):
+    path, data = written(tmp_path)
+    path.write_bytes(data[:20] + b'}{' + data[22:])
+    with pytest.raises(ValueError):
+        Session.read(str(path))
+
+def test_header_of_something_else(tmp_path):
+    path, data = written(tmp_path)
+    # Valid JSON, but not of a session
+    header = b'{"arrays": 1}'
+    path.write_bytes(data[:8] + np.uint64(len(header)).tobytes() + header)
+    with pytest.raises(ValueError):
+        Session.read(str(path))
+
+def test_corrupt_compressed_array(tmp_path):
+    path, data = written(tmp_path)
+    # Flip bytes in the middle of the last (compressed) array
+    end = len(data.rstrip(b'\0'))
+    data = bytearray(data)
+    data[end-8:end-2] = bytes(255 - b for b in data[end-8:end-2])
+    path.write_bytes(bytes(data))
+    with pytest.raises(ValueError):
+        Session.read(str(path))
+
+def test_failed_write_keeps_old_file(tmp_path):
+    session, _, _ = make_session()
+    path = str(tmp_path / 'x.session')
+    session.write(path)
+    before = open(path, 'rb').read()
+    bad = Session({'x':object()})
+    with pytest.raises(TypeError):
+        bad.write(path)
+    assert open(path, 'rb').read() == before
+    assert os.listdir(tmp_path) == ['x.session']
+
+def test_paths():
+    image = os.path.join('data', 'slide.png')
+    assert session_path(image) == \
+           os.path.join('data', SESSION_FOLDER, 'slide.png.session')
+    assert clip_store_path(image) == \
+           os.path.join('data', SESSION_FOLDER, 'slide.png.clips')
+
+def test_image_key():
+    image = np.zeros((4, 3, 3), dtype=np.uint8)
+    other = image.copy()
+    other[1, 1, 1] = 1
+    assert image_key(image) == image_key(image.copy())
+    assert image_key(image) != image_key(other)
+    assert image_key(image) != image_key(image.reshape(3, 4, 3))
+    # Views that are not contiguous hash as their pixels
+    assert image_key(np.asfortranarray(image)) == image_key(image)
+
+def test_json_helpers():
+    points = ((np.int64(1), 2), (3, np.int32(4)))
+    assert points_from_list(points_to_list(points)) == ((1, 2), (3, 4))
+    box = (slice(np.int64(2), 5), slice(0, 7))
+    assert box_from_list(box_to_list(box)) == (slice(2, 5), slice(0, 7))
+
+
+def draw_box(engine):
+    engine.draw_box_start((5, 5))
+    engine.draw_box_end((40, 30))
+    engine.set_prob_mask(np.zeros(engine.shape[:2], dtype=np.float32))
+
+def test_engine_restores_clip(engine, images):
+    a, b = images
+    engine.load_image(a)
+    draw_box(engine)
+    box = engine._clip_box
+    engine.load_image(b)
+    assert not engine._clipped_mode
+    engine.load_image(a)
+    assert engine._clipped_mode
+    assert engine._clip_box == box
+    assert engine.sink.messages == []
+
+@pytest.mark.parametrize('damage', ['truncate', 'garbage', 'empty'])
+def test_engine_reports_damaged_session(engine, images, damage):
+    a, b = images
+    engine.load_image(a)
+    draw_box(engine)
+    engine.load_image(b)
+    path = session_path(a)
+    data = open(path, 'rb').read()
+    data = {'truncate':data[:len(data)//2],
+            'garbage':data[:len(data)//2] + bytes(64) + data[len(data)//2:],
+            'empty':b''}[damage]
+    with open(path, 'wb') as f:
+        f.write(data)
+    engine.load_image(a)
+    assert not engine._clipped_mode
+    assert len(engine.sink.messages) == 1
+    assert 'Failed to restore' in engine.sink.messages[0]
+
+@pytest.mark.parametrize('field, value', [
+    ('calibration', None), ('calibration', 'ab'), ('mask_ratio', None),
+    ('cell_counts', 3), ('clip_boxes', [[1]]), ('prob_masks', [{}]),
+    ('view', {}), ('view', None), ('view/clip_box', 5),
+    ('view/mask', {'shape':[2, 2, 1], 'planes':{}}),
+])
+def test_engine_reports_wrong_fields(engine, images, field, value):
+    a, b = images
+    engine.load_image(a)
+    draw_box(engine)
+    engine.load_image(b)
+    path = session_path(a)
+    session = Session.read(path)
+    state = session.state
+    *parents, name = field.split('/')
+    for parent in parents:
+        state = state[parent]
+    if value is None:
+        del state[name]
+    else:
+        state[name] = value
+    session.write(path)
+    engine.load_image(a)
+    # Nothing of the session is kept
+    assert not engine._clipped_mode
+    assert engine._clip_boxes == []
+    assert engine._cell_counts == []
+    assert engine._mask_ratio == DEFAULT_MASK_RATIO
+    assert (engine._mp_ratio_pixel, engine._mp_ratio_micrometer) == \
+           (DEFAULT_MP_PIXEL, DEFAULT_MP_MICRO)
+    assert engine.mask.shape == engine.shape[:2] + (1,)
+    assert len(engine.sink.messages) == 1
+    assert 'Failed to restore' in engine.sink.messages[0]